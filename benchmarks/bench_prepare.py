@@ -0,0 +1,103 @@
+"""Benchmark building the batch requests that are sent.
+
+Compares the original iterrows/deepcopy renderer, which inlined every row's
+values into the whole prompt, with the request lines llm_util writes: the
+instructions once as a shared system message and only a small JSON data
+block per row. Checks that every request carries the system message and a
+data block with the row's values of the columns its fields reference, and
+reports the characters sent per row.
+
+Usage (from the repository root):
+    python benchmarks/bench_prepare.py --rows 50000
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from copy import deepcopy
+
+import pandas as pd
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
+
+from src.utils.llm_util import _iter_batch_lines  # noqa: E402
+from src.utils.template_util import PromptTemplate, load_prompt_template  # noqa: E402
+from synthetic import make_dataframe, make_fields  # noqa: E402
+
+MODEL = 'gpt-4o-mini'
+
+
+def legacy_render(df, field_descriptions):
+    """The original row-by-row renderer, kept here as the baseline"""
+    available_columns = df.columns.tolist()
+    with open('instructions.txt', 'r') as f:
+        prompt_template = f.read()
+
+    prompts = []
+    for index, row in df.iterrows():
+        fields = deepcopy(field_descriptions)
+        for field in fields:
+            instructions = field['instructions']
+            for col in available_columns:
+                instructions = instructions.replace(f'@{col}', str(row[col].item() if hasattr(row[col], 'item') else row[col]))
+            field['instructions'] = instructions
+        prompts.append(prompt_template.replace('{{FIELD_DESCRIPTIONS}}', json.dumps(fields, indent=2)))
+    return prompts
+
+
+def batch_lines(df, field_descriptions):
+    return list(_iter_batch_lines(df, field_descriptions, MODEL))
+
+
+def expected_blocks(df, template):
+    """The data block each row should get, decoded: its referenced column values as text, or None"""
+    columns = {
+        col: [None if pd.isna(value) else str(value.item() if hasattr(value, 'item') else value)
+              for value in df[col].to_numpy(dtype=object).tolist()]
+        for col in template.data_columns
+    }
+    return [dict(zip(columns, values)) for values in zip(*columns.values())] if columns else [{}] * len(df)
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=50000)
+    parser.add_argument('--columns', type=int, default=12)
+    parser.add_argument('--fields', type=int, default=4)
+    args = parser.parse_args()
+
+    df = make_dataframe(args.rows, args.columns)
+    fields = make_fields(df, args.fields)
+    load_prompt_template()
+
+    legacy, legacy_seconds = timed(legacy_render, df, fields)
+    lines, compiled_seconds = timed(batch_lines, df, fields)
+
+    template = PromptTemplate(fields, df.columns)
+    messages = [json.loads(line)['body']['messages'] for line in lines]
+    if any(system['content'] != template.system for system, _ in messages):
+        sys.exit("A request doesn't carry the shared system message")
+    blocks = [user['content'] for _, user in messages]
+    if [json.loads(block) for block in blocks] != expected_blocks(df, template):
+        sys.exit("A data block doesn't hold its row's values")
+
+    print(f"rows={args.rows:,} columns={args.columns} fields={args.fields}")
+    print(f"legacy    {args.rows / legacy_seconds:12,.0f} rows/sec  ({legacy_seconds:.2f}s)")
+    print(f"compiled  {args.rows / compiled_seconds:12,.0f} rows/sec  ({compiled_seconds:.2f}s)")
+    print(f"speedup   {legacy_seconds / compiled_seconds:12.1f}x")
+    legacy_chars = sum(map(len, legacy)) / len(legacy)
+    block_chars = sum(map(len, blocks)) / len(blocks)
+    print(f"chars/row legacy {legacy_chars:,.0f}; compiled {block_chars:,.0f} data + {len(template.system):,} shared system prompt")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,226 @@
+"""Benchmark the prepare, submit, parse and estimate hot paths.
+
+Each stage runs in its own process against synthetic data and an in-process
+stand-in for the OpenAI files and batches endpoints, so the suite runs
+offline. Reports throughput, peak RSS and traced allocations per row, and
+compares them with a saved baseline.
+
+Usage (from the repository root):
+    python benchmarks/bench_suite.py
+    python benchmarks/bench_suite.py --rows 10000,100000,1000000 --stages prepare,parse
+    python benchmarks/bench_suite.py --save-baseline
+    python benchmarks/bench_suite.py --check --threshold 0.25
+"""
+import argparse
+import json
+import os
+import re
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+
+STAGES = ['prepare', 'submit', 'parse', 'estimate']
+MODEL = 'gpt-4o-mini'
+
+# Allocations are traced on a sample this size, since tracing slows everything down
+ALLOC_SAMPLE_ROWS = 5000
+
+# RSS growth below this is noise from the allocator, not a regression
+RSS_SLACK_MB = 32
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class _RegexEncoding:
+    """Rough tokenizer used when tiktoken's encodings can't be downloaded"""
+
+    def encode(self, text, **kwargs):
+        return re.findall(r"\w+|[^\w\s]", text)
+
+    def encode_batch(self, texts, **kwargs):
+        return [self.encode(text) for text in texts]
+
+
+def prepare_stage(df, fields):
+    from src.utils import llm_util
+
+    # Consume the lines as they're produced, as the uploader does
+    return lambda: sum(len(line) for line in llm_util._iter_batch_lines(df, fields, MODEL))
+
+
+def submit_stage(df, fields):
+    from src.utils import llm_util
+    from stub_openai import StubOpenAI
+
+    llm_util.get_client = lambda api_key, provider='openai': StubOpenAI()
+    return lambda: llm_util.apply_transformation('sk-benchmark', df, fields, MODEL)
+
+
+def parse_stage(df, fields):
+    """Submit the job up front so only downloading and parsing its outputs is measured"""
+    from src.utils import llm_util
+    from stub_openai import StubOpenAI
+
+    stub = StubOpenAI(fields)
+    llm_util.get_client = lambda api_key, provider='openai': stub
+    batch_id, _ = llm_util.apply_transformation('sk-benchmark', df, fields, MODEL)
+    return lambda: llm_util.check_batch_status(batch_id, 'sk-benchmark')
+
+
+def estimate_stage(df, fields):
+    from src.utils import estimate_util
+
+    return lambda: estimate_util.estimate_cost(df, fields, MODEL)
+
+
+STAGE_SETUP = {
+    'prepare': prepare_stage,
+    'submit': submit_stage,
+    'parse': parse_stage,
+    'estimate': estimate_stage,
+}
+
+
+def use_offline_tokenizer():
+    """Fall back to a regex tokenizer if tiktoken has no cached encoding; return True if it did"""
+    from src.utils import estimate_util
+
+    try:
+        estimate_util.get_encoding(MODEL).encode('warm up')
+        return False
+    except Exception:
+        estimate_util.get_encoding = lambda model: _RegexEncoding()
+        return True
+
+
+def worker(args):
+    """Measure one stage at one size and print the result as JSON"""
+    sys.path.insert(0, ROOT)
+    os.chdir(ROOT)
+    os.environ['TABLETALK_CACHE_PATH'] = os.path.join(tempfile.mkdtemp(prefix='tabletalk-bench-'), 'cache.sqlite')
+    from synthetic import make_dataframe, make_fields
+
+    df = make_dataframe(args.rows, args.columns, cell_words=args.cell_words)
+    fields = make_fields(df, args.fields)
+    stub_tokenizer = args.stage == 'estimate' and use_offline_tokenizer()
+
+    run = STAGE_SETUP[args.stage](df, fields)
+    rss_before = peak_rss_mb()
+    start = time.perf_counter()
+    run()
+    seconds = time.perf_counter() - start
+    rss_after = peak_rss_mb()
+
+    # Trace allocations on a fresh cache so the sample isn't served from the first run
+    os.environ['TABLETALK_CACHE_PATH'] = os.path.join(tempfile.mkdtemp(prefix='tabletalk-bench-'), 'cache.sqlite')
+    sample = df.head(ALLOC_SAMPLE_ROWS)
+    run = STAGE_SETUP[args.stage](sample, fields)
+    tracemalloc.start()
+    run()
+    _, traced_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    print(json.dumps({
+        'rows_per_sec': args.rows / seconds if seconds else 0.0,
+        'seconds': seconds,
+        'peak_rss_mb': rss_after,
+        'stage_rss_mb': max(rss_after - rss_before, 0.0),
+        'alloc_bytes_per_row': traced_peak / max(len(sample), 1),
+        'stub_tokenizer': stub_tokenizer,
+    }))
+
+
+def measure(stage, rows, args):
+    command = [
+        sys.executable, os.path.abspath(__file__), '--worker', stage,
+        '--rows', str(rows), '--columns', str(args.columns),
+        '--fields', str(args.fields), '--cell-words', str(args.cell_words),
+    ]
+    output = subprocess.run(command, check=True, capture_output=True, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def case_key(stage, rows, args):
+    return f"{stage}:rows={rows}:columns={args.columns}:fields={args.fields}:cell_words={args.cell_words}"
+
+
+def regressions(result, baseline, threshold):
+    """Return descriptions of the ways result is worse than baseline"""
+    problems = []
+    if result['rows_per_sec'] < baseline['rows_per_sec'] * (1 - threshold):
+        problems.append(f"throughput {result['rows_per_sec']:,.0f} < {baseline['rows_per_sec']:,.0f} rows/sec")
+    if result['stage_rss_mb'] > baseline['stage_rss_mb'] * (1 + threshold) + RSS_SLACK_MB:
+        problems.append(f"RSS growth {result['stage_rss_mb']:,.0f} > {baseline['stage_rss_mb']:,.0f} MB")
+    if result['alloc_bytes_per_row'] > baseline['alloc_bytes_per_row'] * (1 + threshold):
+        problems.append(f"allocations {result['alloc_bytes_per_row']:,.0f} > {baseline['alloc_bytes_per_row']:,.0f} B/row")
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', default='10000,100000', help='Comma-separated dataset sizes')
+    parser.add_argument('--columns', type=int, default=12)
+    parser.add_argument('--fields', type=int, default=4)
+    parser.add_argument('--cell-words', type=int, default=6, help='Words per text cell')
+    parser.add_argument('--stages', default=','.join(STAGES))
+    parser.add_argument('--save-baseline', action='store_true', help=f'Store the results in {os.path.relpath(BASELINE_PATH, ROOT)}')
+    parser.add_argument('--check', action='store_true', help='Exit with an error if any case regressed against the baseline')
+    parser.add_argument('--threshold', type=float, default=0.25, help='Allowed relative slowdown or growth')
+    parser.add_argument('--worker', choices=STAGES, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        args.stage = args.worker
+        args.rows = int(args.rows)
+        worker(args)
+        return
+
+    baseline = {}
+    if os.path.exists(BASELINE_PATH):
+        with open(BASELINE_PATH) as f:
+            baseline = json.load(f)
+
+    print(f"columns={args.columns} fields={args.fields} cell_words={args.cell_words}")
+    print(f"{'stage':<9} {'rows':>10} {'rows/sec':>12} {'seconds':>8} {'peak RSS':>9} {'stage RSS':>10} {'alloc/row':>10}  vs baseline")
+    results = {}
+    failures = []
+    for rows in [int(rows) for rows in args.rows.split(',')]:
+        for stage in args.stages.split(','):
+            result = measure(stage, rows, args)
+            key = case_key(stage, rows, args)
+            results[key] = result
+
+            comparison = ''
+            if key in baseline:
+                problems = regressions(result, baseline[key], args.threshold)
+                change = result['rows_per_sec'] / baseline[key]['rows_per_sec'] - 1
+                comparison = f"{change:+.0%}" + (f"  REGRESSION: {'; '.join(problems)}" if problems else '')
+                if problems:
+                    failures.append(key)
+            note = ' (regex tokenizer)' if result['stub_tokenizer'] else ''
+            print(
+                f"{stage:<9} {rows:>10,} {result['rows_per_sec']:>12,.0f} {result['seconds']:>8.2f} "
+                f"{result['peak_rss_mb']:>7,.0f}MB {result['stage_rss_mb']:>8,.0f}MB "
+                f"{result['alloc_bytes_per_row']:>8,.0f}B  {comparison}{note}"
+            )
+
+    if args.save_baseline:
+        baseline.update(results)
+        with open(BASELINE_PATH, 'w') as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+        print(f"Saved {len(results)} cases to {os.path.relpath(BASELINE_PATH, ROOT)}")
+
+    if args.check and failures:
+        sys.exit(f"{len(failures)} case(s) regressed by more than {args.threshold:.0%}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+"""In-process stand-in for the OpenAI files and batches endpoints.
+
+Only the calls made by llm_util are implemented. Uploads are read in full,
+so the benchmark still pays for producing the request bytes, and batches
+complete as soon as they are created, with outputs generated from each
+request's custom_id.
+"""
+import contextlib
+import itertools
+import json
+from types import SimpleNamespace
+
+from synthetic import output_line, response_content
+
+UPLOAD_BLOCK_BYTES = 1024 * 1024
+
+
+class _Content:
+    def __init__(self, data):
+        self.data = data
+
+    def iter_lines(self):
+        for line in self.data.split(b"\n"):
+            yield line.decode("utf-8")
+
+
+class _Files:
+    def __init__(self, stub):
+        self.stub = stub
+        self.with_streaming_response = self
+
+    def create(self, file, purpose):
+        filename, fileobj = file if isinstance(file, tuple) else (None, file)
+        file_id = f"file-{next(self.stub.ids)}"
+        if self.stub.field_descriptions is None and filename != "row_map.jsonl":
+            # Nothing will be generated from this file, so only count its lines
+            lines = 1
+            for block in iter(lambda: fileobj.read(UPLOAD_BLOCK_BYTES), b""):
+                lines += block.count(b"\n")
+            self.stub.stored[file_id] = lines
+        else:
+            self.stub.stored[file_id] = fileobj.read()
+        return SimpleNamespace(id=file_id)
+
+    @contextlib.contextmanager
+    def content(self, file_id):
+        yield _Content(self.stub.stored[file_id])
+
+
+class _Batches:
+    def __init__(self, stub):
+        self.stub = stub
+
+    def create(self, input_file_id, endpoint, completion_window, metadata=None):
+        batch_id = f"batch_{next(self.stub.ids)}"
+        # The input isn't needed once the batch exists, so don't let it count towards RSS
+        input_data = self.stub.stored.pop(input_file_id)
+        requests = input_data if isinstance(input_data, int) else input_data.count(b"\n") + 1
+        output_file_id = None
+        if self.stub.field_descriptions is not None:
+            output_file_id = f"file-{next(self.stub.ids)}"
+            self.stub.stored[output_file_id] = self.stub.make_output(input_data)
+        del input_data
+        self.stub.records[batch_id] = SimpleNamespace(
+            id=batch_id,
+            status="completed",
+            output_file_id=output_file_id,
+            error_file_id=None,
+            metadata=metadata,
+            request_counts=SimpleNamespace(completed=requests, failed=0, total=requests),
+        )
+        return self.stub.records[batch_id]
+
+    def retrieve(self, batch_id):
+        return self.stub.records[batch_id]
+
+    def cancel(self, batch_id):
+        self.stub.records[batch_id].status = "cancelled"
+        return self.stub.records[batch_id]
+
+
+class StubOpenAI:
+    """Client with files.create, files.with_streaming_response.content and batches.*
+
+    With field_descriptions set, each created batch gets an output file with
+    one schema-valid response per request.
+    """
+
+    def __init__(self, field_descriptions=None):
+        self.field_descriptions = field_descriptions
+        self.ids = itertools.count(1)
+        self.stored = {}
+        self.records = {}
+        self.files = _Files(self)
+        self.batches = _Batches(self)
+
+    def make_output(self, input_data):
+        lines = []
+        for i, line in enumerate(input_data.split(b"\n")):
+            custom_id = json.loads(line)["custom_id"]
+            lines.append(output_line(custom_id, response_content(self.field_descriptions, i)))
+        return "\n".join(lines).encode("utf-8")
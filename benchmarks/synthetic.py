@@ -0,0 +1,55 @@
+"""Synthetic datasets and batch outputs shared by the benchmarks."""
+import json
+
+import numpy as np
+import pandas as pd
+
+WORDS = np.array(['alpha', 'beta', 'gamma', 'delta', 'epsilon', 'zeta', 'eta', 'theta'])
+
+
+def make_dataframe(rows, columns, seed=0, cell_words=6):
+    """Synthetic table with a mix of text, integer and float columns"""
+    rng = np.random.default_rng(seed)
+    data = {}
+    for i in range(columns):
+        kind = i % 3
+        if kind == 0:
+            data[f'text_{i}'] = [' '.join(w) for w in rng.choice(WORDS, size=(rows, cell_words))]
+        elif kind == 1:
+            data[f'count_{i}'] = rng.integers(0, 1000, size=rows)
+        else:
+            data[f'price_{i}'] = rng.random(rows) * 100
+    return pd.DataFrame(data)
+
+
+def make_fields(df, count):
+    columns = df.columns.tolist()
+    return [
+        {
+            "field_name": f"field_{i}",
+            "instructions": f"Summarise @{columns[i % len(columns)]} given @{columns[(i + 1) % len(columns)]}",
+            "data_type": "text" if i % 2 == 0 else "number",
+        }
+        for i in range(count)
+    ]
+
+
+def response_content(field_descriptions, seed):
+    """A response message for one row, with one value per field matching its type"""
+    return json.dumps({
+        field["field_name"]: seed % 100 if field["data_type"] == "number" else f"value {seed}"
+        for field in field_descriptions
+    })
+
+
+def output_line(custom_id, content):
+    """One line of a batch output file in the provider's format"""
+    return json.dumps({
+        "id": f"batch_req_{custom_id}",
+        "custom_id": custom_id,
+        "response": {
+            "status_code": 200,
+            "body": {"choices": [{"index": 0, "message": {"role": "assistant", "content": content}}]},
+        },
+        "error": None,
+    })
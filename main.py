@@ -1,5 +1,12 @@
+import os
+
 import streamlit as st
 from sidebar import render_sidebar
+from src.utils.metrics_util import LOG_JSON_ENV, configure_logging
+
+# Log timings and token usage as JSON lines when asked to
+if os.environ.get(LOG_JSON_ENV):
+    configure_logging()
 
 # Configure the page
 st.set_page_config(
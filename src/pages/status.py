@@ -1,26 +1,252 @@
+import datetime
+
+import pandas as pd
 import streamlit as st
 from src.utils.llm_util import check_batch_status
-from openai import OpenAI
+from src.utils.client_util import validate_api_key
+from src.utils.estimate_util import prompt_cache_report, usage_comparison, usage_cost
+from src.utils.ingest_util import SUPPORTED_FILE_TYPES, dataset_fingerprint, load_dataset
+from src.utils.job_util import RequestCounts
+from src.utils.poller_util import get_poller
+from src.utils.registry_util import JobRegistry
+from src.utils.result_util import EXPORT_FORMATS, ResultsMemo, export_results, join_results
 
+# Seconds between refreshes of the progress of a job the poller is watching
+REFRESH_SECONDS = 10
+
+MANUAL_ENTRY = "Enter a batch ID"
+
+# Rows of the results sent to the browser at a time
+PAGE_SIZES = [50, 100, 500, 1000]
+
+
+@st.cache_resource
+def results_memo():
+    """Results of finished jobs, kept in memory across reruns so they aren't fetched or loaded again"""
+    return ResultsMemo()
+
+
+@st.cache_resource(show_spinner="Loading the original table...", max_entries=2)
+def load_source(file):
+    """Load an uploaded original table to join the results onto, with its fingerprint"""
+    source = load_dataset(file)
+    return source, dataset_fingerprint(source)
+
+
+def show_progress(status, request_counts):
+    """Show the status and combined progress of an unfinished job"""
+    if status == "retrying":
+        st.info("Status: **retrying**. Rows that failed or came back incomplete were sent again in a follow-up batch; its results will be merged in. Check back later", icon=":material/info:")
+    elif status == "escalating":
+        st.info("Status: **escalating**. Rows that failed their checks were sent to the stronger model; its results will replace theirs. Check back later", icon=":material/info:")
+    else:
+        st.info(f"Status: **{status}**. Check back later (it can take up to 24 hours for a batch to complete)", icon=":material/info:")
+
+    # Show combined progress across all batches of the job
+    if request_counts is not None and request_counts.total:
+        processed = request_counts.completed + request_counts.failed
+        st.progress(
+            processed / request_counts.total,
+            text=f"{processed:,} of {request_counts.total:,} rows processed ({request_counts.failed:,} failed)"
+        )
+
+
+def show_results(df, batch_id):
+    """Show the results of a finished job with their row breakdown, downloads and join"""
+    st.info("Batch completed successfully!", icon=":material/check_circle:")
+
+    malformed_lines = df.attrs.get('malformed_lines', 0)
+    if malformed_lines:
+        st.warning(f"{malformed_lines:,} responses could not be parsed and are missing from the results.")
+
+    # Where every row's result came from, and why the rest have none
+    row_breakdown = df.attrs.get('row_breakdown')
+    if row_breakdown:
+        completed, cached, recovered, failed, invalid, missing = st.columns(6)
+        completed.metric("Completed", f"{row_breakdown['completed']:,}")
+        cached.metric("From cache", f"{row_breakdown['from_cache']:,}")
+        recovered.metric("Recovered by retry", f"{row_breakdown['recovered_by_retry']:,}")
+        failed.metric("Failed", f"{row_breakdown['failed']:,}")
+        invalid.metric("Invalid", f"{row_breakdown['invalid']:,}")
+        missing.metric("Missing", f"{row_breakdown['missing']:,}")
+        if row_breakdown['retry_rounds']:
+            st.caption(f"{row_breakdown['retry_rounds']} follow-up batch(es) were sent for rows that failed or came back incomplete.")
+
+    failed_rows = df.attrs.get('failed_rows', [])
+    if failed_rows:
+        st.warning(f"{len(failed_rows):,} rows still have no results after retrying.")
+
+    # Rows the first model got wrong and the stronger model was asked again
+    cascade = df.attrs.get('cascade')
+    if cascade:
+        st.caption(
+            f"Cascade: {cascade['escalated']:,} rows failed their checks and were escalated to {cascade['model']}"
+            + (f" for ${usage_cost(cascade['usage']):.4f}" if cascade['usage']['requests'] else "")
+            + f"; {cascade['still_failing']:,} still fail them."
+            + (
+                f" {cascade['not_escalated']:,} rows that fail them came from the response cache and weren't escalated."
+                if cascade.get('not_escalated') else ""
+            )
+        )
+        if cascade['reasons']:
+            with st.expander("Show why rows were escalated", expanded=False):
+                st.dataframe(
+                    pd.DataFrame(list(cascade['reasons'].items()), columns=["reason", "rows"]),
+                    hide_index=True
+                )
+
+    # Values that didn't fit their field's type were left empty
+    invalid_values = df.attrs.get('invalid_values', {})
+    if invalid_values:
+        st.warning(
+            "Some values didn't match their field's type and were left empty: "
+            + ", ".join(f"{field_name} ({len(values):,})" for field_name, values in invalid_values.items())
+        )
+        with st.expander("Show values that were left empty", expanded=False):
+            st.dataframe(
+                pd.DataFrame([
+                    {"row_number": row_number, "field": field_name, "value": value}
+                    for field_name, values in invalid_values.items()
+                    for row_number, value in values.items()
+                ]),
+                hide_index=True
+            )
+
+    cached_rows = df.attrs.get('cached_rows', 0)
+    if cached_rows:
+        st.caption(f"{cached_rows:,} responses were served from the local cache.")
+
+    # How much of the shared instructions the provider served from its prompt cache
+    usage = df.attrs.get('usage')
+    if usage and usage['input_tokens']:
+        report = prompt_cache_report(usage)
+        st.caption(
+            f"Prompt cache: {report['hit_rate']:.0%} of {usage['input_tokens']:,} input tokens were read from the "
+            f"provider's cache, saving ${report['savings']:.4f}."
+        )
+        show_usage(usage, df.attrs.get('batch_usage', []), registry.job(batch_id, api_key))
+
+    # Responses follow the job's schema, so the columns are exactly its fields
+    st.divider()
+    with st.expander("Show results", expanded=False):
+        show_page(df)
+
+    show_downloads(df, "results")
+    st.divider()
+
+    # Add the results as columns of the table they were generated from
+    source_file = st.file_uploader(
+        "Add the results to the original table",
+        type=SUPPORTED_FILE_TYPES,
+        help="Upload the file the job was run on to download it with the new columns filled in."
+    )
+    if source_file is not None:
+        source, fingerprint = load_source(source_file)
+        job = registry.job(batch_id, api_key)
+        if job is not None and job["dataset"] and fingerprint != job["dataset"]:
+            st.warning("This file isn't the one the job was run on, so rows may not line up.")
+        joined = join_results(source, df)
+        if joined.attrs['unmatched_results']:
+            st.warning(f"{joined.attrs['unmatched_results']:,} results match no row of this file.")
+        st.caption(f"{len(joined):,} rows with {len(joined.columns):,} columns.")
+        show_downloads(joined, "joined_results")
+        st.divider()
+
+
+def show_usage(usage, batch_usage, job):
+    """Show what the job actually used next to the estimate made when it was submitted"""
+    estimate = job["estimate"] if job is not None else None
+    if estimate:
+        comparison = pd.DataFrame(usage_comparison(estimate, usage))
+        comparison["measure"] = comparison["measure"].map(
+            {"requests": "Requests", "input_tokens": "Input tokens", "output_tokens": "Output tokens", "cost": "Cost (USD)"}
+        )
+        st.dataframe(
+            comparison,
+            hide_index=True,
+            column_config={
+                "measure": "",
+                "estimated": st.column_config.NumberColumn("Estimated", format="%.4g"),
+                "actual": st.column_config.NumberColumn("Actual", format="%.4g"),
+                "difference": st.column_config.NumberColumn("Difference", format="percent")
+            }
+        )
+        st.caption(
+            "The estimate was made at submission for every row and field; rows served from the cache and "
+            "fields reused from earlier results aren't sent, so they lower the actual usage."
+        )
+    else:
+        st.caption(f"{usage['input_tokens']:,} input and {usage['output_tokens']:,} output tokens, ${usage_cost(usage):.4f}.")
+
+    if len(batch_usage) > 1:
+        with st.expander("Show token usage per batch", expanded=False):
+            st.dataframe(pd.DataFrame(batch_usage).set_index("batch_id"))
+
+
+def show_downloads(df, name):
+    """Download buttons for each export format; files are only written when a button is clicked"""
+    for column, (file_format, (label, extension, mime)) in zip(st.columns(len(EXPORT_FORMATS)), EXPORT_FORMATS.items()):
+        column.download_button(
+            f"Download {label}",
+            lambda file_format=file_format: export_results(df, file_format),
+            f"{name}.{extension}",
+            mime,
+            key=f"download-{name}-{file_format}"
+        )
+
+
+def show_page(df):
+    """Show one page of the results; only that page is sent to the browser"""
+    size_col, page_col = st.columns(2)
+    page_size = size_col.selectbox("Rows per page", PAGE_SIZES, key="results-page-size")
+    pages = max(-(-len(df) // page_size), 1)
+    # Stay on a page that exists after the page size or the job changes
+    if st.session_state.get("results-page", 1) > pages:
+        st.session_state["results-page"] = pages
+    page = page_col.number_input("Page", min_value=1, max_value=pages, value=1, step=1, key="results-page")
+
+    start = (page - 1) * page_size
+    st.dataframe(df.iloc[start:start + page_size], hide_index=True)
+    st.caption(f"Rows {min(start + 1, len(df)):,}–{min(start + page_size, len(df)):,} of {len(df):,}, page {page:,} of {pages:,}")
+
+
+@st.fragment(run_every=REFRESH_SECONDS)
+def show_watched_job(job_id):
+    """Show the last status the poller recorded, refreshing until the results are in"""
+    job = registry.job(job_id, api_key)
+    if job["done"]:
+        st.rerun()
+    show_progress(job["status"], job_counts(job))
+    if job["error"]:
+        st.warning(f"The last check failed: {job['error']}")
+    if job["checked_at"]:
+        st.caption(
+            f"Checked automatically, last at {format_time(job['checked_at'])}; "
+            f"next check at {format_time(job['next_check_at'])}. The results are downloaded as soon as the batch finishes."
+        )
 
-def validate_api_key(api_key):
-    """Validate OpenAI API key"""
-    try:
-        client = OpenAI(api_key=api_key)
-        client.models.list()
-        return True
-    except Exception:
-        return False
+
+def job_counts(job):
+    return RequestCounts(completed=job["completed"], failed=job["failed"], total=job["total"])
+
+
+def format_time(timestamp):
+    return datetime.datetime.fromtimestamp(timestamp).strftime("%Y-%m-%d %H:%M:%S")
 
 
 st.title("Check Status")
 
+registry = JobRegistry()
+poller = get_poller()
+memo = results_memo()
+
 col1, col2 = st.columns([6, 1])
 
 with col1:
     api_key = st.text_input(
-        "API Key", 
-        type="password", 
+        "API Key",
+        value=st.session_state.get("api_key") or "",
+        type="password",
         placeholder="Enter your API key"
     )
 
@@ -32,71 +258,80 @@ with col2:
         else:
             st.markdown("<div style='margin-top: 34px;'></div>", unsafe_allow_html=True)
             st.write(":material/error: Not valid!")
-        
 
-# Add API key validation
-batch_id = st.text_input(
-    "Batch ID", 
-    placeholder="Enter your batch ID"
+# Jobs submitted from this machine with this key, newest first; other keys' jobs are never shown
+jobs = registry.jobs(api_key, limit=100) if api_key else []
+if not api_key:
+    st.caption("Enter your API key to see the jobs submitted with it.")
+elif jobs:
+    st.dataframe(
+        pd.DataFrame([
+            {
+                "Batch ID": job["job_id"],
+                "Submitted": format_time(job["submitted_at"]),
+                "Model": job["model"],
+                "Rows": job["rows"],
+                "Fields": ", ".join(field["field_name"] for field in job["fields"]),
+                "Status": job["status"],
+                "Results": "Ready" if job["done"] else "",
+            }
+            for job in jobs
+        ]),
+        hide_index=True
+    )
+
+statuses = {job["job_id"]: job["status"] for job in jobs}
+selected_job = st.selectbox(
+    "Job",
+    [job["job_id"] for job in jobs] + [MANUAL_ENTRY],
+    format_func=lambda job_id: job_id if job_id == MANUAL_ENTRY else f"{job_id} ({statuses[job_id]})"
 )
 
-# Add button that's enabled only when both fields have values
+if selected_job == MANUAL_ENTRY:
+    batch_id = st.text_input(
+        "Batch ID",
+        placeholder="Enter your batch ID"
+    ).strip()
+else:
+    batch_id = selected_job
+
+job = registry.job(batch_id, api_key) if batch_id and api_key else None
+
+# Results already fetched in this process with this key, or stored when the job finished
+results = memo.get(batch_id, api_key) if batch_id else None
+if results is None and job is not None and job["done"]:
+    results = registry.load_results(batch_id, api_key)
+    if results is not None:
+        memo.put(batch_id, api_key, results)
+
+# Add button that's enabled only when both fields have values and the results aren't here already
 check_status_button = st.button(
-    "Check Status", 
+    "Check Status",
     type="primary",
     icon=":material/check_circle:",
-    disabled=not (batch_id and api_key),
+    disabled=not (batch_id and api_key) or results is not None or (job is not None and job["done"]),
 )
 
-if check_status_button:
+if results is not None:
+    if job is not None and job["done"]:
+        st.caption(f"Results stored on {format_time(job['checked_at'])}.")
+    show_results(results, batch_id)
+elif job is not None and job["done"]:
+    st.error("The stored results of this job are missing.")
+elif check_status_button:
     try:
-        done, df, batch = check_batch_status(batch_id, api_key)
+        if job is not None:
+            # Keep polling the job in the background with this key, starting now
+            poller.watch(batch_id, api_key)
+            done, df, batch = poller.check(batch_id)
+        else:
+            done, df, batch = check_batch_status(batch_id, api_key)
 
         if not done:
-            st.info(f"Status: **{batch.status}**. Check back later (it can take up to 24 hours for a batch to complete)", icon=":material/info:")
+            show_progress(batch.status, batch.request_counts)
         elif done and df is not None:
-            # Calculate the percentage of non-null values for each column
-            non_null_percentages = df.count() / len(df) * 100
-            
-            # Separate columns with high completion rate (e.g., >80%) from hallucinated ones
-            # Exclude row_number from the percentage calculation
-            columns_to_check = [col for col in df.columns if col != 'row_number']
-            main_columns = [col for col in columns_to_check if non_null_percentages[col] > 80]
-            hallucinated_columns = [col for col in columns_to_check if non_null_percentages[col] <= 80]
-            
-            # Always include row_number in main_df
-            main_df = df[['row_number'] + main_columns]
-
-            st.info("Batch completed successfully!", icon=":material/check_circle:")
-
-            st.divider()
-            with st.expander("Show main results", expanded=False):
-                st.dataframe(main_df)
-            
-            # Download button for main results
-            st.download_button(
-                "Download Main Results CSV",
-                main_df.to_csv(index=False),
-                "main_results.csv",
-                "text/csv",
-                key="download-main-csv"
-            )
-            st.divider()
-
-            # Show hallucinated fields if they exist
-            st.warning("The following results may contain hallucinated fields (columns with sparse data):")
-            with st.expander("Show hallucinated results", expanded=False):  
-                st.dataframe(df)
-            
-            # Download button for hallucinated results
-            st.download_button(
-                "Download Hallucinated Results CSV",
-                df.to_csv(index=False),
-                "hallucinated_results.csv",
-                "text/csv",
-                key="download-hallucinated-csv"
-            )
-            st.divider()
+            memo.put(batch_id, api_key, df)
+            show_results(df, batch_id)
 
         # Show the batch response in a collapsible section
         with st.expander("Show raw batch response", expanded=False):
@@ -105,4 +340,10 @@ if check_status_button:
 
     except Exception as e:
         st.error(f"Error retrieving batch status. Check that the API key and batch ID are correct.")
-        st.write(e)
\ No newline at end of file
+        st.write(e)
+elif job is not None and poller.watching(batch_id):
+    show_watched_job(batch_id)
+elif job is not None:
+    show_progress(job["status"], job_counts(job))
+    last_checked = f"Last checked at {format_time(job['checked_at'])}" if job["checked_at"] else "Not checked yet"
+    st.caption(f"{last_checked}. Check Status to keep checking it in the background.")
@@ -1,15 +1,24 @@
 import streamlit as st
 import pandas as pd
+import datetime
 import json
-from src.utils.llm_util import apply_transformation, apply_test_transformation
-from openai import OpenAI
-import tiktoken
+from src.utils.llm_util import DEFAULT_TEST_ROWS, apply_realtime_transformation, apply_test_run, apply_transformation
+from src.utils.realtime_util import DEFAULT_CONCURRENCY, DEFAULT_RPM, DEFAULT_TPM
+from src.utils.estimate_util import cheaper_models, estimate_cost as estimate_dataset_cost, job_estimate, project_test_run
+from src.utils.registry_util import JobRegistry
+from src.utils.ingest_util import SUPPORTED_FILE_TYPES, Dataset, load_dataset
+from src.utils.client_util import validate_api_key
+from src.utils.poller_util import get_poller
+from src.utils.provider_util import OPENAI, provider_for_model
+from src.utils.validation_util import CONSTRAINT_KEYS
 
 class Field:
-    def __init__(self, name, instructions, field_type):
+    def __init__(self, name, instructions, field_type, constraints=None):
         self.name = name
         self.instructions = instructions
         self.field_type = field_type
+        # Checks the values are validated against: pattern, minimum, maximum, allowed_values
+        self.constraints = constraints or {}
 
 def update_value(key):
     """Update session state new_columns based on input changes"""
@@ -25,64 +34,31 @@ def update_value(key):
     elif input_type == "type":
         st.session_state.new_columns[index].field_type = st.session_state[key]
 
-def count_tokens(text, model):
-    """Count the number of tokens in a text string"""
-    encoding = tiktoken.encoding_for_model(model)
-    return len(encoding.encode(text))
-
-def estimate_cost(df, field_descriptions):
+def update_constraint(key):
+    """Update a column's checks from their inputs (format: "constraint_index"); an empty input removes the check"""
+    constraint, index = key.rsplit('_', 1)
+    col = st.session_state.new_columns[int(index)]
+    if not hasattr(col, 'constraints'):
+        col.constraints = {}
+
+    value = st.session_state[key]
+    if constraint == "allowed_values" and value:
+        value = [item.strip() for item in value.split(",") if item.strip()]
+    if value is None or value == "" or value == []:
+        col.constraints.pop(constraint, None)
+    else:
+        col.constraints[constraint] = value
+
+@st.cache_data(show_spinner="Estimating cost...", max_entries=8, hash_funcs={Dataset: lambda dataset: dataset.fingerprint})
+def estimate_cost(df, field_descriptions, model, reasoning=False):
     """Estimate the cost of running transformations on the dataset"""
-    # Load the instruction template
-    with open('instructions.txt', 'r') as f:
-        prompt_template = f.read()
-    
-    # Create a sample prompt with field descriptions
-    sample_prompt = prompt_template.replace('{{FIELD_DESCRIPTIONS}}', json.dumps(field_descriptions, indent=2))
-    
-    # Count tokens in the prompt
-    input_tokens_per_row = count_tokens(sample_prompt, st.secrets["MODEL"])
-    output_tokens_per_row = 100  # Assuming average output is around 100 tokens
-    
-    # Calculate total tokens
-    total_rows = len(df)
-    total_input_tokens = input_tokens_per_row * total_rows
-    total_output_tokens = output_tokens_per_row * total_rows
-    
-    # Calculate cost using provided rates
-    input_cost_per_million = 0.15  # $0.15 per million tokens
-    output_cost_per_million = 0.60  # $0.60 per million tokens
-    
-    total_input_cost = (total_input_tokens / 1_000_000) * input_cost_per_million
-    total_output_cost = (total_output_tokens / 1_000_000) * output_cost_per_million
-    total_cost = total_input_cost + total_output_cost
-    
-    return {
-        'input_tokens_per_row': input_tokens_per_row,
-        'output_tokens_per_row': output_tokens_per_row,
-        'total_rows': total_rows,
-        'total_input_tokens': total_input_tokens,
-        'total_output_tokens': total_output_tokens,
-        'total_cost': total_cost
-    }
-
-def validate_api_key(api_key):
-    """Validate OpenAI API key"""
-    try:
-        client = OpenAI(api_key=api_key)
-        client.models.list()
-        return True
-    except Exception:
-        return False
+    return estimate_dataset_cost(df, field_descriptions, model, reasoning=reasoning)
 
-@st.cache_data
+@st.cache_resource(show_spinner="Loading dataset...", max_entries=4)
 def load_dataframe(file):
     """Load and cache dataframe from uploaded file"""
     try:
-        df = pd.read_csv(file)
-        original_rows = len(df)
-        if original_rows > 50000:
-            df = df.head(50000)
-            st.warning(f"⚠️ Dataset has been trimmed from {original_rows:,} to 50,000 rows due to size limitations.")
+        df = load_dataset(file)
         return df
     except Exception as e:
         st.error(f"Error processing file. Please check your input and try again. Error: {str(e)}")
@@ -94,7 +70,7 @@ st.title("Transform Data")
 # **Added Step-by-Step Instructions Expander**
 with st.expander("How to Use This App", icon=":material/help_outline:", expanded=False):
     st.markdown("""
-1. **Upload Your File (CSV only)**
+1. **Upload Your File (CSV, Excel or Parquet)**
 
 2. **View Original Data**
    - Once uploaded, the original data will be displayed for your reference
@@ -119,7 +95,7 @@ with st.expander("How to Use This App", icon=":material/help_outline:", expanded
 st.divider()
 
 # File upload
-uploaded_file = st.file_uploader("Start by uploading your CSV file", type=['csv'])
+uploaded_file = st.file_uploader("Start by uploading your CSV, Excel or Parquet file", type=SUPPORTED_FILE_TYPES)
 
 st.divider()
 
@@ -158,7 +134,7 @@ if uploaded_file is not None:
 
         with col2:
             if api_key:
-                if validate_api_key(api_key):
+                if validate_api_key(api_key, provider_for_model(st.secrets["MODEL"]).name):
                     st.markdown("<div style='margin-top: 34px;'></div>", unsafe_allow_html=True)
                     st.write(":material/check_circle: Valid!")
                     st.session_state["api_key"] = api_key
@@ -196,6 +172,36 @@ if uploaded_file is not None:
                         args=(f"type_{i}",),
                         help="Select what type of column this is."
                     )
+
+                    # Checks the values must pass; rows that fail them are escalated in a cascade
+                    constraints = getattr(col, 'constraints', {})
+                    with st.popover("Checks", icon=":material/rule:"):
+                        if field_type == "number":
+                            for constraint, label in (("minimum", "Minimum"), ("maximum", "Maximum")):
+                                st.number_input(
+                                    label,
+                                    value=constraints.get(constraint),
+                                    key=f"{constraint}_{i}",
+                                    on_change=update_constraint,
+                                    args=(f"{constraint}_{i}",)
+                                )
+                        else:
+                            st.text_input(
+                                "Pattern",
+                                value=constraints.get("pattern", ""),
+                                key=f"pattern_{i}",
+                                on_change=update_constraint,
+                                args=(f"pattern_{i}",),
+                                help="Regular expression every value must match in full."
+                            )
+                        st.text_input(
+                            "Allowed values",
+                            value=", ".join(map(str, constraints.get("allowed_values", []))),
+                            key=f"allowed_values_{i}",
+                            on_change=update_constraint,
+                            args=(f"allowed_values_{i}",),
+                            help="Comma-separated list of the only values accepted."
+                        )
                 
                 # Description input
                 with col2:
@@ -231,10 +237,67 @@ if uploaded_file is not None:
         # Apply Transformations button
         st.divider()
 
-        col1, col2, _ = st.columns([1, 1, 1])
+        # Optionally send several rows per request to share the instructions
+        pack_size = None
+        if st.toggle(
+            "Pack several rows per request",
+            help="Sends the instructions once for a group of rows instead of once per row, which saves input tokens. Rows missing from a packed response are reported on the status page."
+        ):
+            pack_size = st.selectbox(
+                "Rows per request",
+                ["auto", 5, 10, 25, 50],
+                help="'auto' picks the largest group that fits the model's token budget."
+            )
+
+        # Reasoning is off unless asked for: it multiplies the output tokens of every row
+        reasoning = st.toggle(
+            "Ask for reasoning",
+            help="Has the model briefly explain how it arrived at the values before giving them. This can help with harder instructions but costs more output tokens. The reasoning isn't included in the results."
+        )
+
+        # Run every row on a cheaper model and only send the rows that fail their checks to the configured one
+        batch_model = st.secrets["MODEL"]
+        cascade = None
+        cheaper = cheaper_models(st.secrets["MODEL"])
+        if cheaper and st.toggle(
+            "Cascade from a cheaper model",
+            help=f"Runs every row on a cheaper model first. Rows whose values don't match their column's type or checks, or that the model isn't confident about, are sent again to {st.secrets['MODEL']} and its results replace theirs."
+        ):
+            cascade_col1, cascade_col2 = st.columns(2)
+            batch_model = cascade_col1.selectbox("Run every row on", cheaper)
+            min_confidence = cascade_col2.slider(
+                "Escalate below confidence", 0.0, 1.0, 0.7, 0.05,
+                help="Rows the cheaper model rates less sure than this are escalated too. 0 escalates only the rows that fail their checks."
+            )
+            cascade = {"model": st.secrets["MODEL"], "min_confidence": min_confidence or None}
+
+        # Rate limits for real-time runs, which call the API directly instead of using a batch
+        with st.expander("Real-time limits", icon=":material/speed:", expanded=False):
+            limit_col1, limit_col2, limit_col3 = st.columns(3)
+            with limit_col1:
+                realtime_rpm = st.number_input("Requests per minute", min_value=1, value=DEFAULT_RPM, step=50)
+            with limit_col2:
+                realtime_tpm = st.number_input("Tokens per minute", min_value=1000, value=DEFAULT_TPM, step=10000)
+            with limit_col3:
+                realtime_concurrency = st.number_input("Concurrent requests", min_value=1, max_value=500, value=DEFAULT_CONCURRENCY)
+
+        # Rows sent by a test run, which projects the full run from their latency and token usage
+        with st.expander("Test run", icon=":material/science:", expanded=False):
+            test_col1, test_col2 = st.columns(2)
+            with test_col1:
+                test_rows = st.number_input("Rows to test", min_value=1, max_value=100, value=DEFAULT_TEST_ROWS)
+            with test_col2:
+                stratify_by = st.selectbox(
+                    "Stratify by",
+                    [None, *df.columns],
+                    format_func=lambda column: "No column" if column is None else column,
+                    help="Samples rows in proportion to the values of this column, with at least one row per value when there are enough rows to test."
+                )
+
+        col1, col2, col3 = st.columns([1, 1, 1])
         with col1:
             # Check if API key is valid
-            api_key_valid = validate_api_key(st.session_state.get('api_key'))
+            api_key_valid = validate_api_key(st.session_state.get('api_key'), provider_for_model(st.secrets["MODEL"]).name)
 
             apply_transformations_button = st.button(
                 "Apply Transformations", 
@@ -249,30 +312,77 @@ if uploaded_file is not None:
 
         with col2:
             test_button = st.button(
-                "Test Single Row",
+                "Test Rows",
                 type="primary",
                 icon=":material/bolt:",
-                help="Test the transformations",
+                help="Transform a few random rows right away, with the settings under Test run, and project the cost and time of the whole dataset from them.",
                 disabled=not st.session_state.new_columns or not all(
                     col.name and col.instructions 
                     for col in st.session_state.new_columns
                 ) or not api_key_valid
             )
 
+        with col3:
+            realtime_button = st.button(
+                "Run in Real Time",
+                icon=":material/speed:",
+                help="Transform every row now with concurrent requests instead of a batch. Best for small and medium datasets.",
+                disabled=not st.session_state.new_columns or not all(
+                    col.name and col.instructions 
+                    for col in st.session_state.new_columns
+                ) or not api_key_valid or provider_for_model(st.secrets["MODEL"]).name != OPENAI
+            )
+
         # Estimate cost (moved outside columns)
         if st.session_state.new_columns:
             field_descriptions = [
                 {
                     "field_name": col.name,
                     "instructions": col.instructions,
-                    "data_type": getattr(col, 'field_type', 'text')
+                    "data_type": getattr(col, 'field_type', 'text'),
+                    **getattr(col, 'constraints', {})
                 }
                 for col in st.session_state.new_columns
             ]
-            cost_estimate = estimate_cost(df, field_descriptions)
+            cost_estimate = estimate_cost(df, field_descriptions, batch_model, reasoning)
             
             # Display cost estimation details
             st.subheader(f"Cost Estimation ${cost_estimate['total_cost']:.2f}")
+            low_cost, high_cost = cost_estimate['cost_bounds']
+            st.caption(
+                f"Likely between \${low_cost:.2f} and \${high_cost:.2f} at batch rates "
+                f"(\${cost_estimate['realtime_cost']:.2f} in real time). "
+                f"~{cost_estimate['input_tokens_per_row']:,.0f} input and ~{cost_estimate['output_tokens_per_row']:,} "
+                f"output tokens per request; "
+                + ("every prompt was tokenized." if cost_estimate['exact'] else
+                   f"input tokens estimated from a sample of {cost_estimate['sampled_prompts']:,} prompts.")
+            )
+            if cost_estimate['cacheable_input_tokens']:
+                st.caption(
+                    f"The {cost_estimate['system_tokens']:,} tokens of instructions are the same in every request, "
+                    f"so the provider can serve up to {cost_estimate['cacheable_input_tokens']:,} input tokens from its prompt cache at a discount."
+                )
+            if not cost_estimate['price_known']:
+                st.caption(f"No price listed for {cost_estimate['model']}; using gpt-4o-mini rates.")
+            if cascade:
+                st.caption(f"The estimate is for running every row on {batch_model}; rows escalated to {cascade['model']} cost extra.")
+            if cost_estimate['dedup_ratio'] > 1:
+                st.caption(
+                    f"{cost_estimate['total_rows']:,} rows need only {cost_estimate['total_requests']:,} requests "
+                    f"({cost_estimate['dedup_ratio']:.1f}× fewer) because rows with identical prompts are sent once."
+                )
+            with st.expander("Input token savings from packing rows", expanded=False):
+                st.dataframe(
+                    pd.DataFrame(cost_estimate['pack_savings']),
+                    column_config={
+                        "pack_size": "Rows per request",
+                        "requests": st.column_config.NumberColumn("Requests", format="%d"),
+                        "input_tokens": st.column_config.NumberColumn("Input tokens", format="%d"),
+                        "input_token_savings": st.column_config.NumberColumn("Savings", format="percent"),
+                    },
+                    hide_index=True
+                )
+                st.caption(f"'auto' packs {cost_estimate['auto_pack_size']} rows per request for this dataset.")
 
         if test_button:
             try:
@@ -281,26 +391,144 @@ if uploaded_file is not None:
                     {
                         "field_name": col.name,
                         "instructions": col.instructions,
-                        "data_type": getattr(col, 'field_type', 'text')
+                        "data_type": getattr(col, 'field_type', 'text'),
+                        **getattr(col, 'constraints', {})
                     }
                     for col in st.session_state.new_columns
                 ]
 
-                # Apply test transformation
-                result, instructions = apply_test_transformation(df, field_descriptions, st.session_state.get('api_key'), st.secrets["MODEL"])
+                # Send the sampled rows concurrently, the same way for every row
+                result, prompt = apply_test_run(
+                    df,
+                    field_descriptions,
+                    st.session_state.get('api_key'),
+                    batch_model,
+                    sample_size=test_rows,
+                    stratify_by=stratify_by,
+                    concurrency=realtime_concurrency,
+                    reasoning=reasoning
+                )
 
-                # Display the result as a table - the result is a row of the dataframe (a pandas row)
-                # Display the instructions
-                if result is not None:
-                    st.markdown("**Instructions**")
-                    st.text(instructions)
-                    st.markdown("**Test Result**")
-                    st.dataframe(result.head(1), height=50)
-                else:
-                    st.error("Error running test transformation")
+                with st.expander("Show the prompt sent for the first row", expanded=False):
+                    st.text(prompt)
+                st.markdown("**Test Results**")
+                errors = [request['error'] for request in result.attrs['requests'] if request['error']]
+                if errors:
+                    st.warning(f"{len(errors)} of {len(result)} test requests failed: {errors[0]}")
+                st.dataframe(
+                    result,
+                    column_config={
+                        "_latency_seconds": st.column_config.NumberColumn("Latency", format="%.2f s"),
+                        "_input_tokens": st.column_config.NumberColumn("Input tokens", format="%d"),
+                        "_cached_tokens": st.column_config.NumberColumn("Cached tokens", format="%d"),
+                        "_output_tokens": st.column_config.NumberColumn("Output tokens", format="%d"),
+                        "_error": "Error",
+                    }
+                )
+                latencies = result['_latency_seconds']
+                metric_col1, metric_col2, metric_col3, metric_col4 = st.columns(4)
+                metric_col1.metric("Median latency", f"{latencies.median():.2f} s")
+                metric_col2.metric("95th percentile latency", f"{latencies.quantile(0.95):.2f} s")
+                metric_col3.metric("Input tokens / row", f"{result['_input_tokens'].mean():,.0f}")
+                metric_col4.metric("Output tokens / row", f"{result['_output_tokens'].mean():,.0f}")
+                st.caption(
+                    f"{len(result):,} rows in {result.attrs['wall_seconds']:.1f} s with up to {realtime_concurrency} requests at a time on {batch_model}."
+                )
+
+                # Scale the measured requests up to the whole dataset
+                projection = pd.DataFrame(project_test_run(
+                    result.attrs['requests'],
+                    cost_estimate['total_requests'],
+                    batch_model,
+                    max_tokens=result.attrs['max_tokens'],
+                    batch_seconds=JobRegistry().batch_durations(provider_for_model(batch_model).name),
+                    rpm=realtime_rpm,
+                    tpm=realtime_tpm,
+                    concurrency=realtime_concurrency
+                ))
+                projection['wall_time'] = [str(datetime.timedelta(seconds=round(seconds))) for seconds in projection['wall_seconds']]
+                st.markdown(f"**Projected for all {cost_estimate['total_requests']:,} requests**")
+                st.dataframe(
+                    projection[["mode", "cost", "cost_low", "cost_high", "wall_time", "limited_by"]],
+                    column_config={
+                        "mode": "Mode",
+                        "cost": st.column_config.NumberColumn("Cost", format="$%.4f"),
+                        "cost_low": st.column_config.NumberColumn("Low", format="$%.4f"),
+                        "cost_high": st.column_config.NumberColumn("High", format="$%.4f"),
+                        "wall_time": "Wall-clock time",
+                        "limited_by": "Time set by",
+                    },
+                    hide_index=True
+                )
+                if pack_size:
+                    st.caption("Projected for one row per request; packing rows lowers the input tokens.")
+                if cascade:
+                    st.caption(f"Rows escalated to {cascade['model']} cost extra.")
             except Exception as e:
                 st.error(f"Error running test transformation: {str(e)}")
 
+        if realtime_button:
+            try:
+                field_descriptions = [
+                    {
+                        "field_name": col.name,
+                        "instructions": col.instructions,
+                        "data_type": getattr(col, 'field_type', 'text'),
+                        **getattr(col, 'constraints', {})
+                    }
+                    for col in st.session_state.new_columns
+                ]
+
+                progress_bar = st.progress(0.0, text="Starting...")
+                metric_col1, metric_col2, metric_col3 = st.columns(3)
+                rows_metric = metric_col1.empty()
+                throughput_metric = metric_col2.empty()
+                tokens_metric = metric_col3.empty()
+                preview = st.empty()
+                last_update = [0.0]
+
+                def show_progress(progress, results, force=False):
+                    # Redraw at most a few times per second
+                    if not force and progress.elapsed - last_update[0] < 0.5 and progress.done < progress.total:
+                        return
+                    last_update[0] = progress.elapsed
+                    progress_bar.progress(
+                        progress.done / progress.total if progress.total else 1.0,
+                        text=f"{progress.done:,} of {progress.total:,} rows ({progress.failed:,} failed)"
+                    )
+                    rows_metric.metric("Rows done", f"{progress.done:,}")
+                    throughput_metric.metric("Rows / second", f"{progress.rows_per_second:,.1f}")
+                    tokens_metric.metric("Tokens / minute", f"{progress.tokens_per_minute:,.0f}")
+                    preview.dataframe(results.to_dataframe().tail(20), height=200)
+
+                realtime_df = apply_realtime_transformation(
+                    st.session_state.get('api_key'),
+                    df,
+                    field_descriptions,
+                    st.secrets["MODEL"],
+                    rpm=realtime_rpm,
+                    tpm=realtime_tpm,
+                    concurrency=realtime_concurrency,
+                    on_progress=show_progress,
+                    reasoning=reasoning
+                )
+                preview.empty()
+
+                failed_rows = realtime_df.attrs.get('failed_rows', [])
+                if failed_rows:
+                    st.warning(f"{len(failed_rows):,} requests failed after retries and are missing from the results.")
+                st.success(f"Transformed {len(realtime_df):,} rows.")
+                st.dataframe(realtime_df)
+                st.download_button(
+                    "Download Results CSV",
+                    lambda: realtime_df.to_csv(index=False),
+                    "realtime_results.csv",
+                    "text/csv",
+                    key="download-realtime-csv"
+                )
+            except Exception as e:
+                st.error(f"Error running real-time transformation: {str(e)}")
+
         if apply_transformations_button:
             try:
                 # Create prompt list in the new format
@@ -308,19 +536,31 @@ if uploaded_file is not None:
                     {
                         "field_name": col.name,
                         "instructions": col.instructions,
-                        "data_type": getattr(col, 'field_type', 'text')
+                        "data_type": getattr(col, 'field_type', 'text'),
+                        **getattr(col, 'constraints', {})
                     }
                     for col in st.session_state.new_columns
                 ]
 
-                # Apply transformations
-                batch_id = apply_transformation(st.session_state.get('api_key'), df, field_descriptions, st.secrets["MODEL"])
+                # Apply transformations, recording the estimate to compare the job's actual usage with
+                batch_id, stats = apply_transformation(
+                    st.session_state.get('api_key'), df, field_descriptions, batch_model, pack_size=pack_size,
+                    reasoning=reasoning, estimate=job_estimate(cost_estimate, pack_size), cascade=cascade
+                )
+
+                # Check the job in the background and download its results as soon as it finishes
+                get_poller().watch(batch_id, st.session_state.get('api_key'))
 
                 # Display the API key and Batch ID
                 st.info(
-                    "Please save these details to check your transformation status. If lost, you won't be able to check the status and retrieve the transformed data:\n\n"
+                    "The job is checked in the background and its results are stored as soon as it finishes; find it on the Check Status page. "
+                    "Save these details to check it from elsewhere:\n\n"
                     f"**API Key**: {st.session_state.get('api_key')}\n\n"
                     f"**Batch ID**: {batch_id}\n\n"
+                    f"**Requests**: {stats['requests']:,} for {stats['rows']:,} rows ({stats['dedup_ratio']:.1f}× deduplication)\n\n"
+                    + (f"**Packing**: {stats['pack_size']} rows per request\n\n" if stats['pack_size'] > 1 else "")
+                    + (f"**Fields**: {stats['fields_submitted']:,} generated, {stats['fields_reused']:,} unchanged and reused from earlier results\n\n" if stats['fields_reused'] else "")
+                    + f"**Cache**: {stats['cache_hits']:,} prompts served from the local cache ({stats['cache_hit_rate']:.0%} hit rate)\n\n"
                     "**Note**: *Processing can take up to 24 hours.*"
                 )
 
@@ -343,7 +583,8 @@ if uploaded_file is not None:
                     {
                         "name": col.name,
                         "instructions": col.instructions,
-                        "field_type": col.field_type
+                        "field_type": col.field_type,
+                        **getattr(col, 'constraints', {})
                     }
                     for col in st.session_state.new_columns
                 ]
@@ -383,7 +624,8 @@ if uploaded_file is not None:
                             Field(
                                 col["name"],
                                 col["instructions"],
-                                col["field_type"]
+                                col["field_type"],
+                                {key: col[key] for key in CONSTRAINT_KEYS if key in col}
                             )
                             for col in config_data["columns"]
                         ]
@@ -0,0 +1,239 @@
+import hashlib
+import json
+import os
+import sqlite3
+import time
+from contextlib import closing
+
+DEFAULT_CACHE_PATH = os.path.join(os.path.expanduser("~"), ".cache", "tabletalk", "responses.sqlite")
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+
+# Keys looked up per SQLite query (stays below the bound-parameter limit)
+LOOKUP_CHUNK = 500
+
+
+class ResponseCache:
+    """Disk-backed cache of model responses keyed by API key, model, schema and rendered prompt.
+
+    Responses are kept apart per API key (by a hash of it), so one account's
+    responses are never served to another. Entries are evicted
+    least-recently-used first once the stored responses and field results
+    together exceed max_bytes.
+    Until a submitted job's results are stored in the job registry, the
+    cache also remembers which of its rows were served from it, so the
+    status check can merge them back in, and the row maps of jobs whose
+    provider can't store them; discard_job drops them afterwards.
+
+    Finished results are also kept per field, keyed by the dataset, the
+    model and a fingerprint of the field definition and API key, so a
+    re-run only has to regenerate the fields that changed.
+    """
+
+    def __init__(self, path=None, max_bytes=None):
+        self.path = path or os.environ.get("TABLETALK_CACHE_PATH", DEFAULT_CACHE_PATH)
+        if max_bytes is None:
+            max_bytes = int(os.environ.get("TABLETALK_CACHE_MAX_MB", DEFAULT_MAX_BYTES // (1024 * 1024))) * 1024 * 1024
+        self.max_bytes = max_bytes
+
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with closing(self._connect()) as conn, conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, content TEXT NOT NULL, size INTEGER NOT NULL, last_access REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS responses_last_access ON responses (last_access)")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS job_rows ("
+                "job_id TEXT NOT NULL, custom_id TEXT NOT NULL, key TEXT NOT NULL, content TEXT, "
+                "PRIMARY KEY (job_id, custom_id))"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS job_row_maps ("
+                "job_id TEXT NOT NULL, line_number INTEGER NOT NULL, line TEXT NOT NULL, "
+                "PRIMARY KEY (job_id, line_number))"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS field_results ("
+                "dataset TEXT NOT NULL, model TEXT NOT NULL, fingerprint TEXT NOT NULL, custom_ids TEXT NOT NULL, "
+                "field_values TEXT NOT NULL, size INTEGER NOT NULL, last_access REAL NOT NULL, "
+                "PRIMARY KEY (dataset, model, fingerprint))"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS job_fields ("
+                "job_id TEXT NOT NULL, position INTEGER NOT NULL, dataset TEXT NOT NULL, model TEXT NOT NULL, "
+                "fingerprint TEXT NOT NULL, field_name TEXT NOT NULL, submitted INTEGER NOT NULL, "
+                "PRIMARY KEY (job_id, position))"
+            )
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    @staticmethod
+    def namespace(account, model, schema):
+        """Return the part of the key shared by every prompt of a job; account is the hash of its API key"""
+        return hashlib.blake2b(f"{account}\n{model}\n{schema}".encode("utf-8"), digest_size=16).hexdigest()
+
+    @staticmethod
+    def key(namespace, prompt):
+        return hashlib.blake2b(f"{namespace}\n{prompt}".encode("utf-8"), digest_size=16).hexdigest()
+
+    @staticmethod
+    def field_fingerprint(field_description, account):
+        """Fingerprint a field definition by its name, instructions and type, for the API key hashed as account"""
+        definition = json.dumps([
+            account,
+            field_description["field_name"],
+            field_description["instructions"],
+            field_description.get("data_type", "text")
+        ])
+        return hashlib.blake2b(definition.encode("utf-8"), digest_size=16).hexdigest()
+
+    def get_many(self, keys):
+        """Return {key: content} for the keys that are cached, marking them as used"""
+        found = {}
+        now = time.time()
+        with closing(self._connect()) as conn, conn:
+            for start in range(0, len(keys), LOOKUP_CHUNK):
+                chunk = keys[start:start + LOOKUP_CHUNK]
+                placeholders = ",".join("?" * len(chunk))
+                rows = conn.execute(f"SELECT key, content FROM responses WHERE key IN ({placeholders})", chunk)
+                found.update(rows)
+                conn.execute(f"UPDATE responses SET last_access = ? WHERE key IN ({placeholders})", [now, *chunk])
+        return found
+
+    def get(self, key):
+        return self.get_many([key]).get(key)
+
+    def put_many(self, items):
+        """Store (key, content) pairs and evict old entries beyond the size limit"""
+        now = time.time()
+        with closing(self._connect()) as conn, conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO responses (key, content, size, last_access) VALUES (?, ?, ?, ?)",
+                ((key, content, len(content), now) for key, content in items)
+            )
+            self._evict(conn)
+
+    def put(self, key, content):
+        self.put_many([(key, content)])
+
+    def _evict(self, conn):
+        # Responses and stored field results share the size limit
+        total = conn.execute(
+            "SELECT (SELECT COALESCE(SUM(size), 0) FROM responses) + (SELECT COALESCE(SUM(size), 0) FROM field_results)"
+        ).fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        # Drop the least recently used entries until we're back under 90% of the limit
+        excess = total - int(self.max_bytes * 0.9)
+        victims = conn.execute(
+            "SELECT kind, id FROM (SELECT kind, id, size, SUM(size) OVER (ORDER BY last_access, kind, id) AS freed FROM ("
+            "SELECT 'responses' AS kind, rowid AS id, size, last_access FROM responses UNION ALL "
+            "SELECT 'field_results', rowid, size, last_access FROM field_results)) "
+            "WHERE freed - size < ?",
+            (excess,)
+        ).fetchall()
+        for table in ("responses", "field_results"):
+            conn.executemany(f"DELETE FROM {table} WHERE rowid = ?", ((id,) for kind, id in victims if kind == table))
+
+    def add_job_rows(self, job_id, rows):
+        """Record (custom_id, key, content) for rows of a job; content is set for cache hits"""
+        with closing(self._connect()) as conn, conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO job_rows (job_id, custom_id, key, content) VALUES (?, ?, ?, ?)",
+                ((job_id, custom_id, key, content) for custom_id, key, content in rows)
+            )
+
+    def rename_job(self, old_job_id, new_job_id):
+        with closing(self._connect()) as conn, conn:
+            conn.execute("UPDATE job_rows SET job_id = ? WHERE job_id = ?", (new_job_id, old_job_id))
+            conn.execute("UPDATE job_row_maps SET job_id = ? WHERE job_id = ?", (new_job_id, old_job_id))
+            conn.execute("UPDATE job_fields SET job_id = ? WHERE job_id = ?", (new_job_id, old_job_id))
+
+    def discard_job(self, job_id):
+        """Drop the rows, row map and fields recorded for a job"""
+        with closing(self._connect()) as conn, conn:
+            conn.execute("DELETE FROM job_rows WHERE job_id = ?", (job_id,))
+            conn.execute("DELETE FROM job_row_maps WHERE job_id = ?", (job_id,))
+            conn.execute("DELETE FROM job_fields WHERE job_id = ?", (job_id,))
+
+    def add_row_map(self, job_id, lines):
+        """Store the encoded JSONL lines of a job's row map"""
+        with closing(self._connect()) as conn, conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO job_row_maps (job_id, line_number, line) VALUES (?, ?, ?)",
+                ((job_id, i, line.decode("utf-8")) for i, line in enumerate(lines))
+            )
+
+    def row_map_lines(self, job_id):
+        """Return the row map lines stored for a job, in order"""
+        with closing(self._connect()) as conn:
+            return [line for line, in conn.execute(
+                "SELECT line FROM job_row_maps WHERE job_id = ? ORDER BY line_number", (job_id,)
+            )]
+
+    def job_rows(self, job_id):
+        """Return [(custom_id, key, content)] recorded for a job"""
+        with closing(self._connect()) as conn:
+            return conn.execute(
+                "SELECT custom_id, key, content FROM job_rows WHERE job_id = ?", (job_id,)
+            ).fetchall()
+
+    def stored_fields(self, dataset, model, fingerprints):
+        """Return the fingerprints among the given ones that have stored results"""
+        with closing(self._connect()) as conn:
+            return {
+                fingerprint for fingerprint in fingerprints
+                if conn.execute(
+                    "SELECT 1 FROM field_results WHERE dataset = ? AND model = ? AND fingerprint = ?",
+                    (dataset, model, fingerprint)
+                ).fetchone()
+            }
+
+    def put_field_values(self, dataset, model, fingerprint, custom_ids, values):
+        """Store the results of one field, replacing any stored before; the column is kept as two JSON arrays"""
+        custom_ids, values = json.dumps(custom_ids), json.dumps(values)
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO field_results (dataset, model, fingerprint, custom_ids, field_values, size, last_access) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (dataset, model, fingerprint, custom_ids, values, len(custom_ids) + len(values), time.time())
+            )
+            self._evict(conn)
+
+    def field_values(self, dataset, model, fingerprint):
+        """Return {custom_id: value} stored for one field"""
+        with closing(self._connect()) as conn, conn:
+            row = conn.execute(
+                "SELECT custom_ids, field_values FROM field_results WHERE dataset = ? AND model = ? AND fingerprint = ?",
+                (dataset, model, fingerprint)
+            ).fetchone()
+            conn.execute(
+                "UPDATE field_results SET last_access = ? WHERE dataset = ? AND model = ? AND fingerprint = ?",
+                (time.time(), dataset, model, fingerprint)
+            )
+        if row is None:
+            return {}
+        return dict(zip(json.loads(row[0]), json.loads(row[1])))
+
+    def add_job_fields(self, job_id, dataset, model, fields):
+        """Record the (fingerprint, field_name, submitted) fields of a job, in column order"""
+        with closing(self._connect()) as conn, conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO job_fields (job_id, position, dataset, model, fingerprint, field_name, submitted) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                ((job_id, i, dataset, model, fingerprint, field_name, int(submitted))
+                 for i, (fingerprint, field_name, submitted) in enumerate(fields))
+            )
+
+    def job_fields(self, job_id):
+        """Return [(dataset, model, fingerprint, field_name, submitted)] recorded for a job"""
+        with closing(self._connect()) as conn:
+            return [
+                (dataset, model, fingerprint, field_name, bool(submitted))
+                for dataset, model, fingerprint, field_name, submitted in conn.execute(
+                    "SELECT dataset, model, fingerprint, field_name, submitted FROM job_fields "
+                    "WHERE job_id = ? ORDER BY position", (job_id,)
+                )
+            ]
@@ -0,0 +1,112 @@
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import anthropic
+import openai
+from anthropic import Anthropic
+from openai import AsyncOpenAI, OpenAI
+
+# Clients kept alive at once; each holds its own connection pool
+MAX_CLIENTS = 32
+
+# Validation results remembered at once
+MAX_VALIDATIONS = 256
+
+# How long a validation result is trusted before the key is checked again
+VALID_KEY_TTL_SECONDS = 15 * 60
+INVALID_KEY_TTL_SECONDS = 30
+VALIDATION_TIMEOUT_SECONDS = 10
+
+# Set TABLETALK_BACKEND=fake to run against the offline fake in fake_util
+BACKEND_ENV = "TABLETALK_BACKEND"
+
+_clients = OrderedDict()
+_validations = OrderedDict()
+_lock = threading.Lock()
+
+
+def use_fake_backend():
+    return os.environ.get(BACKEND_ENV, "openai").lower() == "fake"
+
+
+def _new_client(api_key, provider):
+    if provider == "anthropic":
+        if use_fake_backend():
+            from src.utils.fake_util import FakeAnthropic
+            return FakeAnthropic(api_key=api_key)
+        return Anthropic(api_key=api_key)
+    if use_fake_backend():
+        from src.utils.fake_util import FakeOpenAI
+        return FakeOpenAI(api_key=api_key)
+    return OpenAI(api_key=api_key)
+
+
+def key_provider(api_key):
+    """Guess the provider of an API key from its prefix"""
+    return "anthropic" if api_key.startswith("sk-ant-") else "openai"
+
+
+def key_hash(api_key):
+    """Return a hash that identifies an API key without storing the key, to keep each key's local data apart"""
+    return hashlib.blake2b(api_key.encode("utf-8"), digest_size=16, person=b"tabletalk-key").hexdigest()
+
+
+def get_async_client(api_key):
+    """Return a new async client for a real-time run; the caller closes it"""
+    if use_fake_backend():
+        from src.utils.fake_util import FakeAsyncOpenAI
+        return FakeAsyncOpenAI(api_key=api_key)
+    return AsyncOpenAI(api_key=api_key, max_retries=0)
+
+
+def get_client(api_key, provider="openai"):
+    """Return the shared client of a provider ("openai" or "anthropic") for an API key, creating it on first use.
+
+    Reusing one client per key keeps its HTTP connections open across
+    Streamlit reruns and sessions. The least recently used client is dropped
+    once more than MAX_CLIENTS keys are in use. It isn't closed, since
+    another session or the poller may still be using it; its connections
+    close when it is garbage collected.
+    """
+    with _lock:
+        client = _clients.get((provider, api_key))
+        if client is not None:
+            _clients.move_to_end((provider, api_key))
+            return client
+        client = _clients[(provider, api_key)] = _new_client(api_key, provider)
+        if len(_clients) > MAX_CLIENTS:
+            _clients.popitem(last=False)
+        return client
+
+
+def validate_api_key(api_key, provider=None):
+    """Validate an OpenAI or Anthropic API key, reusing recent results instead of calling the API on every rerun"""
+    if not api_key:
+        return False
+
+    provider = provider or key_provider(api_key)
+    now = time.monotonic()
+    with _lock:
+        cached = _validations.get((provider, api_key))
+    if cached is not None and cached[1] > now:
+        return cached[0]
+
+    try:
+        get_client(api_key, provider).with_options(timeout=VALIDATION_TIMEOUT_SECONDS, max_retries=0).models.list()
+        valid = True
+    except (openai.AuthenticationError, anthropic.AuthenticationError):
+        valid = False
+    except Exception:
+        # Network trouble says nothing about the key, so don't remember it
+        return cached[0] if cached is not None else False
+
+    ttl = VALID_KEY_TTL_SECONDS if valid else INVALID_KEY_TTL_SECONDS
+    with _lock:
+        _validations[(provider, api_key)] = (valid, now + ttl)
+        _validations.move_to_end((provider, api_key))
+        if len(_validations) > MAX_VALIDATIONS:
+            _validations.popitem(last=False)
+    return valid
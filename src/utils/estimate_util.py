@@ -0,0 +1,388 @@
+import math
+from functools import lru_cache
+
+import numpy as np
+import tiktoken
+
+from src.utils.ingest_util import take_rows
+from src.utils.job_util import RowMap
+from src.utils.provider_util import OPENAI, provider_for_model
+from src.utils.realtime_util import DEFAULT_CONCURRENCY, DEFAULT_RPM, DEFAULT_TPM
+from src.utils.template_util import PackedPromptTemplate, PromptTemplate
+
+# USD per million (input, output) tokens at standard rates; snapshots match by prefix
+MODEL_PRICES = {
+    "gpt-4o-mini": (0.15, 0.60),
+    "gpt-4o": (2.50, 10.00),
+    "gpt-4.1-nano": (0.10, 0.40),
+    "gpt-4.1-mini": (0.40, 1.60),
+    "gpt-4.1": (2.00, 8.00),
+    "o4-mini": (1.10, 4.40),
+    "o3-mini": (1.10, 4.40),
+    "o3": (2.00, 8.00),
+    "gpt-3.5-turbo": (0.50, 1.50),
+    "claude-opus-4": (15.00, 75.00),
+    "claude-opus-4-5": (5.00, 25.00),
+    "claude-sonnet-4": (3.00, 15.00),
+    "claude-3-7-sonnet": (3.00, 15.00),
+    "claude-3-5-sonnet": (3.00, 15.00),
+    "claude-haiku-4-5": (1.00, 5.00),
+    "claude-3-5-haiku": (0.80, 4.00),
+    "claude-3-haiku": (0.25, 1.25),
+}
+DEFAULT_MODEL_PRICE = MODEL_PRICES["gpt-4o-mini"]
+
+# Batch requests are billed at half the standard rate by both providers
+BATCH_DISCOUNT = 0.5
+
+# Both providers finish a batch within a day
+BATCH_WINDOW_SECONDS = 24 * 60 * 60
+
+# Share of the input price paid for prompt tokens read from, and written to, the provider's prompt cache
+CACHED_INPUT_PRICE = {"openai": 0.5, "anthropic": 0.1}
+CACHE_WRITE_PRICE = {"openai": 1.0, "anthropic": 1.25}
+
+# Providers only cache prompt prefixes at least this long
+PROMPT_CACHE_MIN_TOKENS = 1024
+
+# Unique prompts up to this count are all tokenized; above it a stratified sample is
+EXACT_PROMPT_LIMIT = 5000
+SAMPLE_PROMPTS = 2000
+LENGTH_STRATA = 10
+Z_95 = 1.96
+
+# Tokens the chat format adds around each request's system and user messages
+MESSAGE_OVERHEAD_TOKENS = 10
+ROW_TAG_TOKENS = 8
+
+# Output tokens of one field's property and value, and of the optional reasoning: (low, expected, high)
+FIELD_OVERHEAD_TOKENS = 4
+REASONING_TOKENS = (30, 70, 200)
+VALUE_TOKENS = {
+    "number": (1, 3, 6),
+    "text": (3, 15, 60),
+}
+RESPONSE_OVERHEAD_TOKENS = 5
+
+
+@lru_cache(maxsize=None)
+def get_encoding(model):
+    """Return the tokenizer for a model, loaded once per process"""
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        # Newer models aren't always registered with tiktoken yet
+        return tiktoken.get_encoding("o200k_base")
+
+
+def count_tokens(text, model):
+    """Count the number of tokens in a text string"""
+    return len(get_encoding(model).encode(text))
+
+
+def model_price(model):
+    """Return (input, output) USD per million tokens and whether the model is in the table"""
+    for name in sorted(MODEL_PRICES, key=len, reverse=True):
+        if model == name or model.startswith(name + "-"):
+            return MODEL_PRICES[name], True
+    return DEFAULT_MODEL_PRICE, False
+
+
+def cheaper_models(model):
+    """Return the models of the same provider with lower prices than model, cheapest first"""
+    (input_price, output_price), _ = model_price(model)
+    provider = provider_for_model(model).name
+    return sorted(
+        (
+            name for name, (name_input, name_output) in MODEL_PRICES.items()
+            if provider_for_model(name).name == provider and name_input < input_price and name_output <= output_price
+        ),
+        key=lambda name: MODEL_PRICES[name]
+    )
+
+
+def output_tokens_per_request(field_descriptions, reasoning=False):
+    """Return (low, expected, high) output tokens of one response for these fields"""
+    bounds = []
+    for i in range(3):
+        tokens = RESPONSE_OVERHEAD_TOKENS
+        if reasoning:
+            tokens += FIELD_OVERHEAD_TOKENS + REASONING_TOKENS[i]
+        for field in field_descriptions:
+            value_tokens = VALUE_TOKENS.get(field.get("data_type"), VALUE_TOKENS["text"])
+            tokens += FIELD_OVERHEAD_TOKENS + len(field.get("field_name") or "") // 4 + value_tokens[i]
+        bounds.append(tokens)
+    return tuple(bounds)
+
+
+def prompt_cache_report(usage, batch=True):
+    """Return the prompt cache hit rate and the USD it saved, given the summed usage of a job's responses"""
+    model = usage.get("model") or ""
+    (input_price, _), _ = model_price(model)
+    provider = provider_for_model(model).name
+    saved_tokens = (
+        usage["cached_tokens"] * (1 - CACHED_INPUT_PRICE[provider])
+        - usage["cache_write_tokens"] * (CACHE_WRITE_PRICE[provider] - 1)
+    )
+    return {
+        "hit_rate": usage["cached_tokens"] / usage["input_tokens"] if usage["input_tokens"] else 0.0,
+        "savings": saved_tokens * input_price / 1_000_000 * (BATCH_DISCOUNT if batch else 1.0)
+    }
+
+
+def usage_cost(usage, batch=True):
+    """Return the USD a job's summed usage cost, with cache reads and writes at their own rates"""
+    model = usage.get("model") or ""
+    (input_price, output_price), _ = model_price(model)
+    provider = provider_for_model(model).name
+    input_cost = (
+        (usage["input_tokens"] - usage["cached_tokens"] - usage["cache_write_tokens"])
+        + usage["cached_tokens"] * CACHED_INPUT_PRICE[provider]
+        + usage["cache_write_tokens"] * CACHE_WRITE_PRICE[provider]
+    ) * input_price
+    return (input_cost + usage["output_tokens"] * output_price) / 1_000_000 * (BATCH_DISCOUNT if batch else 1.0)
+
+
+def job_estimate(estimate, pack_size=1):
+    """Summarize an estimate_cost result for a job sent with pack_size rows per request.
+
+    The summary is recorded with the job so its actual usage can be compared
+    with it once the results are in.
+    """
+    pack_size = estimate["auto_pack_size"] if pack_size == "auto" else max(pack_size or 1, 1)
+    requests = -(-estimate["total_requests"] // pack_size)
+    if pack_size > 1:
+        input_tokens = requests * estimate["packed_request_tokens"] + estimate["packed_row_tokens"]
+    else:
+        input_tokens = estimate["total_input_tokens"]
+    (input_price, output_price), _ = model_price(estimate["model"])
+    return {
+        "model": estimate["model"],
+        "pack_size": pack_size,
+        "requests": requests,
+        "input_tokens": int(input_tokens),
+        "output_tokens": int(estimate["total_output_tokens"]),
+        "cost": float((input_tokens * input_price + estimate["total_output_tokens"] * output_price) / 1_000_000 * BATCH_DISCOUNT)
+    }
+
+
+def usage_comparison(estimate, usage, batch=True):
+    """Return rows of estimated versus actual requests, tokens and cost of a finished job"""
+    actual = {
+        "requests": usage["requests"],
+        "input_tokens": usage["input_tokens"],
+        "output_tokens": usage["output_tokens"],
+        "cost": usage_cost(usage, batch)
+    }
+    return [
+        {
+            "measure": measure,
+            "estimated": estimate[measure],
+            "actual": actual[measure],
+            # Positive when the job used more than estimated
+            "difference": (actual[measure] - estimate[measure]) / estimate[measure] if estimate[measure] else None
+        }
+        for measure in ("requests", "input_tokens", "output_tokens", "cost")
+    ]
+
+
+def project_test_run(requests, total_requests, model, max_tokens=0, batch_seconds=None,
+                     rpm=DEFAULT_RPM, tpm=DEFAULT_TPM, concurrency=DEFAULT_CONCURRENCY):
+    """Project the cost and wall-clock time of the full dataset from a test run's requests.
+
+    requests are the measured requests of llm_util.apply_test_run. Each mode
+    costs the mean cost of a request times total_requests, with a 95%
+    interval from the spread between requests. Real time runs at the lowest
+    of concurrency over the mean latency and the requests- and tokens-per-
+    minute limits, each request reserving its input plus max_tokens tokens as
+    the rate limiter does. Batches take the median of batch_seconds, the
+    durations of earlier batches, or their 24-hour window without any.
+    Real time is left out for models that can't run in real time.
+    """
+    measured = [request for request in requests if request["usage"]]
+    if not measured:
+        raise ValueError("None of the test requests returned their token usage")
+    usages = [dict(request["usage"], model=request["usage"].get("model") or model) for request in measured]
+    latencies = np.array([request["latency_seconds"] for request in measured])
+    reserved_tokens = np.mean([usage["input_tokens"] + max(max_tokens, usage["output_tokens"]) for usage in usages])
+
+    projections = []
+    for mode, batch in (("batch", True), ("real time", False)):
+        if not batch and provider_for_model(model).name != OPENAI:
+            continue
+        costs = np.array([usage_cost(usage, batch) for usage in usages])
+        margin = Z_95 * costs.std(ddof=1) / math.sqrt(len(costs)) if len(costs) > 1 else 0.0
+        if batch:
+            seconds = float(np.median(batch_seconds)) if batch_seconds else BATCH_WINDOW_SECONDS
+            basis = f"median of {len(batch_seconds)} earlier batches" if batch_seconds else "the 24-hour batch window"
+        else:
+            rates = {
+                "concurrency": concurrency / max(latencies.mean(), 1e-3),
+                "requests per minute": rpm / 60,
+                "tokens per minute": tpm / 60 / max(reserved_tokens, 1)
+            }
+            basis = min(rates, key=rates.get)
+            seconds = total_requests / rates[basis]
+        projections.append({
+            "mode": mode,
+            "requests": total_requests,
+            "cost": float(costs.mean() * total_requests),
+            "cost_low": float(max(costs.mean() - margin, 0) * total_requests),
+            "cost_high": float((costs.mean() + margin) * total_requests),
+            "wall_seconds": float(seconds),
+            "limited_by": basis
+        })
+    return projections
+
+
+def _unique_prompt_rows(template, df):
+    """Return (positions, lengths) of the first row of every distinct prompt.
+
+    Prompts are told apart by the RowMap submit uses, so the estimate counts
+    the same requests that are sent.
+    """
+    row_map = RowMap()
+    positions = []
+    lengths = []
+    for _, prompts in template.iter_render(df):
+        for prompt in prompts:
+            position = row_map.rows
+            if row_map.add(position, prompt):
+                positions.append(position)
+                lengths.append(len(prompt))
+    return np.array(positions, dtype=np.int64), np.array(lengths, dtype=np.int64)
+
+
+def count_requests(df, field_descriptions, reasoning=False):
+    """Return the number of requests the dataset takes one row per request, without tokenizing anything"""
+    positions, _ = _unique_prompt_rows(PromptTemplate(field_descriptions, df.columns, reasoning=reasoning), df)
+    return len(positions)
+
+
+def _encode_lengths(template, df, positions, model):
+    prompts = template.render(take_rows(df, positions))
+    encoded = get_encoding(model).encode_batch(prompts, disallowed_special=())
+    return np.array([len(tokens) for tokens in encoded], dtype=np.float64)
+
+
+def _stratified_token_total(template, df, positions, lengths, model, sample_size, seed):
+    """Estimate total prompt tokens from a sample stratified by prompt length.
+
+    Within each length stratum tokens are estimated as chars × the sampled
+    tokens-per-char ratio. Returns (total, standard_error).
+    """
+    rng = np.random.default_rng(seed)
+    edges = np.unique(np.quantile(lengths, np.linspace(0, 1, LENGTH_STRATA + 1)))
+    strata = np.clip(np.searchsorted(edges, lengths, side="right") - 1, 0, max(len(edges) - 2, 0))
+
+    sampled = []
+    for stratum in np.unique(strata):
+        members = np.flatnonzero(strata == stratum)
+        # Allocate proportionally, with at least two per stratum so its variance is defined
+        take = min(len(members), max(2, round(sample_size * len(members) / len(lengths))))
+        sampled.append((members, rng.choice(members, size=take, replace=False)))
+
+    sample_tokens = _encode_lengths(
+        template, df, positions[np.concatenate([chosen for _, chosen in sampled])], model
+    )
+
+    total = variance = 0.0
+    start = 0
+    for members, chosen in sampled:
+        tokens = sample_tokens[start:start + len(chosen)]
+        start += len(chosen)
+        chars = lengths[chosen].astype(np.float64)
+        ratio = tokens.sum() / chars.sum()
+        total += ratio * lengths[members].sum()
+        n, size = len(chosen), len(members)
+        if n > 1 and n < size:
+            residuals = tokens - ratio * chars
+            variance += size ** 2 * (1 - n / size) * residuals.var(ddof=1) / n
+    return float(total), math.sqrt(variance)
+
+
+def estimate_cost(df, field_descriptions, model, exact_limit=EXACT_PROMPT_LIMIT, sample_size=SAMPLE_PROMPTS, seed=0, reasoning=False):
+    """Estimate tokens and cost of transforming the dataset from its rendered prompts.
+
+    Every request carries the same system prompt plus one row's data block.
+    Every distinct data block is tokenized when there are at most exact_limit
+    of them; otherwise a length-stratified sample is, and the input total
+    comes with a 95% confidence interval. Output tokens are derived from the
+    number and types of the fields, and whether reasoning is asked for.
+    """
+    template = PromptTemplate(field_descriptions, df.columns, reasoning=reasoning)
+    positions, lengths = _unique_prompt_rows(template, df)
+    total_rows = len(df)
+    total_requests = len(positions)
+    dedup_ratio = total_rows / total_requests if total_requests else 1.0
+
+    if total_requests == 0:
+        prompt_tokens, prompt_error, sampled_prompts = 0.0, 0.0, 0
+    elif total_requests <= exact_limit:
+        prompt_tokens, prompt_error = _encode_lengths(template, df, positions, model).sum(), 0.0
+        sampled_prompts = total_requests
+    else:
+        prompt_tokens, prompt_error = _stratified_token_total(
+            template, df, positions, lengths, model, sample_size, seed
+        )
+        sampled_prompts = min(total_requests, sample_size)
+
+    system_tokens = count_tokens(template.system, model)
+    overhead = (system_tokens + MESSAGE_OVERHEAD_TOKENS) * total_requests
+    total_input_tokens = prompt_tokens + overhead
+    input_low = max(prompt_tokens - Z_95 * prompt_error, 0) + overhead
+    input_high = prompt_tokens + Z_95 * prompt_error + overhead
+
+    output_low, output_per_request, output_high = output_tokens_per_request(field_descriptions, reasoning)
+    total_output_tokens = output_per_request * total_requests
+
+    (input_price, output_price), price_known = model_price(model)
+
+    def cost(input_tokens, output_tokens, discount=BATCH_DISCOUNT):
+        return float((input_tokens * input_price + output_tokens * output_price) / 1_000_000 * discount)
+
+    # Input tokens when several rows share the system prompt
+    packed_template = PackedPromptTemplate(field_descriptions, df.columns, reasoning=reasoning)
+    packed_system_tokens = count_tokens(packed_template.system, model) + MESSAGE_OVERHEAD_TOKENS
+    row_tokens = prompt_tokens + ROW_TAG_TOKENS * total_requests
+    auto_pack_size = packed_template.choose_pack_size(df)
+    pack_savings = []
+    for pack_size in sorted({1, 5, 10, 25, auto_pack_size}):
+        pack_requests = -(-total_requests // pack_size)
+        pack_input_tokens = pack_requests * packed_system_tokens + row_tokens if pack_size > 1 else total_input_tokens
+        pack_savings.append({
+            'pack_size': pack_size,
+            'requests': pack_requests,
+            'input_tokens': int(pack_input_tokens),
+            'input_token_savings': float(1 - pack_input_tokens / total_input_tokens) if total_input_tokens else 0.0
+        })
+
+    return {
+        'model': model,
+        'price_known': price_known,
+        'input_tokens_per_row': float(total_input_tokens / total_requests) if total_requests else 0.0,
+        'output_tokens_per_row': output_per_request,
+        'total_rows': total_rows,
+        'total_requests': total_requests,
+        'dedup_ratio': dedup_ratio,
+        'sampled_prompts': sampled_prompts,
+        'exact': sampled_prompts == total_requests,
+        'total_input_tokens': int(round(total_input_tokens)),
+        'total_output_tokens': total_output_tokens,
+        'input_tokens_bounds': (int(input_low), int(math.ceil(input_high))),
+        'output_tokens_bounds': (output_low * total_requests, output_high * total_requests),
+        'total_cost': cost(total_input_tokens, total_output_tokens),
+        'cost_bounds': (
+            cost(input_low, output_low * total_requests),
+            cost(input_high, output_high * total_requests)
+        ),
+        'realtime_cost': cost(total_input_tokens, total_output_tokens, discount=1.0),
+        'system_tokens': system_tokens,
+        # Every request after the first can read the system prompt from the provider's cache
+        'cacheable_input_tokens': system_tokens * max(total_requests - 1, 0) if system_tokens >= PROMPT_CACHE_MIN_TOKENS else 0,
+        'auto_pack_size': auto_pack_size,
+        'pack_savings': pack_savings,
+        # Packed input tokens are packed_request_tokens per request plus packed_row_tokens in all
+        'packed_request_tokens': packed_system_tokens,
+        'packed_row_tokens': int(row_tokens)
+    }
@@ -0,0 +1,613 @@
+import asyncio
+import hashlib
+import json
+import os
+import random
+import re
+import threading
+import time
+import uuid
+from types import SimpleNamespace
+
+import openai
+from anthropic.types import Message
+from anthropic.types.messages import MessageBatch, MessageBatchIndividualResponse
+from openai.types import Batch, FileObject
+
+DEFAULT_FAKE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "tabletalk", "fake")
+
+# Defaults, each overridable with an environment variable
+DEFAULT_LATENCY_SECONDS = 0.05      # TABLETALK_FAKE_LATENCY, per chat completion
+DEFAULT_FAILURE_RATE = 0.0          # TABLETALK_FAKE_FAILURE_RATE, per request
+DEFAULT_BATCH_SECONDS = 10.0        # TABLETALK_FAKE_BATCH_SECONDS, until a batch completes
+
+_ROW_TAG = re.compile(r'<row id=("(?:[^"\\]|\\.)*")>\s*')
+
+# Prompt prefixes are cached from this many tokens on, in steps of PROMPT_CACHE_STEP, as the providers do
+PROMPT_CACHE_MIN_TOKENS = 1024
+PROMPT_CACHE_STEP = 128
+
+
+class FakeConfig:
+    """Behaviour of the fake backend, read from TABLETALK_FAKE_* environment variables"""
+
+    def __init__(self, directory=None, latency=None, failure_rate=None, batch_seconds=None):
+        self.directory = directory or os.environ.get("TABLETALK_FAKE_DIR", DEFAULT_FAKE_DIR)
+        self.latency = latency if latency is not None else float(os.environ.get("TABLETALK_FAKE_LATENCY", DEFAULT_LATENCY_SECONDS))
+        self.failure_rate = failure_rate if failure_rate is not None else float(os.environ.get("TABLETALK_FAKE_FAILURE_RATE", DEFAULT_FAILURE_RATE))
+        self.batch_seconds = batch_seconds if batch_seconds is not None else float(os.environ.get("TABLETALK_FAKE_BATCH_SECONDS", DEFAULT_BATCH_SECONDS))
+
+
+def _request_rng(custom_id, prompt, model=None):
+    """Random source seeded by the request, so the same request always gets the same answer from a model"""
+    text = f"{custom_id}\n{prompt}" if model is None else f"{model}\n{custom_id}\n{prompt}"
+    seed = hashlib.blake2b(text.encode("utf-8"), digest_size=8).digest()
+    return random.Random(int.from_bytes(seed, "big"))
+
+
+def _request_fails(config, batch_id, custom_id):
+    """Whether a batch request fails; drawn per batch, so the same request can succeed when sent again"""
+    seed = hashlib.blake2b(f"{batch_id}\n{custom_id}".encode("utf-8"), digest_size=8).digest()
+    return random.Random(int.from_bytes(seed, "big")).random() < config.failure_rate
+
+
+def _field_list_at(text, position):
+    """Decode the JSON list of field descriptions starting at position, or return None"""
+    try:
+        value, _ = json.JSONDecoder().raw_decode(text, position)
+    except ValueError:
+        return None
+    if isinstance(value, list) and value and all(isinstance(item, dict) and "field_name" in item for item in value):
+        return value
+    return None
+
+
+def prompt_fields(prompt):
+    """Return (fields, rows) described by a prompt.
+
+    fields is the field description list the prompt carries and rows is
+    [(row_id, fields)] for every <row> of a packed prompt.
+    """
+    fields = []
+    for match in re.finditer(r"\[", prompt):
+        found = _field_list_at(prompt, match.start())
+        if found is not None:
+            fields = found
+            break
+    return fields, [(json.loads(match.group(1)), fields) for match in _ROW_TAG.finditer(prompt)]
+
+
+def _request_text(messages, system=None):
+    """Return the system prompt and the text of every message of a request"""
+    if isinstance(system, list):
+        system = "".join(block["text"] for block in system)
+    return "\n".join([system or ""] + [message["content"] for message in messages])
+
+
+def _cached_tokens(messages, system, seen):
+    """Return (read, written) prompt cache tokens of a request whose prefix is the system prompt"""
+    if system is None and messages and messages[0]["role"] == "system":
+        system = messages[0]["content"]
+    if isinstance(system, list):
+        system = "".join(block["text"] for block in system)
+    tokens = len(system or "") // 4
+    if tokens < PROMPT_CACHE_MIN_TOKENS:
+        return 0, 0
+    if system in seen:
+        return tokens // PROMPT_CACHE_STEP * PROMPT_CACHE_STEP, 0
+    seen.add(system)
+    return 0, tokens
+
+
+def _schema_type(schema, field):
+    types = schema.get("type", "string")
+    if not isinstance(types, list):
+        return types
+    if field is not None and field.get("data_type") == "number" and "number" in types:
+        return "number"
+    return next((t for t in types if t != "null"), "null")
+
+
+def _resolve(schema, root):
+    """Follow a local $ref such as #/$defs/Response"""
+    while "$ref" in schema:
+        node = root
+        for part in schema["$ref"].lstrip("#/").split("/"):
+            node = node[part]
+        schema = node
+    return schema
+
+
+def fake_value(schema, rng, fields, rows, field=None, row_id=None, name=None, root=None):
+    """Generate a value that satisfies a JSON schema, filling fields and rows from the prompt"""
+    root = root if root is not None else schema
+    schema = _resolve(schema, root)
+    if "anyOf" in schema:
+        options = [_resolve(option, root) for option in schema["anyOf"]]
+        wanted = "number" if field is not None and field.get("data_type") == "number" else "string"
+        schema = next(
+            (option for option in options if option.get("type") == wanted),
+            next((option for option in options if option.get("type") != "null"), options[0])
+        )
+    if "enum" in schema:
+        return rng.choice(schema["enum"])
+
+    kind = _schema_type(schema, field)
+    if kind == "object":
+        properties = schema.get("properties", {})
+        # A property named after a field, or described by its name, holds that field's value
+        by_name = {f["field_name"]: f for f in fields}
+        return {
+            key: fake_value(sub, rng, fields, rows, by_name.get(sub.get("description"), by_name.get(key, field)), row_id, key, root)
+            for key, sub in properties.items()
+        }
+    if kind == "array":
+        items = _resolve(schema.get("items", {}), root)
+        properties = items.get("properties", {})
+        if "row_id" in properties:
+            return [fake_value(items, rng, row_fields, rows, None, rid, root=root) for rid, row_fields in rows]
+        if "field_name" in properties:
+            return [fake_value(items, rng, fields, rows, f, row_id, root=root) for f in fields]
+        return [fake_value(items, rng, fields, rows, field, row_id, root=root)]
+    if kind in ("number", "integer"):
+        if "maximum" in schema:
+            return round(rng.uniform(schema.get("minimum", 0), schema["maximum"]), 2)
+        return rng.randint(0, 100)
+    if kind == "boolean":
+        return rng.random() < 0.5
+    if kind == "null":
+        return None
+    if name == "field_name" and field is not None:
+        return field["field_name"]
+    if name == "row_id" and row_id is not None:
+        return row_id
+    if name == "reasoning":
+        return "Generated by the offline fake backend."
+    label = field["field_name"] if field is not None else "value"
+    return f"{label} {rng.getrandbits(32):08x}"
+
+
+def fake_content(custom_id, prompt, schema, model=None):
+    """Return the JSON message content a model would send back for a prompt"""
+    fields, rows = prompt_fields(prompt)
+    return json.dumps(fake_value(schema, _request_rng(custom_id, prompt, model), fields, rows))
+
+
+def _usage(prompt, content, cached_tokens=0):
+    prompt_tokens = len(prompt) // 4
+    completion_tokens = len(content) // 4
+    return {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": prompt_tokens + completion_tokens,
+        "prompt_tokens_details": {"cached_tokens": min(cached_tokens, prompt_tokens)}
+    }
+
+
+def _rate_limit_error():
+    # Only the parts of an HTTP response the error and the retry logic read
+    response = SimpleNamespace(request=None, status_code=429, headers={"retry-after-ms": "100", "x-request-id": None})
+    return openai.RateLimitError("Rate limit reached (fake backend)", response=response, body=None)
+
+
+class FakeContent:
+    """File content in the shape of both files.content() and its streaming variant"""
+
+    def __init__(self, data):
+        self.content = data
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    @property
+    def text(self):
+        return self.content.decode("utf-8")
+
+    def read(self):
+        return self.content
+
+    def iter_bytes(self, chunk_size=None):
+        yield self.content
+
+    def iter_lines(self):
+        for line in self.content.split(b"\n"):
+            yield line.decode("utf-8")
+
+    def write_to_file(self, path):
+        with open(path, "wb") as f:
+            f.write(self.content)
+
+
+class FakeStore:
+    """Files and batches kept on disk, so separate processes and sessions see the same jobs"""
+
+    def __init__(self, config):
+        self.config = config
+        self.lock = threading.Lock()
+        os.makedirs(os.path.join(config.directory, "files"), exist_ok=True)
+        os.makedirs(os.path.join(config.directory, "batches"), exist_ok=True)
+
+    def _file_path(self, file_id):
+        return os.path.join(self.config.directory, "files", file_id)
+
+    def _batch_path(self, batch_id):
+        return os.path.join(self.config.directory, "batches", f"{batch_id}.json")
+
+    def write_file(self, data, filename, purpose):
+        file_id = f"file-fake{uuid.uuid4().hex}"
+        with open(self._file_path(file_id), "wb") as f:
+            f.write(data)
+        return FileObject(
+            id=file_id, bytes=len(data), created_at=int(time.time()), filename=filename,
+            object="file", purpose=purpose, status="processed"
+        )
+
+    def read_file(self, file_id):
+        try:
+            with open(self._file_path(file_id), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            raise openai.NotFoundError(
+                f"No such file: {file_id}",
+                response=SimpleNamespace(request=None, status_code=404, headers={}),
+                body=None
+            )
+
+    def save_batch(self, record):
+        with open(self._batch_path(record["id"]), "w") as f:
+            json.dump(record, f)
+
+    def load_batch(self, batch_id):
+        try:
+            with open(self._batch_path(batch_id)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            raise openai.NotFoundError(
+                f"No such batch: {batch_id}",
+                response=SimpleNamespace(request=None, status_code=404, headers={}),
+                body=None
+            )
+
+    def _finish(self, record):
+        """Answer every request of a batch and write its output and error files"""
+        outputs = []
+        errors = []
+        seen_prefixes = set()
+        for i, line in enumerate(self.read_file(record["input_file_id"]).split(b"\n")):
+            if not line.strip():
+                continue
+            request = json.loads(line)
+            custom_id = request["custom_id"]
+            body = request["body"]
+            prompt = _request_text(body["messages"])
+            if _request_fails(self.config, record["id"], custom_id):
+                errors.append(json.dumps({
+                    "id": f"batch_req_{i}",
+                    "custom_id": custom_id,
+                    "response": {"status_code": 500, "request_id": f"req_{i}", "body": {
+                        "error": {"message": "The server had an error (fake backend)", "type": "server_error"}
+                    }},
+                    "error": None
+                }))
+                continue
+            schema = body.get("response_format", {}).get("json_schema", {}).get("schema", {})
+            content = fake_content(custom_id, prompt, schema, body.get("model"))
+            outputs.append(json.dumps({
+                "id": f"batch_req_{i}",
+                "custom_id": custom_id,
+                "response": {"status_code": 200, "request_id": f"req_{i}", "body": {
+                    "id": f"chatcmpl-fake{i}",
+                    "object": "chat.completion",
+                    "model": body.get("model"),
+                    "choices": [{
+                        "index": 0,
+                        "message": {"role": "assistant", "content": content, "refusal": None},
+                        "finish_reason": "stop"
+                    }],
+                    "usage": _usage(prompt, content, _cached_tokens(body["messages"], None, seen_prefixes)[0])
+                }},
+                "error": None
+            }))
+
+        record["output_file_id"] = self.write_file("\n".join(outputs).encode("utf-8"), "output.jsonl", "batch_output").id
+        if errors:
+            record["error_file_id"] = self.write_file("\n".join(errors).encode("utf-8"), "errors.jsonl", "batch_output").id
+        record["request_counts"] = {"completed": len(outputs), "failed": len(errors), "total": len(outputs) + len(errors)}
+        record["status"] = "completed"
+        record["completed_at"] = int(time.time())
+
+    def batch(self, batch_id):
+        """Return a batch with its status advanced to where the configured timeline puts it"""
+        with self.lock:
+            record = self.load_batch(batch_id)
+            if record["status"] in ("validating", "in_progress", "finalizing"):
+                progress = (time.time() - record["created_at"]) / max(self.config.batch_seconds, 1e-9)
+                total = record["request_counts"]["total"]
+                if progress >= 1:
+                    self._finish(record)
+                elif progress >= 0.9:
+                    record["status"] = "finalizing"
+                    record["request_counts"]["completed"] = total
+                elif progress >= 0.1:
+                    record["status"] = "in_progress"
+                    record["request_counts"]["completed"] = int(total * (progress - 0.1) / 0.8)
+                self.save_batch(record)
+        return Batch.model_validate(record)
+
+    def _finish_message_batch(self, record):
+        """Answer every request of an Anthropic message batch and write its results file"""
+        results = []
+        counts = {"processing": 0, "succeeded": 0, "errored": 0, "canceled": 0, "expired": 0}
+        seen_prefixes = set()
+        for line in self.read_file(record["input_file_id"]).split(b"\n"):
+            if not line.strip():
+                continue
+            request = json.loads(line)
+            custom_id = request["custom_id"]
+            params = request["params"]
+            prompt = _request_text(params["messages"], params.get("system"))
+            if _request_fails(self.config, record["id"], custom_id):
+                counts["errored"] += 1
+                results.append(json.dumps({"custom_id": custom_id, "result": {"type": "errored", "error": {
+                    "type": "error", "error": {"type": "api_error", "message": "Internal server error (fake backend)"}
+                }}}))
+                continue
+            counts["succeeded"] += 1
+            message = _tool_message(custom_id, prompt, params, seen_prefixes)
+            results.append(json.dumps({"custom_id": custom_id, "result": {"type": "succeeded", "message": message}}))
+
+        record["results_file_id"] = self.write_file("\n".join(results).encode("utf-8"), "results.jsonl", "batch_output").id
+        record["request_counts"] = counts
+        record["processing_status"] = "ended"
+        record["ended_at"] = int(time.time())
+
+    def message_batch(self, batch_id):
+        """Return an Anthropic message batch, ended once the configured time has passed"""
+        with self.lock:
+            record = self.load_batch(batch_id)
+            if record["processing_status"] == "in_progress" and time.time() - record["created_at"] >= self.config.batch_seconds:
+                self._finish_message_batch(record)
+                self.save_batch(record)
+        return MessageBatch.model_validate(record)
+
+
+def _tool_message(custom_id, prompt, params, seen_prefixes):
+    """Return an Anthropic message that answers a prompt by calling the forced tool"""
+    tool = next(tool for tool in params["tools"] if tool["name"] == params["tool_choice"]["name"])
+    fields, rows = prompt_fields(prompt)
+    tool_input = fake_value(tool["input_schema"], _request_rng(custom_id, prompt, params["model"]), fields, rows)
+    usage = _usage(prompt, json.dumps(tool_input))
+    # Only system prompts marked as a cache breakpoint are cached
+    system = params.get("system")
+    cached, written = _cached_tokens(params["messages"], system, seen_prefixes) if system else (0, 0)
+    return {
+        "id": f"msg_fake{uuid.uuid4().hex}",
+        "type": "message",
+        "role": "assistant",
+        "model": params["model"],
+        "content": [{"type": "tool_use", "id": f"toolu_fake{uuid.uuid4().hex}", "name": tool["name"], "input": tool_input}],
+        "stop_reason": "tool_use",
+        "stop_sequence": None,
+        "usage": {
+            "input_tokens": max(usage["prompt_tokens"] - cached - written, 0),
+            "cache_read_input_tokens": cached,
+            "cache_creation_input_tokens": written,
+            "output_tokens": usage["completion_tokens"]
+        }
+    }
+
+
+class _FakeFiles:
+    def __init__(self, store):
+        self.store = store
+        self.with_streaming_response = self
+
+    def create(self, file, purpose):
+        filename, fileobj = file if isinstance(file, tuple) else (getattr(file, "name", "upload.jsonl"), file)
+        data = fileobj if isinstance(fileobj, bytes) else fileobj.read()
+        return self.store.write_file(data, str(filename), purpose)
+
+    def content(self, file_id):
+        return FakeContent(self.store.read_file(file_id))
+
+
+class _FakeBatches:
+    def __init__(self, store):
+        self.store = store
+
+    def create(self, input_file_id, endpoint, completion_window, metadata=None):
+        data = self.store.read_file(input_file_id)
+        total = sum(1 for line in data.split(b"\n") if line.strip())
+        record = {
+            "id": f"batch_fake{uuid.uuid4().hex}",
+            "object": "batch",
+            "endpoint": endpoint,
+            "completion_window": completion_window,
+            "input_file_id": input_file_id,
+            "created_at": int(time.time()),
+            "status": "validating",
+            "metadata": metadata,
+            "request_counts": {"completed": 0, "failed": 0, "total": total}
+        }
+        self.store.save_batch(record)
+        return Batch.model_validate(record)
+
+    def retrieve(self, batch_id):
+        return self.store.batch(batch_id)
+
+    def cancel(self, batch_id):
+        with self.store.lock:
+            record = self.store.load_batch(batch_id)
+            record["status"] = "cancelled"
+            record["cancelled_at"] = int(time.time())
+            self.store.save_batch(record)
+        return Batch.model_validate(record)
+
+
+def _completion(messages, response_format, config, seen_prefixes):
+    """Build the parsed completion for a chat request, or raise a rate limit error"""
+    prompt = _request_text(messages)
+    rng = _request_rng("chat", prompt)
+    # Failures are drawn per call so that retries can succeed
+    if random.random() < config.failure_rate:
+        raise _rate_limit_error()
+    if isinstance(response_format, dict):
+        # A json_schema response format is passed through, so nothing is parsed
+        content = fake_content("chat", prompt, response_format["json_schema"]["schema"])
+        parsed = None
+    else:
+        content = fake_content("chat", prompt, response_format.model_json_schema())
+        parsed = response_format.model_validate_json(content)
+    message = SimpleNamespace(role="assistant", content=content, refusal=None, parsed=parsed)
+    usage = _usage(prompt, content, _cached_tokens(messages, None, seen_prefixes)[0])
+    return SimpleNamespace(
+        id=f"chatcmpl-fake{rng.getrandbits(32):08x}",
+        choices=[SimpleNamespace(index=0, message=message, finish_reason="stop")],
+        usage=SimpleNamespace(
+            prompt_tokens=usage["prompt_tokens"],
+            completion_tokens=usage["completion_tokens"],
+            total_tokens=usage["total_tokens"],
+            prompt_tokens_details=SimpleNamespace(cached_tokens=usage["prompt_tokens_details"]["cached_tokens"])
+        )
+    )
+
+
+class _FakeCompletions:
+    def __init__(self, config):
+        self.config = config
+        self.seen_prefixes = set()
+
+    def parse(self, model, messages, response_format, **kwargs):
+        time.sleep(self.config.latency)
+        return _completion(messages, response_format, self.config, self.seen_prefixes)
+
+
+class _FakeAsyncCompletions:
+    def __init__(self, config):
+        self.config = config
+        self.seen_prefixes = set()
+
+    async def parse(self, model, messages, response_format, **kwargs):
+        await asyncio.sleep(self.config.latency)
+        return _completion(messages, response_format, self.config, self.seen_prefixes)
+
+
+class _FakeModels:
+    def list(self):
+        return SimpleNamespace(data=[SimpleNamespace(id="fake-model")])
+
+
+class _FakeMessageBatches:
+    def __init__(self, store):
+        self.store = store
+
+    def create(self, requests):
+        requests = list(requests)
+        input_file = self.store.write_file("\n".join(json.dumps(r) for r in requests).encode("utf-8"), "requests.jsonl", "batch")
+        now = int(time.time())
+        record = {
+            "id": f"msgbatch_fake{uuid.uuid4().hex}",
+            "type": "message_batch",
+            "created_at": now,
+            "expires_at": now + 24 * 60 * 60,
+            "processing_status": "in_progress",
+            "request_counts": {"processing": len(requests), "succeeded": 0, "errored": 0, "canceled": 0, "expired": 0},
+            "input_file_id": input_file.id
+        }
+        self.store.save_batch(record)
+        return MessageBatch.model_validate(record)
+
+    def retrieve(self, message_batch_id):
+        return self.store.message_batch(message_batch_id)
+
+    def results(self, message_batch_id):
+        record = self.store.load_batch(message_batch_id)
+        for line in self.store.read_file(record["results_file_id"]).split(b"\n"):
+            if line.strip():
+                yield MessageBatchIndividualResponse.model_validate_json(line)
+
+    def cancel(self, message_batch_id):
+        with self.store.lock:
+            record = self.store.load_batch(message_batch_id)
+            if record["processing_status"] == "in_progress":
+                counts = record["request_counts"]
+                counts["canceled"], counts["processing"] = counts["processing"], 0
+                record["processing_status"] = "ended"
+                record["cancel_initiated_at"] = record["ended_at"] = int(time.time())
+                self.store.save_batch(record)
+        return MessageBatch.model_validate(record)
+
+
+class _FakeMessages:
+    def __init__(self, store, config):
+        self.config = config
+        self.batches = _FakeMessageBatches(store)
+        self.seen_prefixes = set()
+
+    def create(self, model, max_tokens, messages, tools, tool_choice, system=None, **kwargs):
+        time.sleep(self.config.latency)
+        prompt = _request_text(messages, system)
+        params = {"model": model, "tools": tools, "tool_choice": tool_choice, "messages": messages, "system": system}
+        return Message.model_validate(_tool_message("message", prompt, params, self.seen_prefixes))
+
+
+class FakeOpenAI:
+    """Offline stand-in for the OpenAI client covering the calls TableTalk makes.
+
+    Batches move through validating, in_progress and finalizing over
+    batch_seconds and then complete with deterministic, schema-valid
+    responses; failure_rate of requests fail. Chat completions take latency
+    seconds and fail with a 429 at failure_rate.
+    """
+
+    def __init__(self, api_key=None, config=None, **kwargs):
+        self.api_key = api_key
+        self.config = config or FakeConfig()
+        store = FakeStore(self.config)
+        self.files = _FakeFiles(store)
+        self.batches = _FakeBatches(store)
+        self.models = _FakeModels()
+        self.chat = SimpleNamespace(completions=_FakeCompletions(self.config))
+        self.beta = SimpleNamespace(chat=self.chat)
+
+    def with_options(self, **kwargs):
+        return self
+
+    def close(self):
+        pass
+
+
+class FakeAsyncOpenAI:
+    """Async counterpart of FakeOpenAI for real-time runs"""
+
+    def __init__(self, api_key=None, config=None, **kwargs):
+        self.api_key = api_key
+        self.config = config or FakeConfig()
+        self.chat = SimpleNamespace(completions=_FakeAsyncCompletions(self.config))
+        self.beta = SimpleNamespace(chat=self.chat)
+
+    async def close(self):
+        pass
+
+
+class FakeAnthropic:
+    """Offline stand-in for the Anthropic client: message batches and tool-use messages.
+
+    Follows the same FakeConfig as FakeOpenAI; batches end after
+    batch_seconds and their requests fail at failure_rate.
+    """
+
+    def __init__(self, api_key=None, config=None, **kwargs):
+        self.api_key = api_key
+        self.config = config or FakeConfig()
+        self.messages = _FakeMessages(FakeStore(self.config), self.config)
+        self.models = _FakeModels()
+
+    def with_options(self, **kwargs):
+        return self
+
+    def close(self):
+        pass
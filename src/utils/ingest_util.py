@@ -0,0 +1,297 @@
+import contextlib
+import hashlib
+import os
+import shutil
+import tempfile
+import weakref
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+import pyarrow.parquet as pq
+
+SUPPORTED_FILE_TYPES = ['csv', 'xlsx', 'parquet']
+
+# Rows read per chunk when streaming a dataset, and rows kept for the preview
+CHUNK_ROWS = 50000
+PREVIEW_ROWS = 5000
+
+# Column types are inferred from the first block of a CSV file
+CSV_BLOCK_BYTES = 16 * 1024 * 1024
+COPY_BUFFER_BYTES = 1024 * 1024
+
+# Strings read as missing values, the same ones pandas.read_csv uses
+NA_VALUES = [
+    '', '#N/A', '#N/A N/A', '#NA', '-1.#IND', '-1.#QNAN', '-NaN', '-nan', '1.#IND', '1.#QNAN',
+    '<NA>', 'N/A', 'NA', 'NULL', 'NaN', 'None', 'n/a', 'nan', 'null'
+]
+
+
+class Dataset:
+    """A dataset stored as a local Parquet file and read in row chunks.
+
+    Behaves enough like a DataFrame (columns, len, head, sample) for the
+    page and the prompt renderers, which stream it with iter_chunks instead
+    of holding every row in memory. Chunks get the dtypes pandas would give
+    the whole file, so prompts render the same as with a single read.
+    """
+
+    def __init__(self, path, fingerprint, directory=None):
+        self.path = path
+        self.fingerprint = fingerprint
+        self._file = pq.ParquetFile(path)
+        metadata = self._file.metadata
+        self.columns = pd.Index(self._file.schema_arrow.names)
+        self._row_group_starts = np.cumsum(
+            [0] + [metadata.row_group(i).num_rows for i in range(metadata.num_row_groups)]
+        )
+        self._dtypes = self._consistent_dtypes()
+        self.preview = next(self.iter_chunks(PREVIEW_ROWS), None)
+        if self.preview is None:
+            self.preview = self._file.schema_arrow.empty_table().to_pandas()
+        if directory is not None:
+            # Remove the file once the dataset is no longer used
+            weakref.finalize(self, shutil.rmtree, directory, True)
+
+    def __len__(self):
+        return self._file.metadata.num_rows
+
+    def _consistent_dtypes(self):
+        """Return the dtype overrides that make every chunk match a whole-file read.
+
+        Integer and boolean columns only become float64 and object in chunks
+        that contain missing values, so columns with any missing value are
+        converted in every chunk.
+        """
+        schema = self._file.schema_arrow
+        pandas_types = {
+            column.get('name'): column.get('numpy_type')
+            for column in (schema.pandas_metadata or {}).get('columns', [])
+        }
+        dtypes = {}
+        for i, field in enumerate(schema):
+            if pa.types.is_integer(field.type):
+                dtype = 'float64'
+            elif pa.types.is_boolean(field.type):
+                dtype = object
+            else:
+                continue
+            numpy_type = pandas_types.get(field.name)
+            if numpy_type and isinstance(pd.api.types.pandas_dtype(numpy_type), pd.api.extensions.ExtensionDtype):
+                # Nullable extension dtypes are already the same in every chunk
+                continue
+            if self._null_count(i) > 0:
+                dtypes[field.name] = dtype
+        return dtypes
+
+    def _null_count(self, column_index):
+        metadata = self._file.metadata
+        total = 0
+        for i in range(metadata.num_row_groups):
+            statistics = metadata.row_group(i).column(column_index).statistics
+            if statistics is None or not statistics.has_null_count:
+                # No statistics written; count the column itself
+                return self._file.read(columns=[self._file.schema_arrow.names[column_index]]).column(0).null_count
+            total += statistics.null_count
+        return total
+
+    def _to_pandas(self, table, index):
+        df = table.to_pandas()
+        for column, dtype in self._dtypes.items():
+            series = df[column].astype(dtype)
+            # Missing booleans are NaN rather than None, as with read_csv
+            df[column] = series.where(series.notna(), np.nan) if dtype is object else series
+        df.index = index
+        return df
+
+    def iter_chunks(self, chunk_size=CHUNK_ROWS):
+        """Yield consecutive row chunks as DataFrames indexed by row position"""
+        start = 0
+        for batch in self._file.iter_batches(batch_size=chunk_size):
+            table = pa.Table.from_batches([batch])
+            yield self._to_pandas(table, pd.RangeIndex(start, start + table.num_rows))
+            start += table.num_rows
+
+    def head(self, n=5):
+        if n <= len(self.preview):
+            return self.preview.head(n)
+        return self.take(np.arange(min(n, len(self))))
+
+    def take(self, positions):
+        """Return the rows at the given positions, reading only the row groups that hold them"""
+        positions = np.asarray(positions, dtype=np.int64)
+        groups = np.searchsorted(self._row_group_starts, positions, side='right') - 1
+        tables = []
+        order = []
+        for group in np.unique(groups):
+            selected = np.flatnonzero(groups == group)
+            offsets = positions[selected] - self._row_group_starts[group]
+            tables.append(self._file.read_row_group(int(group)).take(pa.array(offsets)))
+            order.append(selected)
+        if not tables:
+            return self.preview.iloc[:0]
+        table = pa.concat_tables(tables)
+        order = np.concatenate(order)
+        df = self._to_pandas(table, pd.Index(positions[order]))
+        # Restore the order the positions were asked for
+        return df.iloc[np.argsort(order, kind='stable')]
+
+    def sample(self, n=1, random_state=None):
+        rng = np.random.default_rng(random_state)
+        return self.take(rng.choice(len(self), size=min(n, len(self)), replace=False))
+
+    def column(self, name):
+        """Return one column of every row, reading only that column"""
+        series = self._file.read(columns=[name]).column(0).to_pandas()
+        return series.astype(self._dtypes[name]) if name in self._dtypes else series
+
+
+def iter_chunks(data, chunk_size=CHUNK_ROWS):
+    """Yield row chunks of a DataFrame or Dataset"""
+    if isinstance(data, Dataset):
+        yield from data.iter_chunks(chunk_size)
+        return
+    for start in range(0, len(data), chunk_size):
+        yield data.iloc[start:start + chunk_size]
+
+
+def take_rows(data, positions):
+    """Return the rows of a DataFrame or Dataset at the given positions"""
+    if isinstance(data, Dataset):
+        return data.take(positions)
+    return data.iloc[positions]
+
+
+def row_ids(data):
+    """Return the custom_ids of the rows of a DataFrame or Dataset: their index labels as text"""
+    index = pd.RangeIndex(len(data)) if isinstance(data, Dataset) else data.index
+    return [f"{row_index}" for row_index in index]
+
+
+def dataset_fingerprint(data):
+    """Return a hash identifying the content of a DataFrame or Dataset"""
+    if isinstance(data, Dataset):
+        return data.fingerprint
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(repr(list(data.columns)).encode('utf-8'))
+    for chunk in iter_chunks(data):
+        digest.update(pd.util.hash_pandas_object(chunk, index=True).to_numpy().tobytes())
+    return digest.hexdigest()
+
+
+def _fingerprint(file, copy_to=None):
+    """Hash an uploaded file's content, optionally copying it to disk on the way"""
+    digest = hashlib.blake2b(digest_size=16)
+    file.seek(0)
+    with open(copy_to, 'wb') if copy_to else contextlib.nullcontext() as out:
+        while True:
+            block = file.read(COPY_BUFFER_BYTES)
+            if not block:
+                break
+            digest.update(block)
+            if out is not None:
+                out.write(block)
+    file.seek(0)
+    return digest.hexdigest()
+
+
+def _csv_to_parquet(source, path):
+    """Stream a CSV file into Parquet block by block, with column types inferred like pandas"""
+    read_options = pa_csv.ReadOptions(block_size=CSV_BLOCK_BYTES)
+    convert_options = pa_csv.ConvertOptions(null_values=NA_VALUES, strings_can_be_null=True)
+    reader = pa_csv.open_csv(source, read_options=read_options, convert_options=convert_options)
+    schema = reader.schema
+    if len(set(schema.names)) != len(schema.names):
+        raise ValueError("duplicate column names")
+
+    # pandas reads dates as text and empty columns as float
+    column_types = {}
+    for field in schema:
+        if pa.types.is_temporal(field.type):
+            column_types[field.name] = pa.string()
+        elif pa.types.is_null(field.type):
+            column_types[field.name] = pa.float64()
+    if column_types:
+        source.seek(0)
+        convert_options.column_types = column_types
+        reader = pa_csv.open_csv(source, read_options=read_options, convert_options=convert_options)
+
+    with pq.ParquetWriter(path, reader.schema) as writer:
+        for batch in reader:
+            writer.write_batch(batch)
+
+
+def load_dataset(file, file_type=None):
+    """Load an uploaded CSV, Excel or Parquet file.
+
+    CSV and Parquet files become a Dataset backed by a temporary Parquet file,
+    so the parsed rows never have to sit in memory at once. Excel workbooks,
+    and CSV files whose column types change after the first block, are read
+    whole into a DataFrame. The type comes from the file name unless given.
+    """
+    extension = file_type
+    if extension is None:
+        name = getattr(file, 'name', '')
+        extension = os.path.splitext(name if isinstance(name, str) else '')[1].lower().lstrip('.')
+    if extension == 'xlsx':
+        return pd.read_excel(file, engine='openpyxl')
+
+    directory = tempfile.mkdtemp(prefix='tabletalk-')
+    try:
+        if extension == 'parquet':
+            path = os.path.join(directory, 'upload.parquet')
+            fingerprint = _fingerprint(file, copy_to=path)
+            return Dataset(path, fingerprint, directory)
+
+        fingerprint = _fingerprint(file)
+        path = os.path.join(directory, 'data.parquet')
+        try:
+            _csv_to_parquet(file, path)
+        except (pa.ArrowInvalid, ValueError):
+            # Column types differ from what the first block suggested
+            shutil.rmtree(directory, ignore_errors=True)
+            file.seek(0)
+            return pd.read_csv(file)
+        return Dataset(path, fingerprint, directory)
+    except Exception:
+        shutil.rmtree(directory, ignore_errors=True)
+        raise
+
+
+def _allocate_sample(group_sizes, n, rng):
+    """Split n rows between groups in proportion to their sizes, giving each group a row while n allows"""
+    if n < len(group_sizes):
+        # Too few rows for every group: pick groups with probability by size
+        allocation = np.zeros(len(group_sizes), dtype=np.int64)
+        allocation[rng.choice(len(group_sizes), size=n, replace=False, p=group_sizes / group_sizes.sum())] = 1
+        return allocation
+    # One row each, then the rest by the largest remainder of each group's share
+    spare = group_sizes - 1
+    share = spare * (n - len(group_sizes)) / max(spare.sum(), 1)
+    allocation = np.floor(share).astype(np.int64)
+    remainder = n - len(group_sizes) - allocation.sum()
+    allocation[np.argsort(allocation - share, kind='stable')[:remainder]] += 1
+    return np.minimum(allocation + 1, group_sizes)
+
+
+def sample_rows(data, n, stratify_by=None, random_state=None):
+    """Return n random rows of a DataFrame or Dataset, in their order in the data.
+
+    With stratify_by, rows are drawn from each value of that column in
+    proportion to how often it occurs, with at least one row per value
+    while n allows; missing values count as a value of their own.
+    """
+    rng = np.random.default_rng(random_state)
+    n = min(n, len(data))
+    if stratify_by is None:
+        positions = rng.choice(len(data), size=n, replace=False)
+    else:
+        values = data.column(stratify_by) if isinstance(data, Dataset) else data[stratify_by]
+        codes, _ = pd.factorize(values, use_na_sentinel=False)
+        allocation = _allocate_sample(np.bincount(codes), n, rng)
+        positions = np.concatenate([
+            rng.choice(np.flatnonzero(codes == group), size=size, replace=False)
+            for group, size in enumerate(allocation) if size
+        ] or [np.array([], dtype=np.int64)])
+    return take_rows(data, np.sort(positions))
@@ -0,0 +1,178 @@
+import base64
+import hashlib
+import json
+import tempfile
+from typing import List
+
+from pydantic import BaseModel
+
+# Provider limits for a single batch input file
+MAX_BATCH_REQUESTS = 50000
+MAX_BATCH_BYTES = 190 * 1024 * 1024  # 200 MB limit, minus headroom
+
+# Request files stay in memory up to this size, then spill to disk
+SPOOL_MAX_BYTES = 32 * 1024 * 1024
+
+JOB_ID_PREFIX = "job_"
+
+# Jobs whose rows were all served from the local response cache
+CACHED_JOB_PREFIX = "cached_"
+
+ACTIVE_STATUSES = ("validating", "in_progress", "finalizing", "cancelling")
+
+
+class RequestCounts(BaseModel):
+    completed: int = 0
+    failed: int = 0
+    total: int = 0
+
+
+class JobStatus(BaseModel):
+    """Combined status of a job that was split into several batches"""
+    id: str
+    status: str
+    request_counts: RequestCounts
+    batches: List[object]
+
+
+# Job IDs of providers other than the default start with "<provider>:"
+DEFAULT_PROVIDER = "openai"
+PROVIDER_SEPARATOR = ":"
+
+
+def encode_job_id(batch_ids, provider=DEFAULT_PROVIDER):
+    """Return one ID for a list of batch IDs (a single batch keeps its own ID)"""
+    if len(batch_ids) == 1:
+        job_id = batch_ids[0]
+    else:
+        encoded = base64.urlsafe_b64encode(",".join(batch_ids).encode("utf-8")).decode("ascii")
+        job_id = JOB_ID_PREFIX + encoded.rstrip("=")
+    if provider != DEFAULT_PROVIDER:
+        job_id = f"{provider}{PROVIDER_SEPARATOR}{job_id}"
+    return job_id
+
+
+def job_provider(job_id):
+    """Return the name of the provider that runs a job"""
+    provider, separator, _ = job_id.strip().partition(PROVIDER_SEPARATOR)
+    return provider if separator else DEFAULT_PROVIDER
+
+
+def decode_job_id(job_id):
+    """Return the batch IDs behind a job ID; jobs served from the local cache have none"""
+    job_id = job_id.strip()
+    if PROVIDER_SEPARATOR in job_id:
+        job_id = job_id.partition(PROVIDER_SEPARATOR)[2]
+    if job_id.startswith(CACHED_JOB_PREFIX):
+        return []
+    if not job_id.startswith(JOB_ID_PREFIX):
+        return [job_id]
+    encoded = job_id[len(JOB_ID_PREFIX):]
+    encoded += "=" * (-len(encoded) % 4)
+    return base64.urlsafe_b64decode(encoded).decode("utf-8").split(",")
+
+
+class RowMap:
+    """Tracks unique prompts and the rows that share each of them.
+
+    The first row with a given prompt is sent as the request; every later row
+    with the same prompt is recorded as a duplicate of it and receives its
+    result when the outputs are parsed. Packed requests record the rows they
+    carry.
+    """
+
+    def __init__(self):
+        self.first_rows = {}
+        self.duplicates = {}
+        self.packs = {}
+        self.rows = 0
+
+    def add(self, custom_id, prompt):
+        """Record a row and return True if its prompt hasn't been seen before"""
+        self.rows += 1
+        digest = hashlib.blake2b(prompt.encode("utf-8"), digest_size=16).digest()
+        first_row = self.first_rows.setdefault(digest, custom_id)
+        if first_row == custom_id:
+            return True
+        self.duplicates.setdefault(first_row, []).append(custom_id)
+        return False
+
+    def add_pack(self, custom_id, row_ids):
+        """Record the rows carried by a packed request"""
+        self.packs[custom_id] = row_ids
+
+    @property
+    def requests(self):
+        return len(self.first_rows)
+
+    @property
+    def dedup_ratio(self):
+        return self.rows / self.requests if self.requests else 1.0
+
+    def iter_lines(self):
+        """Encode the map as JSONL lines of {"custom_id", "duplicates"} and {"custom_id", "rows"}"""
+        for custom_id, duplicates in self.duplicates.items():
+            yield json.dumps({"custom_id": custom_id, "duplicates": duplicates}).encode("utf-8")
+        for custom_id, row_ids in self.packs.items():
+            yield json.dumps({"custom_id": custom_id, "rows": row_ids}).encode("utf-8")
+
+
+def write_jsonl(lines):
+    """Write encoded JSONL lines to one spooled file, rewound for reading"""
+    jsonl_file = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_BYTES, mode="w+b")
+    for i, line in enumerate(lines):
+        if i:
+            jsonl_file.write(b"\n")
+        jsonl_file.write(line)
+    jsonl_file.seek(0)
+    return jsonl_file
+
+
+def iter_jsonl_shards(lines, max_requests=MAX_BATCH_REQUESTS, max_bytes=MAX_BATCH_BYTES):
+    """Split encoded JSONL lines into spooled files that each fit in one batch.
+
+    Each yielded file is rewound and ready to upload; the caller closes it.
+    """
+    shard = None
+    count = size = 0
+    for line in lines:
+        if shard is not None and (count >= max_requests or size + 1 + len(line) > max_bytes):
+            shard.seek(0)
+            yield shard
+            shard = None
+
+        if shard is None:
+            shard = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_BYTES, mode="w+b")
+            count = size = 0
+        else:
+            shard.write(b"\n")
+            size += 1
+
+        shard.write(line)
+        count += 1
+        size += len(line)
+
+    if shard is not None:
+        shard.seek(0)
+        yield shard
+
+
+def combine_batches(job_id, batches):
+    """Summarize the batches of a job into a single status with combined progress"""
+    statuses = [batch.status for batch in batches]
+    if all(status == "completed" for status in statuses):
+        status = "completed"
+    elif any(status in ACTIVE_STATUSES for status in statuses):
+        status = "in_progress"
+    else:
+        # Every batch is finished; report the first one that didn't complete
+        status = next(status for status in statuses if status != "completed")
+
+    request_counts = RequestCounts()
+    for batch in batches:
+        if batch.request_counts is not None:
+            request_counts.completed += batch.request_counts.completed
+            request_counts.failed += batch.request_counts.failed
+            request_counts.total += batch.request_counts.total
+
+    return JobStatus(id=job_id, status=status, request_counts=request_counts, batches=batches)
@@ -1,231 +1,1040 @@
+import asyncio
 import json
-from copy import deepcopy
 import pandas as pd
-from openai import OpenAI
-from pydantic import BaseModel
-from typing import Union, List
-import io
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from json.encoder import encode_basestring_ascii
+from src.utils.template_util import CHARS_PER_TOKEN, PackedPromptTemplate, PromptTemplate
+from src.utils.schema_util import CONFIDENCE_COLUMN, ResponseSchema
+from src.utils.validation_util import check_constraints, failing_rows
+from src.utils.result_util import ResultColumns, coerce_results, fan_out_rows
+from src.utils.job_util import ACTIVE_STATUSES, CACHED_JOB_PREFIX, JobStatus, RequestCounts, RowMap, combine_batches, decode_job_id, encode_job_id, iter_jsonl_shards, job_provider, write_jsonl
+from src.utils.cache_util import ResponseCache
+from src.utils.ingest_util import dataset_fingerprint, row_ids, sample_rows, take_rows
+from src.utils.client_util import get_async_client, get_client, key_hash
+from src.utils.registry_util import JobRegistry
+from src.utils.provider_util import OPENAI, get_provider, provider_for_model
+from src.utils.metrics_util import Stopwatch, log_event, metrics, record_span, record_usage, timed, timed_span
+from src.utils.realtime_util import DEFAULT_CONCURRENCY, DEFAULT_RPM, DEFAULT_TPM, RateLimiter, RealtimeProgress, call_with_backoff
 
-class Response(BaseModel):
-    field_name: str
-    reasoning: str
-    value: Union[str, float, int]
+# Rows rendered per chunk while streaming requests
+RENDER_CHUNK_ROWS = 5000
 
-class ResponseList(BaseModel):
-    responses: List[Response]
+# Rows sent by a test run unless asked for more
+DEFAULT_TEST_ROWS = 10
 
-def _prepare_batch_requests(df, field_descriptions, model):
-    """Generate the batch of requests in OpenAI batch API format"""
-    
-    available_columns = df.columns.tolist()
+# Shards uploaded at the same time
+MAX_CONCURRENT_UPLOADS = 4
+
+# Custom IDs of requests that carry several rows
+PACK_ID_PREFIX = "pack-"
+
+# Follow-up batches sent for rows that failed, came back unparseable or never came back
+MAX_RETRY_ROUNDS = 2
+
+# Batches that ended like this aren't retried: the input was rejected or the job was stopped
+NO_RETRY_STATUSES = ("failed", "cancelled")
+
+def _batch_request(custom_id, prompt, model, schema, pack_size=None, provider=None, system=None):
+    """Create a single request in the batch format of the model's provider"""
+    packed = bool(pack_size and pack_size > 1)
+    provider = provider or provider_for_model(model)
+    return provider.batch_request(
+        custom_id,
+        prompt,
+        model,
+        schema.max_tokens(pack_size),
+        schema.response_format(packed),
+        system
+    )
+
+def _cache_namespace(account, model, system, schema):
+    """Cache key prefix for responses of this API key hash, model, row response schema and system prompt"""
+    return ResponseCache.namespace(account, model, json.dumps(schema.response_format(), sort_keys=True) + "\n" + system)
+
+def _empty_usage():
+    return {"model": None, "requests": 0, "input_tokens": 0, "cached_tokens": 0, "cache_write_tokens": 0, "output_tokens": 0}
 
-    with open('instructions.txt', 'r') as f:
-        prompt_template = f.read()
+def _add_usage(totals, usage):
+    """Add the token usage of one response, or another total, to totals"""
+    if not usage:
+        return
+    totals["model"] = usage.get("model") or totals["model"]
+    totals["requests"] += usage.get("requests", 1)
+    for key in ("input_tokens", "cached_tokens", "cache_write_tokens", "output_tokens"):
+        totals[key] += usage.get(key) or 0
+
+def _iter_batch_lines(df, field_descriptions, model, row_map=None, cache=None, job_token=None, stats=None, pack_size=None, provider=None, reasoning=False, confidence=False,
+                      account=None):
+    """Generate the batch requests as encoded JSONL lines.
+
+    The request envelope, including the response schema, is serialized once;
+    each line only encodes its custom_id and prompt. Lines are byte-identical
+    to json.dumps() of the corresponding request dict. With a row_map, only
+    the first row of each distinct prompt produces a request; with a cache,
+    prompts that already have a cached response are recorded under job_token
+    instead of being sent; account, the hash of the API key, keeps each
+    key's cached responses apart. With a pack_size above 1, that many rows share
+    one request and the packs are recorded in the row_map. The response
+    schema is generated from the fields; reasoning adds a reasoning property
+    and confidence a confidence property.
+    """
+    packed = bool(pack_size and pack_size > 1)
+    schema = ResponseSchema(field_descriptions, reasoning, confidence)
+    if packed:
+        template = PackedPromptTemplate(field_descriptions, df.columns, reasoning=reasoning, confidence=confidence)
+        # Rows are cached one by one, under the system prompt and schema they'd get unpacked
+        namespace = _cache_namespace(account, model, template.rows.system, schema)
+    else:
+        template = PromptTemplate(field_descriptions, df.columns, reasoning=reasoning, confidence=confidence)
+        namespace = _cache_namespace(account, model, template.system, schema)
     
-    jsonl_requests = []
+    # The system prompt is part of the envelope, so it is encoded once per job
+    sentinel = uuid.uuid4().hex
+    envelope = json.dumps(_batch_request(sentinel, sentinel, model, schema, pack_size, provider, template.system))
+    head, middle, tail = envelope.split(f'"{sentinel}"')
+    stats = stats if stats is not None else {}
+    stats.setdefault("cache_hits", 0)
+    stats.setdefault("requests", 0)
+
+    def encode_line(custom_id, prompt):
+        stats["requests"] += 1
+        line = head + encode_basestring_ascii(custom_id) + middle + encode_basestring_ascii(prompt) + tail
+        return line.encode('utf-8')
     
-    for index, row in df.iterrows():
-        # Create a deep copy of field_descriptions to avoid modifying the original
-        fields = deepcopy(field_descriptions)
+    # Time spent rendering prompts, and encoding them (packing included) into lines
+    render_time = Stopwatch()
+    serialize_time = Stopwatch()
+    pack = []
+    for index, prompts in timed(template.iter_render(df, RENDER_CHUNK_ROWS), render_time):
+        requests = []
+        for row_index, prompt in zip(index, prompts):
+            custom_id = f"{row_index}"
+            if row_map is not None and not row_map.add(custom_id, prompt):
+                continue
+            requests.append((custom_id, prompt))
         
-        # Replace @col_name with row[col_name] in each field's description
-        for field in fields:
-            instructions = field['instructions']
-            for col in available_columns:
-                # Convert the value to a simple string without Series metadata
-                instructions = instructions.replace(f'@{col}', str(row[col].item() if hasattr(row[col], 'item') else row[col]))
-            field['instructions'] = instructions
+        # Look up the whole chunk in the cache at once
+        keys = [ResponseCache.key(namespace, prompt) for _, prompt in requests] if cache is not None else []
+        hits = cache.get_many(keys) if cache is not None else {}
+        if cache is not None:
+            cache.add_job_rows(job_token, [
+                (custom_id, key, hits.get(key)) for (custom_id, _), key in zip(requests, keys)
+            ])
+            stats["cache_hits"] += sum(key in hits for key in keys)
         
-        # Create the prompt with the processed field descriptions
-        prompt = prompt_template.replace('{{FIELD_DESCRIPTIONS}}', json.dumps(fields, indent=2))
+        lines = []
+        with serialize_time:
+            for i, (custom_id, prompt) in enumerate(requests):
+                if hits and keys[i] in hits:
+                    continue
+                if not packed:
+                    lines.append(encode_line(custom_id, prompt))
+                    continue
+                
+                # Packs carry over between chunks so every request is full
+                pack.append((custom_id, prompt))
+                if len(pack) == pack_size:
+                    pack_id = f"{PACK_ID_PREFIX}{pack[0][0]}"
+                    row_map.add_pack(pack_id, [row_id for row_id, _ in pack])
+                    lines.append(encode_line(pack_id, template.render_pack(pack)))
+                    pack = []
+        yield from lines
+    
+    if pack:
+        with serialize_time:
+            pack_id = f"{PACK_ID_PREFIX}{pack[0][0]}"
+            row_map.add_pack(pack_id, [row_id for row_id, _ in pack])
+            line = encode_line(pack_id, template.render_pack(pack))
+        yield line
+    
+    render_time.record("render", model=model, rows=len(df))
+    serialize_time.record("serialize", model=model, requests=stats["requests"])
+
+def _submit_batch_requests(api_key, batch_lines, row_map=None, provider=None):
+    """Submit the requests as one or more batches and return the job ID"""
+    provider = provider or get_provider(OPENAI)
+    client = get_client(api_key, provider.name)
+    metadata = {
+        "description": "nightly eval job"
+    }
+    
+    def upload(shard, jsonl_file):
+        with timed_span("upload", provider=provider.name, shard=shard):
+            return provider.upload_file(client, jsonl_file, f"batch_requests_{shard}.jsonl")
+    
+    def create_batch(shard, input_file_id):
+        with timed_span("create_batch", provider=provider.name, shard=shard):
+            return provider.create_batch(client, input_file_id, dict(metadata, shard=str(shard)))
+    
+    with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_UPLOADS) as executor:
+        # Shards are uploaded concurrently while the next ones are still being written
+        uploads = [
+            executor.submit(upload, shard, jsonl_file)
+            for shard, jsonl_file in enumerate(iter_jsonl_shards(
+                batch_lines, provider.max_batch_requests, provider.max_batch_bytes
+            ))
+        ]
         
-        # Create the OpenAI batch request in JSONL format
-        jsonl_request = {
-            "custom_id": f"{index}",
-            "method": "POST",
-            "url": "/v1/chat/completions",
-            "body": {
-                "model": model,
-                "messages": [
-                    {"role": "user", "content": prompt}
-                ],
-                "max_tokens": 1024,
-                "response_format": {
-                    "type": "json_schema",
-                    "json_schema": {
-                        "name": "response_list",
-                        "schema": {
-                            "type": "object",
-                            "properties": {
-                                "responses": {
-                                    "type": "array",
-                                    "items": {
-                                        "type": "object",
-                                        "properties": {
-                                            "field_name": {"type": "string"},
-                                            "reasoning": {"type": "string"},
-                                            "value": {
-                                                "type": ["string", "number"]
-                                            }
-                                        },
-                                        "required": ["field_name", "reasoning", "value"],
-                                        "additionalProperties": False
-                                    }
-                                }
-                            },
-                            "required": ["responses"],
-                            "additionalProperties": False
-                        },
-                        "strict": True
-                    }
-                }
-            }
-        }
-        jsonl_requests.append(jsonl_request)
+        # All rows have been seen now, so the row map is complete
+        if provider.uploads_row_map and row_map is not None and (row_map.duplicates or row_map.packs):
+            with timed_span("upload", provider=provider.name, shard="row_map"):
+                metadata["row_map_file_id"] = provider.upload_file(client, write_jsonl(row_map.iter_lines()), "row_map.jsonl")
+        
+        input_file_ids = [upload.result() for upload in uploads]
+        futures = [
+            executor.submit(create_batch, shard, input_file_id)
+            for shard, input_file_id in enumerate(input_file_ids)
+        ]
+    
+    batch_ids = []
+    errors = []
+    for future in futures:
+        try:
+            batch_ids.append(future.result())
+        except Exception as e:
+            errors.append(e)
     
-    # Return the JSONL requests directly instead of writing to a file
-    return jsonl_requests
+    if not batch_ids and not errors:
+        return None
+    
+    if errors:
+        # Don't leave a partial job running
+        for batch_id in batch_ids:
+            try:
+                provider.cancel(client, batch_id)
+            except Exception:
+                pass
+        raise errors[0]
+    
+    return encode_job_id(batch_ids, provider.name)
+
+def apply_transformation(api_key, df, field_descriptions, model, cache=None, pack_size=None, incremental=True, reasoning=False,
+                         estimate=None, cascade=None):
+    """Submit the transformation of every row and return the job ID and request stats.
 
-def _submit_batch_requests(api_key, batch_requests):
-    client = OpenAI(api_key=api_key)
+    Rows whose rendered prompt is identical share one request, and prompts
+    with a response in the local cache are not sent at all; both are merged
+    back in when the batch is checked. pack_size puts several rows into one
+    request; "auto" picks the largest pack that fits the token budgets.
+    The model decides the provider: Claude models run as Anthropic message
+    batches, everything else as OpenAI batches. Responses hold one typed
+    value per field; reasoning also asks the model to explain them first,
+    which costs more output tokens.
     
-    # Create a string with each JSON object on a new line
-    jsonl_content = "\n".join(json.dumps(request) for request in batch_requests)
+    With incremental set, fields whose definition already has stored results
+    for every row of this dataset and model are not sent again; their stored
+    values are merged into the results when the batch is checked. Fields
+    stored for only some rows are generated again, and when every field to
+    generate is stored like that, only the rows one of them misses are sent.
     
-    # Create a file-like object from the string
-    jsonl_file = io.BytesIO(jsonl_content.encode('utf-8'))
+    A cascade ({"model": stronger_model, "min_confidence": 0.7}) runs every
+    row on model first. Once its batch is done, rows whose values break
+    their field's type or constraints (pattern, minimum, maximum,
+    allowed_values), or whose confidence is below min_confidence, are sent
+    to the stronger model of the same provider and its results replace
+    theirs. Without min_confidence no confidence is asked for.
     
-    # Submit the batch directly using the file-like object
-    batch_input_file = client.files.create(
-        file=jsonl_file,
-        purpose="batch"
-    )
+    Every job is recorded in the job registry, next to the cache, with the
+    estimate from estimate_cost if one is given, so the tokens it actually
+    used can be compared with it once it finishes.
+    """
+    provider = provider_for_model(model)
+    if cascade is not None and provider_for_model(cascade["model"]).name != provider.name:
+        raise ValueError(f"A cascade can only escalate to a model of the same provider, not from {model} to {cascade['model']}")
+    check_constraints(field_descriptions)
+    confidence = cascade is not None and cascade.get("min_confidence") is not None
+    cache = cache or ResponseCache()
+    registry = JobRegistry(cache.path)
+    account = key_hash(api_key)
+    all_fields = field_descriptions
+    # Jobs that need no batch keep this ID; it names the provider like any other job ID
+    job_token = encode_job_id([f"{CACHED_JOB_PREFIX}{uuid.uuid4().hex}"], provider.name)
     
-    batch_input_file_id = batch_input_file.id
-    request = client.batches.create(
-        input_file_id=batch_input_file_id,
-        endpoint="/v1/chat/completions",
-        completion_window="24h",
-        metadata={
-            "description": "nightly eval job"
+    # Only fields without stored results for every row need to be generated
+    dataset = dataset_fingerprint(df)
+    rows = len(df)
+    fingerprints = [ResponseCache.field_fingerprint(field, account) for field in field_descriptions]
+    stored = cache.stored_fields(dataset, model, fingerprints) if incremental else set()
+    custom_ids = row_ids(df) if stored else []
+    gaps = {}
+    for fingerprint in stored:
+        values = cache.field_values(dataset, model, fingerprint)
+        gaps[fingerprint] = {custom_id for custom_id in custom_ids if custom_id not in values}
+    complete = {fingerprint for fingerprint, missing in gaps.items() if not missing}
+    cache.add_job_fields(job_token, dataset, model, [
+        (fingerprint, field["field_name"], fingerprint not in complete)
+        for fingerprint, field in zip(fingerprints, field_descriptions)
+    ])
+    submitted = [fingerprint for fingerprint in fingerprints if fingerprint not in complete]
+    field_descriptions = [
+        field for fingerprint, field in zip(fingerprints, field_descriptions) if fingerprint not in complete
+    ]
+    if not field_descriptions:
+        # Every field is stored; the job is complete without a batch
+        registry.add_job(job_token, provider.name, model, all_fields, rows, api_key, dataset=dataset, estimate=estimate, cascade=cascade)
+        return job_token, {
+            "cache_hits": 0, "requests": 0, "pack_size": 1, "rows": rows, "dedup_ratio": 1.0,
+            "cache_hit_rate": 0.0, "fields_submitted": 0, "fields_reused": len(complete)
         }
-    )
-    batch_id = request.id
-    return batch_id
-
-def apply_transformation(api_key, df, field_descriptions, model):
-    """Apply the transformation to a single row and return multiple values"""
-    batch_requests = _prepare_batch_requests(df, field_descriptions, model)
-    batch_id = _submit_batch_requests(api_key, batch_requests)
-    return batch_id
+    if all(fingerprint in gaps for fingerprint in submitted):
+        # Every field to generate is stored for some rows; the rest come from the store
+        missing = set().union(*(gaps[fingerprint] for fingerprint in submitted))
+        df = take_rows(df, [position for position, custom_id in enumerate(custom_ids) if custom_id in missing])
+    
+    if pack_size == "auto":
+        pack_size = PackedPromptTemplate(field_descriptions, df.columns, reasoning=reasoning, confidence=confidence).choose_pack_size(df)
+    
+    row_map = RowMap()
+    stats = {
+        "cache_hits": 0, "requests": 0, "pack_size": pack_size or 1,
+        "fields_submitted": len(field_descriptions), "fields_reused": len(complete)
+    }
+    batch_lines = _iter_batch_lines(df, field_descriptions, model, row_map, cache, job_token, stats, pack_size, provider, reasoning, confidence, account)
+    try:
+        with timed_span("submit", provider=provider.name, model=model, rows=len(df)):
+            batch_id = _submit_batch_requests(api_key, batch_lines, row_map, provider)
+    except Exception:
+        cache.discard_job(job_token)
+        metrics.write()
+        raise
+    
+    if batch_id is None:
+        # Every prompt was cached, so the job is complete without a batch.
+        # There is no uploaded row map either, so record the duplicates locally.
+        batch_id = job_token
+        cached_rows = {custom_id: (key, content) for custom_id, key, content in cache.job_rows(job_token)}
+        cache.add_job_rows(job_token, [
+            (duplicate, *cached_rows[custom_id])
+            for custom_id, duplicates in row_map.duplicates.items()
+            for duplicate in duplicates
+        ])
+    else:
+        if not provider.uploads_row_map and (row_map.duplicates or row_map.packs):
+            cache.add_row_map(job_token, row_map.iter_lines())
+        cache.rename_job(job_token, batch_id)
+    
+    stats.update({
+        "rows": row_map.rows,
+        "dedup_ratio": row_map.dedup_ratio,
+        "cache_hit_rate": stats["cache_hits"] / row_map.requests if row_map.requests else 0.0
+    })
+    registry.add_job(batch_id, provider.name, model, all_fields, rows, api_key, dataset=dataset, estimate=estimate, cascade=cascade)
+    metrics.inc("jobs_submitted_total", provider=provider.name)
+    metrics.inc("requests_submitted_total", stats["requests"], provider=provider.name)
+    log_event("job_submitted", job_id=batch_id, provider=provider.name, model=model, **stats)
+    metrics.write()
+    return batch_id, stats
 
-def _parse_batch_response(response_content):
-    """Helper function to parse batch response content"""
+def _parse_json(message_content):
     try:
-        # Parse the JSONL response
-        response_data = json.loads(response_content)
-        
-        # Extract the actual message content
-        message_content = response_data['response']['body']['choices'][0]['message']['content']
-        
-        # Parse the JSON string into ResponseList
-        return ResponseList.model_validate_json(message_content)
-    except Exception as e:
-        print(f"Error parsing response: {e}")
+        return json.loads(message_content)
+    except (TypeError, ValueError):
         return None
 
-def check_batch_status(batch_id, api_key):
-    client = OpenAI(api_key=api_key)
-    batch = client.batches.retrieve(batch_id=batch_id)
+def _add_response(results, custom_id, message_content, schema):
+    """Parse a response message into the result columns, returning False if it is malformed"""
+    values = schema.values(_parse_json(message_content))
+    if values is None:
+        results.malformed_lines += 1
+        return False
+    results.add_row(custom_id, values)
+    return True
+
+def _add_packed_response(results, row_ids, message_content, to_cache, cache_keys, schema):
+    """Unpack a packed response into per-row results, ignoring rows it wasn't asked about"""
+    response = _parse_json(message_content)
+    if not isinstance(response, dict) or not isinstance(response.get("rows"), list):
+        results.malformed_lines += 1
+        return False
     
+    expected = set(row_ids)
+    for packed_row in response["rows"]:
+        row_id = packed_row.get("row_id") if isinstance(packed_row, dict) else None
+        if row_id not in expected:
+            continue
+        values = schema.values(packed_row)
+        if values is None:
+            continue
+        expected.discard(row_id)
+        results.add_row(row_id, values)
+        if cache_keys and row_id in cache_keys:
+            # Cache each row in the same form as an unpacked response
+            row_content = json.dumps({key: value for key, value in packed_row.items() if key != "row_id"})
+            to_cache.append((cache_keys[row_id], row_content))
+    return True
 
-    if batch.status == 'completed' and batch.output_file_id is not None:
-        # Download the output file
-        file_response = client.files.content(batch.output_file_id)
-        
-        # Initialize dict to store data for DataFrame
-        data = {}
-        field_names = set()
-        
-        # Process each line in the JSONL response
-        for line in file_response.text.strip().split('\n'):
-            response = _parse_batch_response(line)
-            if response:
-                custom_id = json.loads(line)['custom_id']
-                data[custom_id] = {'row_number': custom_id}
-                
-                # Add each field_name: value pair to the row
-                for field in response.responses:
-                    field_names.add(field.field_name)
-                    data[custom_id][field.field_name] = field.value
+def _download_results(client, provider, shard, schema, cache=None, cache_keys=None, packs=None):
+    """Stream a batch's results and parse each response once into per-column arrays.
+
+    Responses for custom_ids in cache_keys are stored in the cache as they are
+    parsed, and packed responses are split into the rows listed in packs. The
+    custom_ids of responses that couldn't be parsed are listed in the
+    dataframe's invalid_ids attribute, those of requests the results report
+    as failed in failed_ids, and the summed token usage in usage.
+    Time spent waiting on the download and parsing it are recorded apart.
+    """
+    results = ResultColumns()
+    to_cache = []
+    invalid_ids = []
+    failed_ids = []
+    usage = _empty_usage()
+    start = time.perf_counter()
+    download_time = Stopwatch()
+    
+    for custom_id, message_content, response_usage in timed(provider.iter_results(client, shard, failed_ids), download_time):
+        _add_usage(usage, response_usage)
+        if custom_id is None:
+            results.malformed_lines += 1
+            continue
+        if message_content is None:
+            results.malformed_lines += 1
+            invalid_ids.append(custom_id)
+            continue
         
-        # Ensure all rows have all columns (fill with None for missing values)
-        for row_data in data.values():
-            for field_name in field_names:
-                if field_name not in row_data:
-                    row_data[field_name] = None
+        if packs and custom_id in packs:
+            if not _add_packed_response(results, packs[custom_id], message_content, to_cache, cache_keys, schema):
+                invalid_ids.append(custom_id)
+        elif _add_response(results, custom_id, message_content, schema):
+            if cache_keys and custom_id in cache_keys:
+                to_cache.append((cache_keys[custom_id], message_content))
+        else:
+            invalid_ids.append(custom_id)
         
-        # Convert results to DataFrame
-        results_df = pd.DataFrame(list(data.values()))
-        return True, results_df, batch
+        if len(to_cache) >= RENDER_CHUNK_ROWS:
+            cache.put_many(to_cache)
+            to_cache = []
+    
+    if to_cache:
+        cache.put_many(to_cache)
+    results_df = results.to_dataframe()
+    results_df.attrs['invalid_ids'] = invalid_ids
+    results_df.attrs['failed_ids'] = failed_ids
+    results_df.attrs['usage'] = usage
+    
+    download_time.record("download", batch_id=shard.id)
+    record_span("parse", time.perf_counter() - start - download_time.seconds, batch_id=shard.id, rows=len(results_df))
+    record_usage(usage, batch_id=shard.id)
+    return results_df
+
+def _parse_row_map(lines):
+    """Return the duplicates ({custom_id: [duplicate custom_ids]}) and packs
+    ({custom_id: [row custom_ids]}) from the lines of a row map"""
+    duplicates = {}
+    packs = {}
+    for line in lines:
+        if line.strip():
+            entry = json.loads(line)
+            if "rows" in entry:
+                packs[entry["custom_id"]] = entry["rows"]
+            else:
+                duplicates[entry["custom_id"]] = entry["duplicates"]
+    return duplicates, packs
+
+def _download_row_map(client, batches):
+    """Return the duplicates and packs recorded in the row map uploaded with a job"""
+    row_map_file_id = next(
+        (shard.metadata["row_map_file_id"] for shard in batches if shard.metadata and shard.metadata.get("row_map_file_id")),
+        None
+    )
+    if row_map_file_id is None:
+        return {}, {}
+    
+    with client.files.with_streaming_response.content(row_map_file_id) as file_response:
+        return _parse_row_map(file_response.iter_lines())
+
+def _retrieve_batches(client, provider, batch_id):
+    """Return (batch, shards): the combined status of a job and its individual batches"""
+    batch_ids = decode_job_id(batch_id)
+    with timed_span("poll", job_id=batch_id, batches=len(batch_ids)), ThreadPoolExecutor(max_workers=MAX_CONCURRENT_UPLOADS) as executor:
+        batches = list(executor.map(lambda shard_id: provider.retrieve(client, shard_id), batch_ids))
+    batch = batches[0] if len(batches) == 1 else combine_batches(batch_id, batches)
+    return batch, batches
+
+def _is_running(batches):
+    return any(shard.status in ACTIVE_STATUSES for shard in batches)
+
+def _retry_status(job_id, batches, total=0, status="retrying"):
+    """Status of a job while a follow-up batch for its failed rows, or its escalation, runs"""
+    if batches:
+        job_status = combine_batches(job_id, batches)
     else:
-        return False, None, batch
+        job_status = JobStatus(id=job_id, status=status, request_counts=RequestCounts(total=total), batches=[])
+    job_status.status = status
+    return job_status
+
+def _retrieve_job(client, provider, registry, batch_id):
+    """Return (batch, generations, retries, running).
+
+    generations holds the job's batches followed by those of each retry that
+    was sent, and retries the retry job IDs recorded for it. While any of
+    them is still running, batch is the status of the running one.
+    """
+    batch, batches = _retrieve_batches(client, provider, batch_id)
+    generations = [batches]
+    retries = registry.job_retries(batch_id)
+    if _is_running(batches):
+        return batch, generations, retries, True
+    
+    for retry_job_id in retries:
+        if retry_job_id is None:
+            # Another check is submitting this retry right now
+            return _retry_status(batch_id, []), generations, retries, True
+        if not retry_job_id:
+            # Nothing could be sent that time
+            continue
+        _, retry_batches = _retrieve_batches(client, provider, retry_job_id)
+        generations.append(retry_batches)
+        if _is_running(retry_batches):
+            return _retry_status(batch_id, retry_batches), generations, retries, True
+    return batch, generations, retries, False
+
+def get_batch_status(batch_id, api_key, cache=None):
+    """Return the combined status of a job without downloading its results"""
+    provider = get_provider(job_provider(batch_id))
+    registry = JobRegistry((cache or ResponseCache()).path)
+    batch, _, _, _ = _retrieve_job(get_client(api_key, provider.name), provider, registry, batch_id)
+    return batch
+
+def _submit_retry(api_key, provider, client, registry, job_id, attempt, batches, request_ids):
+    """Send the requests with the given custom_ids again, copied from the job's own input.
+
+    Returns the job's status while the retry runs, or None if none of the
+    requests could be found.
+    """
+    if not registry.claim_job_retry(job_id, attempt):
+        return _retry_status(job_id, [])
     
-def apply_test_transformation(df, field_descriptions, api_key, model):
-    """Apply the transformation to a random row from the dataset"""
-    # Select a random row
-    random_row = df.sample(n=1)
+    sent = 0
+    def retry_lines():
+        nonlocal sent
+        for shard in batches:
+            for line in provider.iter_requests(client, shard):
+                if json.loads(line)['custom_id'] in request_ids:
+                    sent += 1
+                    yield line
     
-    # Get the available columns
-    available_columns = df.columns.tolist()
+    try:
+        retry_job_id = _submit_batch_requests(api_key, retry_lines(), None, provider)
+    except Exception:
+        registry.set_job_retry(job_id, attempt, None)
+        raise
+    # An empty ID records that there was nothing to send, so the job can finish
+    registry.set_job_retry(job_id, attempt, retry_job_id or "")
+    if retry_job_id is None:
+        return None
+    return _retry_status(job_id, [], total=sent)
+
+def _submit_escalation(api_key, provider, client, registry, job_id, model, batches, request_ids):
+    """Send the requests with the given custom_ids again to a stronger model, copied from the job's own input.
+
+    Returns the job's status while the escalation runs, or None if nothing was sent.
+    """
+    if not registry.claim_job_escalation(job_id, model):
+        return _retry_status(job_id, [], status="escalating")
+    if not request_ids:
+        registry.set_job_escalation(job_id, "")
+        return None
     
-    # Prepare the request
-    batch_requests = _prepare_batch_requests(random_row, field_descriptions, model)
-    messages = batch_requests[0]['body']['messages']
+    sent = 0
+    def escalation_lines():
+        nonlocal sent
+        for shard in batches:
+            for line in provider.iter_requests(client, shard):
+                request = json.loads(line)
+                if request['custom_id'] in request_ids:
+                    sent += 1
+                    yield json.dumps(provider.with_model(request, model)).encode('utf-8')
     
-    # Setup client
-    client = OpenAI(api_key=api_key)
+    try:
+        escalation_job_id = _submit_batch_requests(api_key, escalation_lines(), None, provider)
+    except Exception:
+        registry.set_job_escalation(job_id, None)
+        raise
+    # An empty ID records that there was nothing to send, so the job can finish
+    registry.set_job_escalation(job_id, escalation_job_id or "")
+    if escalation_job_id is None:
+        return None
+    metrics.inc("escalated_requests_total", sent, provider=provider.name)
+    log_event("job_escalated", job_id=job_id, escalation_job_id=escalation_job_id, model=model, requests=sent)
+    return _retry_status(job_id, [], total=sent, status="escalating")
 
+def _count_rows(row_ids, duplicates):
+    """Count rows including those that shared a prompt with them"""
+    return sum(1 + len(duplicates.get(row_id, ())) for row_id in row_ids)
 
-    completion = client.beta.chat.completions.parse(
-        model=model,
-        messages=messages,
-        response_format=ResponseList
-    )
+def _merge_stored_fields(cache, job_id, results_df, fields=None, escalated_rows=()):
+    """Store the fields a job generated and fill in the values stored by earlier runs.
+
+    A generated field is stored for the rows whose value passed the field's
+    checks (fields describes them by name) and didn't come from a cascade's
+    stronger model (escalated_rows); later runs generate the other rows
+    again. Rows without a value from this job get the stored one, for
+    reused fields and generated fields alike.
+    """
+    job_fields = cache.job_fields(job_id)
+    if not job_fields:
+        return results_df
+    dataset, model = job_fields[0][:2]
+    fields = {field["field_name"]: field for field in fields or []}
+    stored = {
+        fingerprint: cache.field_values(dataset, model, fingerprint) for _, _, fingerprint, _, _ in job_fields
+    }
+    
+    # Keep the values this model generated for later runs, next to those stored before
+    for _, _, fingerprint, field_name, submitted in job_fields:
+        if not submitted or field_name not in results_df:
+            continue
+        failing = failing_rows(results_df, [fields.get(field_name, {"field_name": field_name})]).index
+        succeeded = ~results_df['row_number'].isin(failing) & ~results_df['row_number'].isin(escalated_rows)
+        if succeeded.any():
+            values = dict(stored[fingerprint])
+            values.update(zip(results_df['row_number'][succeeded].tolist(), results_df[field_name][succeeded].tolist()))
+            cache.put_field_values(dataset, model, fingerprint, list(values), list(values.values()))
+    
+    filled = {
+        field_name: stored[fingerprint] for _, _, fingerprint, field_name, _ in job_fields if stored[fingerprint]
+    }
+    if not filled:
+        return results_df
     
-    response_text = completion.choices[0].message.parsed
+    # Rows can have stored values even if the new request for them failed, or wasn't sent
+    attrs = dict(results_df.attrs)
+    row_numbers = list(results_df['row_number'])
+    seen = set(row_numbers)
+    for values in filled.values():
+        row_numbers.extend(row_number for row_number in values if row_number not in seen and not seen.add(row_number))
+    merged = results_df.set_index('row_number').reindex(pd.Index(row_numbers, dtype=object, name='row_number'))
+    for field_name, values in filled.items():
+        stored_values = pd.Series(values, dtype=object).reindex(merged.index)
+        if field_name in merged:
+            stored_values = merged[field_name].astype(object).where(merged[field_name].notna(), stored_values)
+        merged[field_name] = stored_values.infer_objects()
+    
+    # Fields in their configured order, then anything else the model returned
+    field_names = [field_name for _, _, _, field_name, _ in job_fields]
+    columns = [field_name for field_name in field_names if field_name in merged] + [
+        column for column in merged.columns if column not in field_names
+    ]
+    merged = merged[columns].reset_index().sort_values(
+        'row_number',
+        key=lambda row_number: pd.to_numeric(row_number, errors='coerce'),
+        kind='stable'
+    ).reset_index(drop=True)
+    merged.attrs = attrs
+    return merged
 
-    # Get the row based on the custom_id
-    row_idx = int(batch_requests[0]['custom_id'])
-    row = df.loc[[row_idx]].copy()  # Create an explicit copy
+def check_batch_status(batch_id, api_key, cache=None):
+    """Return (done, results_df, batch), downloading the results once every batch of the job has ended.
 
-    # Add the new columns to the row
-    for new_column in response_text.responses:  # Access the 'responses' attribute
-        row.loc[:, new_column.field_name] = new_column.value
+    Output is salvaged from every batch that has some, expired and partially
+    failed ones included. Rows that failed, came back unparseable or never
+    came back are sent again in a follow-up batch, up to MAX_RETRY_ROUNDS
+    times; the job reports "retrying" until that ends and its results are
+    merged in. The results carry a per-row breakdown in attrs['row_breakdown'].
+    Columns are converted to the types of their fields; values that don't
+    fit are left empty and listed in attrs['invalid_values']. Token usage is
+    totalled for the job in attrs['usage'] and per batch in attrs['batch_usage'].
+    
+    A job submitted with a cascade reports "escalating" while the rows that
+    failed their checks run on the stronger model; attrs['cascade'] holds how
+    many were escalated and why, how many still fail, and the stronger
+    model's usage, which isn't part of attrs['usage']. Rows that failed but
+    were served from the response cache have no request to send again; they
+    are counted in not_escalated instead.
+    
+    Timings and token counts are written to TABLETALK_METRICS_PATH, if set,
+    after every check.
+    """
+    try:
+        return _check_batch_status(batch_id, api_key, cache)
+    finally:
+        metrics.write()
 
-    # get the instructions for the transformation
-    # Create a deep copy of field_descriptions to avoid modifying the original
-    fields = deepcopy(field_descriptions)
+def _check_batch_status(batch_id, api_key, cache):
+    provider = get_provider(job_provider(batch_id))
+    client = get_client(api_key, provider.name)
+    cache = cache or ResponseCache()
+    registry = JobRegistry(cache.path)
+    batch, generations, retries, running = _retrieve_job(client, provider, registry, batch_id)
+    if running:
+        return False, None, batch
+    
+    # A job with a cascade isn't done until its escalation to the stronger model is
+    job = registry.job(batch_id, api_key)
+    cascade = job["cascade"] if job else None
+    escalations = registry.job_escalations(batch_id) if cascade else []
+    escalation_batches = []
+    if escalations and escalations[0] is None:
+        # Another check is submitting the escalation right now
+        return False, None, _retry_status(batch_id, [], status="escalating")
+    if escalations and escalations[0]:
+        _, escalation_batches = _retrieve_batches(client, provider, escalations[0])
+        if _is_running(escalation_batches):
+            return False, None, _retry_status(batch_id, escalation_batches, status="escalating")
+    
+    # Response properties are mapped back to the fields the job asked for;
+    # without a record of them (jobs submitted elsewhere) they're taken as named
+    schema = ResponseSchema.for_field_names([
+        field_name for _, _, _, field_name, submitted in cache.job_fields(batch_id) if submitted
+    ])
+    
+    # Rows served from the cache at submission, and cache keys for the rest
+    job_rows = cache.job_rows(batch_id)
+    cache_keys = {custom_id: key for custom_id, key, content in job_rows if content is None}
+    if provider.uploads_row_map:
+        duplicates, packs = _download_row_map(client, generations[0])
+    else:
+        duplicates, packs = _parse_row_map(cache.row_map_lines(batch_id))
+    
+    # Download and parse the output of every batch that has one, retries included,
+    # and collect the requests listed as failed, in their results or apart from them
+    shards = [shard for batches in generations for shard in batches]
+    ready = [shard for shard in shards if provider.results_ready(shard)]
+    with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_UPLOADS) as executor:
+        shard_results = list(executor.map(
+            lambda shard: _download_results(client, provider, shard, schema, cache, cache_keys, packs), ready
+        ))
+        failed_ids = set().union(*executor.map(lambda shard: set(provider.iter_failed(client, shard)), shards))
+    failed_ids.update(*(shard_df.attrs['failed_ids'] for shard_df in shard_results))
+    invalid_ids = set().union(*(shard_df.attrs['invalid_ids'] for shard_df in shard_results))
+    batch_usage = [dict(shard_df.attrs['usage'], batch_id=shard.id) for shard, shard_df in zip(ready, shard_results)]
+    
+    # Rows that came back before any retry, or from the cache
+    first_ready = sum(1 for shard in generations[0] if provider.results_ready(shard))
+    first_rows = set().union(*(shard_df['row_number'] for shard_df in shard_results[:first_ready]))
+    cached_ids = [custom_id for custom_id, key, content in job_rows if content is not None]
+    first_rows.update(cached_ids)
+    
+    cached = ResultColumns()
+    for custom_id, key, content in job_rows:
+        if content is not None:
+            _add_response(cached, custom_id, content, schema)
+    if len(cached) or not shard_results:
+        shard_results.append(cached.to_dataframe())
+    
+    # Stitch the shards and cached rows back into row order
+    malformed_lines = sum(shard_df.attrs['malformed_lines'] for shard_df in shard_results)
+    usage = _empty_usage()
+    for shard_df in shard_results:
+        _add_usage(usage, shard_df.attrs.get('usage'))
+    results_df = shard_results[0] if len(shard_results) == 1 else pd.concat(shard_results, ignore_index=True)
+    if len(generations) > 1:
+        # A retried pack can repeat rows that already came back; the first result wins
+        results_df = results_df.drop_duplicates('row_number', keep='first')
+    if len(shard_results) > 1 or len(cached) or packs:
+        results_df = results_df.sort_values(
+            'row_number',
+            key=lambda row_number: pd.to_numeric(row_number, errors='coerce'),
+            kind='stable'
+        ).reset_index(drop=True)
+    
+    # Rows still without a result, and the requests that would bring them back
+    returned = set(results_df['row_number'])
+    pack_of = {row_id: pack_id for pack_id, row_ids in packs.items() for row_id in row_ids}
+    unresolved = {custom_id for custom_id in cache_keys if custom_id not in returned}
+    for custom_id in failed_ids | invalid_ids:
+        unresolved.update(row_id for row_id in packs.get(custom_id, [custom_id]) if row_id not in returned)
+    
+    if unresolved and len(retries) < MAX_RETRY_ROUNDS and not any(
+        shard.status in NO_RETRY_STATUSES for shard in generations[-1]
+    ):
+        request_ids = {pack_of.get(row_id, row_id) for row_id in unresolved}
+        retry_status = _submit_retry(api_key, provider, client, registry, batch_id, len(retries) + 1, generations[0], request_ids)
+        if retry_status is not None:
+            return False, None, retry_status
+    
+    if cascade:
+        # Rows the first model got wrong or never answered, and the requests that carry them
+        fields = [field for field in job["fields"] if field["field_name"] in schema.keys.values()]
+        failing = failing_rows(results_df, fields, cascade.get("min_confidence"))
+        escalated_rows = set(failing.index) | unresolved
+        # Rows served from the cache at submission have no request to send again
+        not_escalated = escalated_rows & set(cached_ids)
+        escalated_rows -= not_escalated
+        if not escalations:
+            escalation_status = _submit_escalation(
+                api_key, provider, client, registry, batch_id, cascade["model"], generations[0],
+                {pack_of.get(row_id, row_id) for row_id in escalated_rows}
+            )
+            if escalation_status is not None:
+                return False, None, escalation_status
+        
+        # The stronger model's results replace those of the rows it was sent
+        escalation_results = [
+            _download_results(client, provider, shard, schema, packs=packs)
+            for shard in escalation_batches if provider.results_ready(shard)
+        ]
+        batch_usage.extend(dict(shard_df.attrs['usage'], batch_id=shard.id) for shard, shard_df in zip(
+            [shard for shard in escalation_batches if provider.results_ready(shard)], escalation_results
+        ))
+        escalation_usage = _empty_usage()
+        escalated_df = None
+        for shard_df in escalation_results:
+            _add_usage(escalation_usage, shard_df.attrs.get('usage'))
+        if escalation_results:
+            escalated_df = pd.concat(escalation_results, ignore_index=True)
+            escalated_df = escalated_df[escalated_df['row_number'].isin(escalated_rows)]
+            results_df = pd.concat([escalated_df, results_df], ignore_index=True).drop_duplicates('row_number', keep='first')
+            results_df = results_df.sort_values(
+                'row_number',
+                key=lambda row_number: pd.to_numeric(row_number, errors='coerce'),
+                kind='stable'
+            ).reset_index(drop=True)
+            returned.update(escalated_df['row_number'])
+            unresolved -= returned
+        
+        still_failing = failing_rows(results_df, fields, cascade.get("min_confidence")).index
+        cascade_report = {
+            "model": cascade["model"],
+            "min_confidence": cascade.get("min_confidence"),
+            "escalated": _count_rows(escalated_rows, duplicates) if escalation_batches else 0,
+            "not_escalated": _count_rows(not_escalated, duplicates),
+            "reasons": failing.value_counts().to_dict(),
+            "still_failing": _count_rows(
+                (escalated_rows | not_escalated) & set(still_failing) | (escalated_rows & unresolved), duplicates
+            ),
+            "usage": escalation_usage
+        }
+    
+    def reason(row_id):
+        request_id = pack_of.get(row_id, row_id)
+        return "failed" if request_id in failed_ids else "invalid" if request_id in invalid_ids else "missing"
+    
+    reasons = [reason(row_id) for row_id in unresolved]
+    results_df.attrs['malformed_lines'] = malformed_lines
+    results_df.attrs['cached_rows'] = len(cached)
+    results_df.attrs['usage'] = usage
+    results_df.attrs['batch_usage'] = batch_usage
+    if cascade:
+        results_df.attrs['cascade'] = cascade_report
+    results_df.attrs['failed_rows'] = sorted(
+        [duplicate for row_id in unresolved for duplicate in [row_id, *duplicates.get(row_id, ())]],
+        key=lambda row_id: pd.to_numeric(row_id, errors='coerce')
+    )
+    results_df.attrs['row_breakdown'] = {
+        "completed": _count_rows(returned, duplicates),
+        "from_cache": _count_rows(cached_ids, duplicates),
+        "recovered_by_retry": _count_rows(returned - first_rows, duplicates),
+        "failed": _count_rows((row_id for row_id, r in zip(unresolved, reasons) if r == "failed"), duplicates),
+        "invalid": _count_rows((row_id for row_id, r in zip(unresolved, reasons) if r == "invalid"), duplicates),
+        "missing": _count_rows((row_id for row_id, r in zip(unresolved, reasons) if r == "missing"), duplicates),
+        "retry_rounds": len(generations) - 1
+    }
+    
+    # The confidence was only asked for to decide what to escalate
+    if CONFIDENCE_COLUMN in results_df:
+        results_df = results_df.drop(columns=CONFIDENCE_COLUMN)
+    
+    # Give rows that shared a prompt the result of the request that was sent
+    results_df = fan_out_rows(results_df, duplicates)
+    escalated = [
+        duplicate for row_id in escalated_rows | not_escalated for duplicate in [row_id, *duplicates.get(row_id, ())]
+    ] if cascade else []
+    results_df = _merge_stored_fields(cache, batch_id, results_df, job["fields"] if job else None, escalated)
+    
+    # Columns take the types their fields were declared with, where the job is registered
+    field_types = {field["field_name"]: field.get("data_type", "text") for field in job["fields"]} if job else {}
+    with timed_span("coerce", job_id=batch_id, rows=len(results_df)):
+        results_df = coerce_results(results_df, field_types)
     
-    # Replace @col_name with row[col_name] in each field's description
-    for field in fields:
-        instructions = field['instructions']
-        for col in available_columns:
-            # Convert the value to a simple string without Series metadata
-            instructions = instructions.replace(f'@{col}', str(row[col].item() if hasattr(row[col], 'item') else row[col]))
-        field['instructions'] = instructions
+    metrics.inc("jobs_completed_total", provider=provider.name)
+    log_event("job_completed", job_id=batch_id, provider=provider.name, row_breakdown=results_df.attrs['row_breakdown'], **usage)
+    return True, results_df, batch
+    
+async def _run_realtime(api_key, df, field_descriptions, model, rpm, tpm, concurrency, on_progress, cache, reasoning):
+    row_map = RowMap()
+    template = PromptTemplate(field_descriptions, df.columns, reasoning=reasoning)
+    schema = ResponseSchema(field_descriptions, reasoning)
+    namespace = _cache_namespace(key_hash(api_key), model, template.system, schema)
+    requests = []
+    for index, prompts in template.iter_render(df, RENDER_CHUNK_ROWS):
+        for row_index, prompt in zip(index, prompts):
+            custom_id = f"{row_index}"
+            if row_map.add(custom_id, prompt):
+                requests.append((custom_id, prompt))
+    
+    results = ResultColumns()
+    progress = RealtimeProgress(total=row_map.rows)
+    failed_rows = []
+    
+    def rows_of(custom_id):
+        return 1 + len(row_map.duplicates.get(custom_id, ()))
+    
+    # Serve what we can from the cache before calling the API
+    keys = [ResponseCache.key(namespace, prompt) for _, prompt in requests]
+    hits = cache.get_many(keys)
+    pending = []
+    for (custom_id, prompt), key in zip(requests, keys):
+        if key in hits and _add_response(results, custom_id, hits[key], schema):
+            progress.completed += rows_of(custom_id)
+            progress.cached += rows_of(custom_id)
+        else:
+            pending.append((custom_id, prompt, key))
+    if on_progress is not None:
+        on_progress(progress, results)
+    
+    client = get_async_client(api_key)
+    limiter = RateLimiter(rpm, tpm)
+    semaphore = asyncio.Semaphore(concurrency)
+    to_cache = []
+    usage = _empty_usage()
+    system_tokens = len(template.system) // CHARS_PER_TOKEN
+    max_tokens = schema.max_tokens()
+    response_format = schema.response_format()
+    
+    async def run_one(custom_id, prompt, key):
+        async with semaphore:
+            try:
+                completion = await call_with_backoff(
+                    limiter,
+                    system_tokens + len(prompt) // CHARS_PER_TOKEN + max_tokens,
+                    lambda: client.beta.chat.completions.parse(
+                        model=model,
+                        messages=[
+                            {"role": "system", "content": template.system},
+                            {"role": "user", "content": prompt}
+                        ],
+                        response_format=response_format,
+                        max_tokens=max_tokens
+                    )
+                )
+                content = completion.choices[0].message.content
+            except Exception:
+                content = None
+        
+        if content is not None and _add_response(results, custom_id, content, schema):
+            to_cache.append((key, content))
+            progress.completed += rows_of(custom_id)
+            if completion.usage is not None:
+                progress.tokens += completion.usage.total_tokens
+                details = getattr(completion.usage, 'prompt_tokens_details', None)
+                _add_usage(usage, {
+                    "model": getattr(completion, 'model', None) or model,
+                    "input_tokens": completion.usage.prompt_tokens,
+                    "cached_tokens": getattr(details, 'cached_tokens', 0) or 0,
+                    "output_tokens": completion.usage.completion_tokens
+                })
+        else:
+            failed_rows.append(custom_id)
+            progress.failed += rows_of(custom_id)
+        if on_progress is not None:
+            on_progress(progress, results)
+    
+    try:
+        await asyncio.gather(*(run_one(*request) for request in pending))
+    finally:
+        if to_cache:
+            cache.put_many(to_cache)
+        await client.close()
+    
+    results_df = results.to_dataframe().sort_values(
+        'row_number',
+        key=lambda row_number: pd.to_numeric(row_number, errors='coerce'),
+        kind='stable'
+    ).reset_index(drop=True)
+    results_df.attrs['malformed_lines'] = results.malformed_lines
+    results_df.attrs['cached_rows'] = progress.cached
+    results_df.attrs['failed_rows'] = failed_rows
+    results_df.attrs['usage'] = usage
+    results_df = fan_out_rows(results_df, row_map.duplicates)
+    return coerce_results(results_df, {field["field_name"]: field.get("data_type", "text") for field in field_descriptions})
+
+def apply_realtime_transformation(api_key, df, field_descriptions, model, rpm=DEFAULT_RPM, tpm=DEFAULT_TPM,
+                                  concurrency=DEFAULT_CONCURRENCY, on_progress=None, cache=None, reasoning=False):
+    """Transform every row right away with concurrent chat completions instead of a batch.
 
+    Requests are kept under the given requests- and tokens-per-minute limits
+    and retried with backoff when rate limited. on_progress(progress, results)
+    is called as results arrive. Returns a dataframe in the same layout as
+    check_batch_status. Only OpenAI models can run in real time.
+    """
+    if provider_for_model(model).name != OPENAI:
+        raise ValueError(f"Real-time runs are only available for OpenAI models, not {model}")
+    cache = cache or ResponseCache()
     try:
-        instructions = fields
-
-        instructions_text = ""
-        for instr in instructions:
-            instructions = instr['instructions']
-            col_name = instr['field_name']
-            # add a row like this -> col_name: instructions
-            instr_text = f"{col_name}: {instructions}"
-            instructions_text += instr_text + "\n"
-    except Exception as e:
-        instructions_text = None
-
-    return row, instructions_text
\ No newline at end of file
+        with timed_span("realtime", model=model, rows=len(df)):
+            results_df = asyncio.run(_run_realtime(api_key, df, field_descriptions, model, rpm, tpm, concurrency, on_progress, cache, reasoning))
+        record_usage(results_df.attrs['usage'], mode="realtime")
+        return results_df
+    finally:
+        metrics.write()
+
+def apply_test_run(df, field_descriptions, api_key, model, sample_size=DEFAULT_TEST_ROWS, stratify_by=None,
+                   concurrency=DEFAULT_CONCURRENCY, cache=None, reasoning=False, random_state=None):
+    """Transform sample_size random rows right away, concurrently, timing each request.
+
+    Rows are drawn in proportion to the values of the stratify_by column
+    when one is given. Every row is sent to the API, even if its response is
+    cached, so latencies and token counts are measured; the responses are
+    cached for later runs. Returns (rows, prompt_text): the sampled
+    rows with their new values, then _latency_seconds, _input_tokens,
+    _cached_tokens, _output_tokens and _error per row, and the system message
+    and data block sent for the first of them. attrs['requests'] holds the
+    measurement of each request and attrs['usage'] their total.
+    """
+    rows = sample_rows(df, sample_size, stratify_by, random_state)
+    if rows.empty:
+        raise ValueError("The dataset has no rows to test")
+
+    # One template, schema and client for every sampled row
+    template = PromptTemplate(field_descriptions, df.columns, reasoning=reasoning)
+    schema = ResponseSchema(field_descriptions, reasoning)
+    prompts = [prompt for _, chunk in template.iter_render(rows, RENDER_CHUNK_ROWS) for prompt in chunk]
+    provider = provider_for_model(model)
+    client = get_client(api_key, provider.name)
+    max_tokens = schema.max_tokens()
+    response_format = schema.response_format()
+
+    def run_one(prompt):
+        start = time.perf_counter()
+        try:
+            content, usage = provider.complete(client, prompt, model, max_tokens, response_format, template.system)
+            error = None
+        except Exception as e:
+            content, usage, error = None, None, str(e)
+        latency = time.perf_counter() - start
+        values = schema.values(_parse_json(content)) if content is not None else None
+        if values is None and error is None:
+            error = "The model did not return a response"
+        return {"content": content, "values": values, "latency_seconds": latency, "usage": usage, "error": error}
+
+    with Stopwatch() as wall:
+        with ThreadPoolExecutor(max_workers=max(1, min(concurrency, len(prompts)))) as pool:
+            outcomes = list(pool.map(run_one, prompts))
+    wall.record("test_run", model=model, rows=len(rows))
+
+    cache = cache or ResponseCache()
+    namespace = _cache_namespace(key_hash(api_key), model, template.system, schema)
+    to_cache = [(ResponseCache.key(namespace, prompt), outcome["content"]) for prompt, outcome in zip(prompts, outcomes) if outcome["values"] is not None]
+    if to_cache:
+        cache.put_many(to_cache)
+
+    # The prompt as sent for the first sampled row: the shared system message, then its data block
+    prompt_text = f"{template.system}\n\n{prompts[0]}"
+
+    # The new values, then the measurements of the request behind each row
+    rows = rows.copy()
+    for field in field_descriptions:
+        rows[field["field_name"]] = [dict(outcome["values"] or ()).get(field["field_name"]) for outcome in outcomes]
+    rows["_latency_seconds"] = [outcome["latency_seconds"] for outcome in outcomes]
+    for key in ("input_tokens", "cached_tokens", "output_tokens"):
+        rows[f"_{key}"] = pd.array([outcome["usage"][key] if outcome["usage"] else None for outcome in outcomes], dtype="Int64")
+    rows["_error"] = [outcome["error"] for outcome in outcomes]
+
+    usage = _empty_usage()
+    for outcome in outcomes:
+        _add_usage(usage, outcome["usage"])
+    usage["model"] = usage["model"] or model
+    record_usage(usage, mode="test")
+    metrics.write()
+    rows.attrs['requests'] = [
+        {"latency_seconds": outcome["latency_seconds"], "usage": outcome["usage"], "error": outcome["error"]}
+        for outcome in outcomes
+    ]
+    rows.attrs['usage'] = usage
+    rows.attrs['wall_seconds'] = wall.seconds
+    rows.attrs['max_tokens'] = max_tokens
+
+    return rows, prompt_text
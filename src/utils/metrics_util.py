@@ -0,0 +1,181 @@
+import datetime
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger("tabletalk")
+
+# File the metrics are written to in the Prometheus text format, e.g. for
+# node_exporter's textfile collector
+METRICS_PATH_ENV = "TABLETALK_METRICS_PATH"
+
+# Set to log timings and token usage to stderr as one JSON object per line
+LOG_JSON_ENV = "TABLETALK_LOG_JSON"
+
+METRIC_PREFIX = "tabletalk_"
+
+# Token counts of a usage total and the metric kind each is counted as
+USAGE_KINDS = {"input_tokens": "input", "cached_tokens": "cached", "cache_write_tokens": "cache_write", "output_tokens": "output"}
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    escaped = (
+        (name, str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"'))
+        for name, value in labels
+    )
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+
+class Metrics:
+    """Counters and timings of this process, rendered in the Prometheus text format.
+
+    Timings are kept as summaries (count, sum and max seconds) per span name.
+    Labels should have few distinct values; IDs of jobs and batches belong in
+    the logs instead.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {}
+        self.timings = {}
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, span, seconds):
+        with self._lock:
+            count, total, longest = self.timings.get(span, (0, 0.0, 0.0))
+            self.timings[span] = (count + 1, total + seconds, max(longest, seconds))
+
+    def prometheus_text(self):
+        with self._lock:
+            counters = sorted(self.counters.items())
+            timings = sorted(self.timings.items())
+
+        lines = []
+        if timings:
+            lines.append(f"# HELP {METRIC_PREFIX}span_seconds Time spent in each step of preparing, submitting and collecting jobs")
+            lines.append(f"# TYPE {METRIC_PREFIX}span_seconds summary")
+            for span, (count, total, _) in timings:
+                lines.append(f"{METRIC_PREFIX}span_seconds_count{_format_labels([('span', span)])} {count}")
+                lines.append(f"{METRIC_PREFIX}span_seconds_sum{_format_labels([('span', span)])} {total:.6f}")
+            lines.append(f"# HELP {METRIC_PREFIX}span_seconds_max Longest single run of each step")
+            lines.append(f"# TYPE {METRIC_PREFIX}span_seconds_max gauge")
+            for span, (_, _, longest) in timings:
+                lines.append(f"{METRIC_PREFIX}span_seconds_max{_format_labels([('span', span)])} {longest:.6f}")
+
+        previous = None
+        for (name, labels), value in counters:
+            if name != previous:
+                lines.append(f"# TYPE {METRIC_PREFIX}{name} counter")
+                previous = name
+            lines.append(f"{METRIC_PREFIX}{name}{_format_labels(labels)} {value}")
+        return "\n".join(lines) + "\n" if lines else ""
+
+    def write(self, path=None):
+        """Write the metrics to path, or to TABLETALK_METRICS_PATH if it is set"""
+        path = path or os.environ.get(METRICS_PATH_ENV)
+        if not path:
+            return
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        # Replace the file in one step, so a scraper never reads half of it
+        with open(path + ".tmp", "w") as f:
+            f.write(self.prometheus_text())
+        os.replace(path + ".tmp", path)
+
+
+metrics = Metrics()
+
+
+def log_event(event, **fields):
+    """Log an event with its fields; with JSON logging on, the fields become keys of the line"""
+    if logger.isEnabledFor(logging.INFO):
+        logger.info(event, extra={"fields": fields})
+
+
+def record_span(span, seconds, **fields):
+    metrics.observe(span, seconds)
+    log_event("span", span=span, seconds=round(seconds, 6), **fields)
+
+
+@contextmanager
+def timed_span(span, **fields):
+    """Time a block as one run of span; fields are only logged"""
+    start = time.perf_counter()
+    try:
+        yield
+    except BaseException:
+        record_span(span, time.perf_counter() - start, error=True, **fields)
+        raise
+    record_span(span, time.perf_counter() - start, **fields)
+
+
+class Stopwatch:
+    """Total time of a step that runs in many short pieces, like rendering a chunk at a time"""
+
+    def __init__(self):
+        self.seconds = 0.0
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.seconds += time.perf_counter() - self._start
+
+    def record(self, span, **fields):
+        record_span(span, self.seconds, **fields)
+
+
+def timed(iterable, stopwatch):
+    """Iterate, adding the time spent producing each item to stopwatch"""
+    iterator = iter(iterable)
+    while True:
+        with stopwatch:
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+        yield item
+
+
+def record_usage(usage, **fields):
+    """Count the token usage of one batch's output by model and kind, and log it with fields"""
+    model = usage.get("model") or "unknown"
+    metrics.inc("requests_total", usage["requests"], model=model)
+    for key, kind in USAGE_KINDS.items():
+        metrics.inc("tokens_total", usage[key], model=model, kind=kind)
+    log_event("usage", **fields, **usage)
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per log line, with the event's fields as keys"""
+
+    def format(self, record):
+        entry = {
+            "time": datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname.lower(),
+            "event": record.getMessage(),
+            **getattr(record, "fields", {})
+        }
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+def configure_logging(stream=None):
+    """Log tabletalk's events as JSON lines to stream (stderr by default); calling it again does nothing"""
+    if any(isinstance(handler.formatter, JsonFormatter) for handler in logger.handlers):
+        return
+    handler = logging.StreamHandler(stream or sys.stderr)
+    handler.setFormatter(JsonFormatter())
+    logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
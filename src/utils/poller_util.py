@@ -0,0 +1,104 @@
+import threading
+import time
+
+from src.utils.cache_util import ResponseCache
+from src.utils.llm_util import check_batch_status
+from src.utils.registry_util import JobRegistry
+
+# Seconds between checks of a job: doubles each time its status is unchanged
+MIN_POLL_SECONDS = 30
+MAX_POLL_SECONDS = 30 * 60
+
+
+class JobPoller:
+    """Checks the unfinished jobs of the registry in a background thread and stores their results.
+
+    API keys are only held in memory, so a job is polled while this process
+    runs and knows its key. Each job is checked again after an interval that
+    doubles while its status stays the same, and resets when it changes.
+    Results are downloaded and stored as soon as a job finishes.
+    """
+
+    def __init__(self, registry=None, cache=None, min_interval=MIN_POLL_SECONDS, max_interval=MAX_POLL_SECONDS):
+        self.registry = registry or JobRegistry()
+        self.cache = cache or ResponseCache(self.registry.path)
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.api_keys = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+
+    def watch(self, job_id, api_key):
+        """Poll a registered job with this API key until it finishes"""
+        with self._lock:
+            self.api_keys[job_id] = api_key
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="tabletalk-poller", daemon=True)
+                self._thread.start()
+        self._wake.set()
+
+    def watching(self, job_id):
+        with self._lock:
+            return job_id in self.api_keys
+
+    def check(self, job_id):
+        """Check one job now; returns (done, results_df, batch) like check_batch_status"""
+        with self._lock:
+            api_key = self.api_keys.get(job_id)
+        job = self.registry.job(job_id, api_key)
+        interval = (job["poll_interval"] or self.min_interval) if job else self.min_interval
+        try:
+            done, results_df, batch = check_batch_status(job_id, api_key, self.cache)
+        except Exception as e:
+            # Back off on errors too, so a revoked key or outage isn't hammered
+            self.registry.set_status(job_id, None, min(interval * 2, self.max_interval), error=str(e))
+            raise
+
+        if done:
+            self.registry.save_results(job_id, results_df, batch)
+            with self._lock:
+                self.api_keys.pop(job_id, None)
+        else:
+            changed = job is None or (batch.status, batch.request_counts.completed) != (job["status"], job["completed"])
+            self.registry.set_status(job_id, batch, self.min_interval if changed else min(interval * 2, self.max_interval))
+        return done, results_df, batch
+
+    def poll_once(self):
+        """Check every watched job that is due"""
+        with self._lock:
+            job_ids = list(self.api_keys)
+        for job_id in self.registry.due_jobs(job_ids):
+            try:
+                self.check(job_id)
+            except Exception:
+                # The error is recorded with the job and it is retried later
+                continue
+
+    def _seconds_to_next_check(self):
+        with self._lock:
+            api_keys = dict(self.api_keys)
+        jobs = [self.registry.job(job_id, api_key) for job_id, api_key in api_keys.items()]
+        upcoming = [job["next_check_at"] for job in jobs if job and not job["done"]]
+        if not upcoming:
+            return None
+        return max(min(upcoming) - time.time(), 0)
+
+    def _run(self):
+        while True:
+            self._wake.clear()
+            self.poll_once()
+            self._wake.wait(timeout=self._seconds_to_next_check())
+
+
+_poller = None
+_poller_lock = threading.Lock()
+
+
+def get_poller():
+    """Return the poller shared by everything in this process"""
+    global _poller
+    with _poller_lock:
+        if _poller is None:
+            _poller = JobPoller()
+        return _poller
@@ -0,0 +1,365 @@
+import gzip
+import json
+import os
+import tempfile
+
+from pydantic import BaseModel
+
+from src.utils.job_util import DEFAULT_PROVIDER, MAX_BATCH_BYTES, MAX_BATCH_REQUESTS, RequestCounts
+
+OPENAI = DEFAULT_PROVIDER
+ANTHROPIC = "anthropic"
+
+# Tool the Anthropic models are made to call with their response
+RESPONSE_TOOL_DESCRIPTION = "Record the generated value of every field."
+
+# Copies of submitted requests for providers that don't keep them, used to build retry batches
+DEFAULT_REQUEST_ARCHIVE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "tabletalk", "requests")
+
+
+def request_archive_dir():
+    return os.environ.get("TABLETALK_REQUEST_DIR", DEFAULT_REQUEST_ARCHIVE_DIR)
+
+
+def request_archive_path(batch_id):
+    return os.path.join(request_archive_dir(), f"{batch_id}.jsonl.gz")
+
+
+def discard_request_archives(batch_ids):
+    """Delete the copies of submitted requests kept for these batches, once nothing will be retried from them"""
+    for batch_id in batch_ids:
+        try:
+            os.remove(request_archive_path(batch_id))
+        except FileNotFoundError:
+            pass
+
+
+class ProviderBatch(BaseModel):
+    """Status of a batch from a provider other than OpenAI, in the shape of an OpenAI batch"""
+    id: str
+    status: str
+    request_counts: RequestCounts
+    batch: object
+
+
+class OpenAIProvider:
+    """OpenAI Batch API: JSONL files of chat completions with a json_schema response format"""
+
+    name = OPENAI
+
+    max_batch_requests = MAX_BATCH_REQUESTS
+    max_batch_bytes = MAX_BATCH_BYTES
+
+    # Row maps are uploaded with the job, so any machine can check it
+    uploads_row_map = True
+
+    def _messages(self, prompt, system):
+        # The system prompt comes first so every request of a job shares it as a cacheable prefix
+        messages = [{"role": "system", "content": system}] if system else []
+        return messages + [{"role": "user", "content": prompt}]
+
+    def batch_request(self, custom_id, prompt, model, max_tokens, response_format, system=None):
+        """Create a single request in OpenAI batch API format"""
+        return {
+            "custom_id": custom_id,
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": {
+                "model": model,
+                "messages": self._messages(prompt, system),
+                "max_tokens": max_tokens,
+                "response_format": response_format
+            }
+        }
+
+    def with_model(self, request, model):
+        """Return a copy of a batch request addressed to another model"""
+        return {**request, "body": {**request["body"], "model": model}}
+
+    def upload_file(self, client, jsonl_file, filename):
+        """Upload a spooled JSONL file and return its file ID"""
+        with jsonl_file:
+            # The upload reads the file in chunks instead of copying it into memory
+            batch_input_file = client.files.create(
+                file=(filename, jsonl_file),
+                purpose="batch"
+            )
+        return batch_input_file.id
+
+    def create_batch(self, client, input_file_id, metadata):
+        request = client.batches.create(
+            input_file_id=input_file_id,
+            endpoint="/v1/chat/completions",
+            completion_window="24h",
+            metadata=metadata
+        )
+        return request.id
+
+    def retrieve(self, client, batch_id):
+        return client.batches.retrieve(batch_id=batch_id)
+
+    def cancel(self, client, batch_id):
+        client.batches.cancel(batch_id)
+
+    def results_ready(self, batch):
+        """Return True if the batch has an output file, which expired and cancelled batches can too"""
+        return batch.output_file_id is not None
+
+    def iter_failed(self, client, batch):
+        """Yield the custom_ids in the batch's error file"""
+        if batch.error_file_id is None:
+            return
+        with client.files.with_streaming_response.content(batch.error_file_id) as file_response:
+            for line in file_response.iter_lines():
+                if line.strip():
+                    try:
+                        yield json.loads(line)['custom_id']
+                    except Exception:
+                        continue
+
+    def iter_requests(self, client, batch):
+        """Yield the encoded request lines the batch was created from"""
+        with client.files.with_streaming_response.content(batch.input_file_id) as file_response:
+            for line in file_response.iter_lines():
+                if line.strip():
+                    yield line.encode('utf-8')
+
+    def usage(self, usage, model=None):
+        """Return the token usage of a response as a dict, or None if it has none"""
+        if not usage:
+            return None
+        details = usage.get('prompt_tokens_details') or {}
+        return {
+            "model": model,
+            "input_tokens": usage.get('prompt_tokens') or 0,
+            "cached_tokens": details.get('cached_tokens') or 0,
+            "cache_write_tokens": 0,
+            "output_tokens": usage.get('completion_tokens') or 0
+        }
+
+    def iter_results(self, client, batch, failed_ids=None):
+        """Yield (custom_id, message_content, usage) per output line; custom_id or content is None when the line is malformed.
+
+        Failed requests are listed in the error file instead, by iter_failed,
+        so failed_ids is left as it is.
+        """
+        with client.files.with_streaming_response.content(batch.output_file_id) as file_response:
+            for line in file_response.iter_lines():
+                if not line.strip():
+                    continue
+                try:
+                    response_data = json.loads(line)
+                    custom_id = response_data['custom_id']
+                except Exception:
+                    yield None, None, None
+                    continue
+                try:
+                    body = response_data['response']['body']
+                    usage = self.usage(body.get('usage'), body.get('model'))
+                except Exception:
+                    usage = None
+                try:
+                    yield custom_id, body['choices'][0]['message']['content'], usage
+                except Exception:
+                    yield custom_id, None, usage
+
+    def complete(self, client, prompt, model, max_tokens, response_format, system=None):
+        """Send one prompt right away and return (message content, token usage)"""
+        completion = client.beta.chat.completions.parse(
+            model=model,
+            messages=self._messages(prompt, system),
+            response_format=response_format,
+            max_tokens=max_tokens
+        )
+        usage = None
+        if completion.usage is not None:
+            details = getattr(completion.usage, 'prompt_tokens_details', None)
+            usage = {
+                "model": getattr(completion, 'model', None) or model,
+                "input_tokens": completion.usage.prompt_tokens or 0,
+                "cached_tokens": getattr(details, 'cached_tokens', 0) or 0,
+                "cache_write_tokens": 0,
+                "output_tokens": completion.usage.completion_tokens or 0
+            }
+        return completion.choices[0].message.content, usage
+
+
+class AnthropicProvider:
+    """Anthropic Message Batches: the response schema becomes a tool the model must call"""
+
+    name = ANTHROPIC
+
+    # Limits for a single message batch
+    max_batch_requests = 100000
+    max_batch_bytes = 240 * 1024 * 1024  # 256 MB limit, minus headroom
+
+    # Message batches carry no metadata, so row maps stay in the local cache
+    uploads_row_map = False
+
+    def _tool(self, response_format):
+        json_schema = response_format["json_schema"]
+        return {
+            "name": json_schema["name"],
+            "description": RESPONSE_TOOL_DESCRIPTION,
+            "input_schema": json_schema["schema"]
+        }
+
+    def _system(self, system):
+        # Marked as a cache breakpoint, so the tool and system prompt are cached together
+        return [{"type": "text", "text": system, "cache_control": {"type": "ephemeral"}}]
+
+    def batch_request(self, custom_id, prompt, model, max_tokens, response_format, system=None):
+        """Create a single request in Message Batches format, answered through a forced tool call"""
+        tool = self._tool(response_format)
+        params = {"model": model, "max_tokens": max_tokens}
+        if system:
+            params["system"] = self._system(system)
+        return {
+            "custom_id": custom_id,
+            "params": {
+                **params,
+                "messages": [
+                    {"role": "user", "content": prompt}
+                ],
+                "tools": [tool],
+                "tool_choice": {"type": "tool", "name": tool["name"]}
+            }
+        }
+
+    def with_model(self, request, model):
+        """Return a copy of a batch request addressed to another model"""
+        return {**request, "params": {**request["params"], "model": model}}
+
+    def upload_file(self, client, jsonl_file, filename):
+        """Message batches are created from the requests themselves, so keep the file for create_batch"""
+        return jsonl_file
+
+    def create_batch(self, client, input_file, metadata):
+        # Message batches don't keep their requests, so keep a copy to retry failed rows from.
+        # It is written as the requests are read, and named after the batch once it exists.
+        directory = request_archive_dir()
+        os.makedirs(directory, exist_ok=True)
+        requests = []
+        with input_file, tempfile.NamedTemporaryFile(dir=directory, suffix=".tmp", delete=False) as archive_file:
+            with gzip.GzipFile(fileobj=archive_file, mode="wb") as archive:
+                for line in input_file:
+                    if line.strip():
+                        archive.write(line.rstrip(b"\n") + b"\n")
+                        requests.append(json.loads(line))
+        try:
+            batch_id = client.messages.batches.create(requests=requests).id
+        except Exception:
+            os.remove(archive_file.name)
+            raise
+        os.replace(archive_file.name, request_archive_path(batch_id))
+        return batch_id
+
+    def retrieve(self, client, batch_id):
+        batch = client.messages.batches.retrieve(batch_id)
+        counts = batch.request_counts
+        failed = counts.errored + counts.canceled + counts.expired
+        if batch.processing_status == "in_progress":
+            status = "in_progress"
+        elif batch.processing_status == "canceling":
+            status = "cancelling"
+        elif counts.succeeded == 0 and counts.expired and not counts.errored:
+            status = "expired"
+        elif counts.succeeded == 0 and counts.canceled and not counts.errored:
+            status = "cancelled"
+        else:
+            status = "completed"
+        return ProviderBatch(
+            id=batch.id,
+            status=status,
+            request_counts=RequestCounts(
+                completed=counts.succeeded,
+                failed=failed,
+                total=counts.processing + counts.succeeded + failed
+            ),
+            batch=batch
+        )
+
+    def cancel(self, client, batch_id):
+        client.messages.batches.cancel(batch_id)
+
+    def results_ready(self, batch):
+        return batch.batch.processing_status == "ended"
+
+    def iter_failed(self, client, batch):
+        """Yield nothing: failed requests come with the results, and iter_results collects them in the same pass"""
+        return iter(())
+
+    def iter_requests(self, client, batch):
+        """Yield the encoded request lines kept when the batch was created"""
+        path = request_archive_path(batch.id)
+        if not os.path.exists(path):
+            return
+        with gzip.open(path, "rb") as f:
+            for line in f:
+                if line.strip():
+                    yield line.rstrip(b"\n")
+
+    def _tool_input(self, message):
+        """Return the tool call's input as JSON text, or None if the model didn't call it"""
+        for block in message.content:
+            if block.type == "tool_use":
+                return json.dumps(block.input)
+        return None
+
+    def usage(self, message):
+        """Return the token usage of a message as a dict; input_tokens includes cache reads and writes"""
+        usage = message.usage
+        cached = usage.cache_read_input_tokens or 0
+        written = usage.cache_creation_input_tokens or 0
+        return {
+            "model": message.model,
+            "input_tokens": usage.input_tokens + cached + written,
+            "cached_tokens": cached,
+            "cache_write_tokens": written,
+            "output_tokens": usage.output_tokens
+        }
+
+    def iter_results(self, client, batch, failed_ids=None):
+        """Yield (custom_id, message_content, usage) per succeeded request; content is None without a tool call.
+
+        The custom_ids of requests that errored, expired or were cancelled
+        are appended to failed_ids, so the results are only streamed once.
+        """
+        for entry in client.messages.batches.results(batch.id):
+            if entry.result.type == "succeeded":
+                message = entry.result.message
+                yield entry.custom_id, self._tool_input(message), self.usage(message)
+            elif failed_ids is not None:
+                failed_ids.append(entry.custom_id)
+
+    def complete(self, client, prompt, model, max_tokens, response_format, system=None):
+        """Send one prompt right away and return (the response as JSON text, token usage)"""
+        tool = self._tool(response_format)
+        params = {"system": self._system(system)} if system else {}
+        message = client.messages.create(
+            model=model,
+            max_tokens=max_tokens,
+            **params,
+            messages=[{"role": "user", "content": prompt}],
+            tools=[tool],
+            tool_choice={"type": "tool", "name": tool["name"]}
+        )
+        return self._tool_input(message), self.usage(message)
+
+
+PROVIDERS = {
+    OPENAI: OpenAIProvider(),
+    ANTHROPIC: AnthropicProvider(),
+}
+
+
+def get_provider(name):
+    try:
+        return PROVIDERS[name]
+    except KeyError:
+        raise ValueError(f"Unknown provider: {name}")
+
+
+def provider_for_model(model):
+    """Return the provider that serves a model: Claude models go to Anthropic, the rest to OpenAI"""
+    return get_provider(ANTHROPIC if model.startswith("claude") else OPENAI)
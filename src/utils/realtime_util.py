@@ -0,0 +1,147 @@
+import asyncio
+import random
+import time
+
+import openai
+
+# Default account limits; the transform page lets users override them
+DEFAULT_RPM = 500
+DEFAULT_TPM = 200000
+DEFAULT_CONCURRENCY = 50
+
+MAX_ATTEMPTS = 6
+BASE_BACKOFF_SECONDS = 1.0
+MAX_BACKOFF_SECONDS = 60.0
+
+# Status codes that are worth retrying
+RETRYABLE_STATUS_CODES = (408, 409, 429, 500, 502, 503, 504)
+
+
+class TokenBucket:
+    """Token bucket that refills continuously up to its capacity"""
+
+    def __init__(self, capacity, refill_per_second):
+        self.capacity = capacity
+        self.refill_per_second = refill_per_second
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.refill_per_second)
+        self.updated = now
+
+    def wait_time(self, amount):
+        """Seconds until `amount` tokens are available (0 if they are now)"""
+        self._refill()
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.refill_per_second
+
+    def take(self, amount):
+        self.tokens -= min(amount, self.capacity)
+
+
+class RateLimiter:
+    """Keeps requests under requests-per-minute and tokens-per-minute limits"""
+
+    def __init__(self, rpm=DEFAULT_RPM, tpm=DEFAULT_TPM):
+        self.requests = TokenBucket(rpm, rpm / 60)
+        self.tokens = TokenBucket(tpm, tpm / 60)
+        self.lock = asyncio.Lock()
+        self.paused_until = 0.0
+
+    async def acquire(self, tokens):
+        """Wait until one request using `tokens` tokens fits in both budgets"""
+        async with self.lock:
+            while True:
+                delay = max(
+                    self.requests.wait_time(1),
+                    self.tokens.wait_time(tokens),
+                    self.paused_until - time.monotonic()
+                )
+                if delay <= 0:
+                    break
+                await asyncio.sleep(delay)
+            self.requests.take(1)
+            self.tokens.take(tokens)
+
+    def pause(self, seconds):
+        """Hold back every request for a while, e.g. after a 429 with Retry-After"""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+def _retry_after(error):
+    """Seconds the server asked us to wait, if it said so"""
+    response = getattr(error, 'response', None)
+    if response is None:
+        return None
+    headers = response.headers
+    for header, scale in (('retry-after-ms', 0.001), ('retry-after', 1.0)):
+        value = headers.get(header)
+        if value is None:
+            continue
+        try:
+            return float(value) * scale
+        except ValueError:
+            return None
+    return None
+
+
+def _is_retryable(error):
+    if isinstance(error, (openai.APIConnectionError, openai.APITimeoutError)):
+        return True
+    return isinstance(error, openai.APIStatusError) and error.status_code in RETRYABLE_STATUS_CODES
+
+
+async def call_with_backoff(limiter, tokens, request):
+    """Run `request()` under the rate limiter, retrying transient errors.
+
+    Honors Retry-After when the server sends it and otherwise backs off
+    exponentially with full jitter.
+    """
+    for attempt in range(MAX_ATTEMPTS):
+        await limiter.acquire(tokens)
+        try:
+            return await request()
+        except Exception as e:
+            if attempt == MAX_ATTEMPTS - 1 or not _is_retryable(e):
+                raise
+            delay = _retry_after(e)
+            if delay is None:
+                delay = random.uniform(0, min(MAX_BACKOFF_SECONDS, BASE_BACKOFF_SECONDS * 2 ** attempt))
+            else:
+                # Spread retries out a little so they don't all land at once
+                delay *= random.uniform(1.0, 1.25)
+            if getattr(e, 'status_code', None) == 429:
+                limiter.pause(delay)
+            await asyncio.sleep(delay)
+
+
+class RealtimeProgress:
+    """Live counters for a real-time run"""
+
+    def __init__(self, total):
+        self.total = total
+        self.completed = 0
+        self.failed = 0
+        self.cached = 0
+        self.tokens = 0
+        self.started = time.monotonic()
+
+    @property
+    def done(self):
+        return self.completed + self.failed
+
+    @property
+    def elapsed(self):
+        return time.monotonic() - self.started
+
+    @property
+    def rows_per_second(self):
+        return self.done / self.elapsed if self.elapsed > 0 else 0.0
+
+    @property
+    def tokens_per_minute(self):
+        return self.tokens / self.elapsed * 60 if self.elapsed > 0 else 0.0
@@ -0,0 +1,229 @@
+import json
+import os
+import sqlite3
+import time
+from contextlib import closing
+
+from src.utils.cache_util import DEFAULT_CACHE_PATH, ResponseCache
+from src.utils.client_util import key_hash
+from src.utils.job_util import CACHED_JOB_PREFIX, decode_job_id
+from src.utils.provider_util import discard_request_archives
+from src.utils.result_util import read_results_file, write_results_file
+
+
+class JobRegistry:
+    """Local record of submitted jobs: their fields, row count, last known status and results.
+
+    Jobs live in the same SQLite file as the response cache. Results of
+    finished jobs are kept as Arrow files in a results folder next to it,
+    so they can be shown again without downloading anything. API keys
+    are never stored: each job keeps a hash of the key it was submitted
+    with, and is only listed or loaded for that key. The follow-up batches
+    sent for a job's failed rows, and its escalation to a stronger model,
+    are recorded here too.
+    """
+
+    def __init__(self, path=None, results_dir=None):
+        self.path = path or os.environ.get("TABLETALK_CACHE_PATH", DEFAULT_CACHE_PATH)
+        self.results_dir = results_dir or os.path.join(os.path.dirname(os.path.abspath(self.path)), "results")
+
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with closing(self._connect()) as conn, conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                "job_id TEXT PRIMARY KEY, key_hash TEXT NOT NULL, provider TEXT NOT NULL, model TEXT NOT NULL, fields TEXT NOT NULL, "
+                "rows INTEGER NOT NULL, submitted_at REAL NOT NULL, status TEXT NOT NULL, "
+                "completed INTEGER NOT NULL DEFAULT 0, failed INTEGER NOT NULL DEFAULT 0, total INTEGER NOT NULL DEFAULT 0, "
+                "checked_at REAL, next_check_at REAL NOT NULL, poll_interval REAL, result_path TEXT, error TEXT, "
+                "dataset TEXT, estimate TEXT, cascade TEXT)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS jobs_key_hash ON jobs (key_hash, submitted_at)")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS job_retries ("
+                "job_id TEXT NOT NULL, attempt INTEGER NOT NULL, retry_job_id TEXT, "
+                "PRIMARY KEY (job_id, attempt))"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS job_escalations ("
+                "job_id TEXT PRIMARY KEY, model TEXT NOT NULL, escalation_job_id TEXT)"
+            )
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def add_job(self, job_id, provider, model, field_descriptions, rows, api_key, dataset=None, estimate=None, cascade=None):
+        """Record a job submitted with api_key, with its dataset fingerprint, cost estimate and cascade settings if it has them.
+
+        The job is due for its first check right away.
+        """
+        now = time.time()
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO jobs "
+                "(job_id, key_hash, provider, model, fields, rows, submitted_at, status, next_check_at, dataset, estimate, cascade) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, 'submitted', ?, ?, ?, ?)",
+                (job_id, key_hash(api_key), provider, model, json.dumps(field_descriptions), rows, now, now, dataset,
+                 json.dumps(estimate) if estimate is not None else None,
+                 json.dumps(cascade) if cascade is not None else None)
+            )
+
+    def _job(self, row):
+        job = dict(row)
+        job["fields"] = json.loads(job["fields"])
+        job["estimate"] = json.loads(job["estimate"]) if job["estimate"] else None
+        job["cascade"] = json.loads(job["cascade"]) if job["cascade"] else None
+        job["done"] = job["result_path"] is not None
+        return job
+
+    def _get(self, job_id):
+        with closing(self._connect()) as conn:
+            row = conn.execute("SELECT * FROM jobs WHERE job_id = ?", (job_id.strip(),)).fetchone()
+        return self._job(row) if row else None
+
+    def job(self, job_id, api_key):
+        """Return the recorded job as a dict, or None if it isn't registered or was submitted with another key"""
+        job = self._get(job_id)
+        if job is None or not api_key or job["key_hash"] != key_hash(api_key):
+            return None
+        return job
+
+    def jobs(self, api_key, limit=None):
+        """Return the jobs submitted with api_key, newest first"""
+        query = "SELECT * FROM jobs WHERE key_hash = ? ORDER BY submitted_at DESC"
+        with closing(self._connect()) as conn:
+            rows = conn.execute(query + " LIMIT ?", (key_hash(api_key), limit)) if limit else conn.execute(query, (key_hash(api_key),))
+            return [self._job(row) for row in rows]
+
+    def batch_durations(self, provider, limit=20):
+        """Return the seconds from submission to results of the provider's latest finished batches.
+
+        Jobs served entirely from the local response cache never ran as
+        batches and are left out.
+        """
+        with closing(self._connect()) as conn:
+            rows = conn.execute(
+                "SELECT job_id, checked_at - submitted_at AS seconds FROM jobs "
+                "WHERE provider = ? AND result_path IS NOT NULL AND checked_at IS NOT NULL ORDER BY submitted_at DESC",
+                (provider,)
+            ).fetchall()
+        return [row["seconds"] for row in rows if CACHED_JOB_PREFIX not in row["job_id"]][:limit]
+
+    def due_jobs(self, job_ids, now=None):
+        """Return the IDs among job_ids that are unfinished and due for a check"""
+        now = time.time() if now is None else now
+        return [
+            job["job_id"] for job in map(self._get, job_ids)
+            if job is not None and not job["done"] and job["next_check_at"] <= now
+        ]
+
+    def set_status(self, job_id, batch, poll_interval, error=None):
+        """Record the status of an unfinished job and when to check it next"""
+        now = time.time()
+        counts = batch.request_counts if batch is not None else None
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                "UPDATE jobs SET status = COALESCE(?, status), completed = COALESCE(?, completed), "
+                "failed = COALESCE(?, failed), total = COALESCE(?, total), checked_at = ?, "
+                "next_check_at = ?, poll_interval = ?, error = ? WHERE job_id = ?",
+                (
+                    batch.status if batch is not None else None,
+                    counts.completed if counts else None,
+                    counts.failed if counts else None,
+                    counts.total if counts else None,
+                    now, now + poll_interval, poll_interval, error, job_id
+                )
+            )
+
+    def _results_path(self, job_id):
+        # Job IDs can contain ':' (provider prefix), which not every file system allows
+        return os.path.join(self.results_dir, job_id.replace(":", "__") + ".arrow")
+
+    def save_results(self, job_id, results_df, batch):
+        """Store the results of a finished job and mark it done.
+
+        The rows the response cache kept to build the results are dropped,
+        since the stored results replace them, and so are the copies of the
+        requests sent for the job, its retries and its escalation.
+        """
+        os.makedirs(self.results_dir, exist_ok=True)
+        path = self._results_path(job_id)
+        # Write to a temporary file first, so a reader never sees half a file
+        write_results_file(results_df, path + ".tmp")
+        os.replace(path + ".tmp", path)
+
+        counts = batch.request_counts
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                "UPDATE jobs SET status = ?, completed = ?, failed = ?, total = ?, checked_at = ?, "
+                "result_path = ?, error = NULL WHERE job_id = ?",
+                (
+                    batch.status, counts.completed if counts else 0, counts.failed if counts else 0,
+                    counts.total if counts else 0, time.time(), path, job_id
+                )
+            )
+        ResponseCache(self.path).discard_job(job_id)
+        follow_ups = [batch_id for batch_id in self.job_retries(job_id) + self.job_escalations(job_id) if batch_id]
+        discard_request_archives(shard for batch_id in [job_id, *follow_ups] for shard in decode_job_id(batch_id))
+
+    def load_results(self, job_id, api_key):
+        """Return the stored results of a finished job submitted with api_key, or None"""
+        job = self.job(job_id, api_key)
+        if job is None or not job["done"] or not os.path.exists(job["result_path"]):
+            return None
+        return read_results_file(job["result_path"])
+
+    def claim_job_retry(self, job_id, attempt):
+        """Reserve a retry attempt of a job; returns False if another check already did"""
+        with closing(self._connect()) as conn, conn:
+            cursor = conn.execute(
+                "INSERT OR IGNORE INTO job_retries (job_id, attempt, retry_job_id) VALUES (?, ?, NULL)",
+                (job_id, attempt)
+            )
+            return cursor.rowcount == 1
+
+    def set_job_retry(self, job_id, attempt, retry_job_id):
+        """Record the job submitted for a claimed retry attempt, or release the claim with None"""
+        with closing(self._connect()) as conn, conn:
+            if retry_job_id is None:
+                conn.execute("DELETE FROM job_retries WHERE job_id = ? AND attempt = ?", (job_id, attempt))
+            else:
+                conn.execute(
+                    "UPDATE job_retries SET retry_job_id = ? WHERE job_id = ? AND attempt = ?",
+                    (retry_job_id, job_id, attempt)
+                )
+
+    def job_retries(self, job_id):
+        """Return the retry job IDs of a job in attempt order; None while a retry is being submitted"""
+        with closing(self._connect()) as conn:
+            return [row["retry_job_id"] for row in conn.execute(
+                "SELECT retry_job_id FROM job_retries WHERE job_id = ? ORDER BY attempt", (job_id,)
+            )]
+
+    def claim_job_escalation(self, job_id, model):
+        """Reserve the escalation of a job to a stronger model; returns False if another check already did"""
+        with closing(self._connect()) as conn, conn:
+            cursor = conn.execute(
+                "INSERT OR IGNORE INTO job_escalations (job_id, model, escalation_job_id) VALUES (?, ?, NULL)",
+                (job_id, model)
+            )
+            return cursor.rowcount == 1
+
+    def set_job_escalation(self, job_id, escalation_job_id):
+        """Record the job submitted for a claimed escalation, or release the claim with None"""
+        with closing(self._connect()) as conn, conn:
+            if escalation_job_id is None:
+                conn.execute("DELETE FROM job_escalations WHERE job_id = ?", (job_id,))
+            else:
+                conn.execute(
+                    "UPDATE job_escalations SET escalation_job_id = ? WHERE job_id = ?", (escalation_job_id, job_id)
+                )
+
+    def job_escalations(self, job_id):
+        """Return the escalation job ID of a job in a list, empty until one is claimed; None while it is being submitted"""
+        with closing(self._connect()) as conn:
+            return [row["escalation_job_id"] for row in conn.execute(
+                "SELECT escalation_job_id FROM job_escalations WHERE job_id = ?", (job_id,)
+            )]
@@ -0,0 +1,297 @@
+import io
+import json
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from src.utils.client_util import key_hash
+from src.utils.ingest_util import iter_chunks
+
+# Finished results kept in memory for quick redisplay
+MEMO_MAX_ENTRIES = 8
+MEMO_MAX_BYTES = 1024 * 1024 * 1024
+
+# The attrs of a results dataframe travel in the Arrow schema metadata under this key
+ATTRS_METADATA_KEY = b"tabletalk.attrs"
+
+# File formats results can be exported as: (label, file extension, MIME type)
+EXPORT_FORMATS = {
+    "csv": ("CSV", "csv", "text/csv"),
+    "parquet": ("Parquet", "parquet", "application/vnd.apache.parquet"),
+    "arrow": ("Arrow", "arrow", "application/vnd.apache.arrow.file"),
+}
+
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+class ResultColumns:
+    """Accumulates parsed batch results straight into per-column arrays"""
+
+    def __init__(self):
+        self.row_numbers = []
+        self.columns = {}
+        self.numeric = {}
+        self.malformed_lines = 0
+
+    def __len__(self):
+        return len(self.row_numbers)
+
+    def add_row(self, row_number, values):
+        """Append one row given (field_name, value) pairs"""
+        position = len(self.row_numbers)
+        self.row_numbers.append(row_number)
+        for field_name, value in values:
+            column = self.columns.get(field_name)
+            if column is None:
+                # Back-fill rows seen before this field first appeared
+                column = self.columns[field_name] = [None] * position
+                self.numeric[field_name] = True
+            elif len(column) > position:
+                # Repeated field in the same row: the last value wins
+                column[position] = value
+                self.numeric[field_name] = self.numeric[field_name] and (value is None or _is_number(value))
+                continue
+            else:
+                column.extend([None] * (position - len(column)))
+            column.append(value)
+            if value is not None and not _is_number(value):
+                self.numeric[field_name] = False
+
+    def to_dataframe(self):
+        """Build a dataframe with numeric fields as int64/float64 columns and the rest as text"""
+        rows = len(self.row_numbers)
+        data = {'row_number': np.array(self.row_numbers, dtype=object)}
+        for field_name, column in self.columns.items():
+            column.extend([None] * (rows - len(column)))
+            if self.numeric[field_name]:
+                data[field_name] = pd.to_numeric(np.array(column, dtype=object))
+            else:
+                data[field_name] = np.array(column, dtype=object)
+        df = pd.DataFrame(data)
+        df.attrs['malformed_lines'] = self.malformed_lines
+        return df
+
+
+def fan_out_rows(results_df, row_map):
+    """Copy each result to the rows that shared its prompt, keeping row order.
+
+    row_map maps the custom_id that was sent to the custom_ids of its duplicates.
+    """
+    if results_df.empty or not row_map:
+        return results_df
+
+    positions = pd.Series(np.arange(len(results_df)), index=results_df['row_number'])
+    sources = []
+    row_numbers = []
+    for custom_id, duplicates in row_map.items():
+        if custom_id in positions.index:
+            sources.extend([positions[custom_id]] * len(duplicates))
+            row_numbers.extend(duplicates)
+    if not sources:
+        return results_df
+
+    copies = results_df.iloc[sources].copy()
+    copies['row_number'] = np.array(row_numbers, dtype=object)
+    attrs = dict(results_df.attrs)
+    fanned_out = pd.concat([results_df, copies], ignore_index=True)
+    fanned_out = fanned_out.sort_values(
+        'row_number',
+        key=lambda row_number: pd.to_numeric(row_number, errors='coerce'),
+        kind='stable'
+    ).reset_index(drop=True)
+    fanned_out.attrs = attrs
+    return fanned_out
+
+
+class ResultsMemo:
+    """Finished results kept in memory by batch ID and API key, so showing them again costs nothing.
+
+    Results are only returned for the key they were fetched with; the memo
+    holds a hash of it, never the key. The least recently used results are
+    evicted once there are more than max_entries of them or they take more
+    than max_bytes; the latest results are always kept. Safe to share
+    between threads.
+    """
+
+    def __init__(self, max_entries=MEMO_MAX_ENTRIES, max_bytes=MEMO_MAX_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, batch_id, api_key):
+        """Return the results of a batch fetched with api_key, or None if they aren't held"""
+        if not api_key:
+            return None
+        entry_key = (batch_id, key_hash(api_key))
+        with self._lock:
+            entry = self._entries.get(entry_key)
+            if entry is None:
+                return None
+            self._entries.move_to_end(entry_key)
+            return entry[0]
+
+    def put(self, batch_id, api_key, results_df):
+        """Hold the results of a finished batch fetched with api_key, evicting the least recently used beyond the limits"""
+        entry_key = (batch_id, key_hash(api_key))
+        size = int(results_df.memory_usage(index=True, deep=True).sum())
+        with self._lock:
+            self._entries[entry_key] = (results_df, size)
+            self._entries.move_to_end(entry_key)
+            total = sum(size for _, size in self._entries.values())
+            while len(self._entries) > 1 and (len(self._entries) > self.max_entries or total > self.max_bytes):
+                _, (_, evicted) = self._entries.popitem(last=False)
+                total -= evicted
+
+
+def _arrow_numbers(series):
+    """Arrow array of a float or integer series; whole numbers become int64"""
+    array = pa.array(series.to_numpy(dtype='float64', na_value=np.nan), from_pandas=True)
+    values = series.dropna().to_numpy(dtype='float64')
+    if len(values) and np.all(np.mod(values, 1) == 0) and np.all(np.abs(values) < 2 ** 53):
+        return array.cast(pa.int64())
+    return array
+
+
+def _text(value):
+    if value is None or (isinstance(value, float) and np.isnan(value)):
+        return None
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+def _arrow_text(series):
+    """Arrow string array of a series, with numbers written as text"""
+    try:
+        return pa.array(series, type=pa.string(), from_pandas=True)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        return pa.array(series.map(_text, na_action='ignore'), type=pa.string(), from_pandas=True)
+
+
+def _arrow_series(array, index):
+    return pd.Series(pd.arrays.ArrowExtensionArray(array), index=index)
+
+
+def coerce_results(results_df, field_types=None):
+    """Convert the result columns to Arrow-backed columns of their declared field types.
+
+    field_types maps field names to "number" or "text"; columns it doesn't
+    list stay numeric if all their values are numbers and become text
+    otherwise. Values a number field can't hold are set to null and listed
+    in attrs['invalid_values'] as {field_name: {row_number: value}}.
+    """
+    field_types = field_types or {}
+    index = results_df.index
+    row_numbers = results_df['row_number'].astype(str)
+    data = {'row_number': _arrow_series(_arrow_text(row_numbers), index)}
+    invalid_values = {}
+    for column in results_df.columns:
+        if column == 'row_number':
+            continue
+        series = results_df[column]
+        kind = field_types.get(column) or ("number" if pd.api.types.is_numeric_dtype(series) else "text")
+        if kind == "number":
+            numbers = pd.to_numeric(series, errors='coerce')
+            failed = (numbers.isna() & series.notna()).to_numpy()
+            if failed.any():
+                invalid_values[column] = dict(zip(row_numbers[failed], series[failed].map(str)))
+            data[column] = _arrow_series(_arrow_numbers(numbers), index)
+        else:
+            data[column] = _arrow_series(_arrow_text(series), index)
+
+    coerced = pd.DataFrame(data, index=index)
+    coerced.attrs = dict(results_df.attrs, invalid_values=invalid_values)
+    return coerced
+
+
+def results_table(results_df):
+    """Arrow table of a results dataframe, carrying its attrs in the schema metadata"""
+    columns = {}
+    for column in results_df.columns:
+        series = results_df[column]
+        if isinstance(series.dtype, pd.ArrowDtype):
+            columns[column] = pa.array(series.array)
+        elif series.dtype == object or pd.api.types.is_string_dtype(series):
+            # Results stored before columns were typed can mix text and numbers
+            columns[column] = _arrow_text(series)
+        else:
+            columns[column] = pa.array(series, from_pandas=True)
+    table = pa.table(columns) if columns else pa.table({'row_number': pa.array([], pa.string())})
+    attrs = json.dumps(results_df.attrs, default=str).encode('utf-8')
+    return table.replace_schema_metadata({ATTRS_METADATA_KEY: attrs})
+
+
+def results_from_table(table):
+    """Results dataframe with Arrow-backed columns and its attrs, from results_table's output"""
+    metadata = table.schema.metadata or {}
+    df = table.to_pandas(types_mapper=pd.ArrowDtype)
+    df.attrs = json.loads(metadata.get(ATTRS_METADATA_KEY, b'{}'))
+    return df
+
+
+def write_results_file(results_df, path):
+    """Store results as an Arrow IPC file"""
+    table = results_table(results_df)
+    with pa.OSFile(path, 'wb') as sink, pa.ipc.new_file(sink, table.schema) as writer:
+        writer.write_table(table)
+
+
+def read_results_file(path):
+    """Load results stored by write_results_file, memory-mapping the file"""
+    with pa.memory_map(path, 'r') as source:
+        return results_from_table(pa.ipc.open_file(source).read_all())
+
+
+def export_results(results_df, file_format):
+    """Return the results as the bytes of a CSV, Parquet or Arrow file"""
+    if file_format == "csv":
+        return results_df.to_csv(index=False).encode('utf-8')
+    buffer = io.BytesIO()
+    table = results_table(results_df)
+    if file_format == "parquet":
+        pq.write_table(table, buffer)
+    elif file_format == "arrow":
+        with pa.ipc.new_file(buffer, table.schema) as writer:
+            writer.write_table(table)
+    else:
+        raise ValueError(f"Unknown export format: {file_format}")
+    return buffer.getvalue()
+
+
+def join_results(source, results_df):
+    """Merge the results onto the source table, row by row.
+
+    Each result's row_number is the index label of the source row it was
+    generated from, so results are matched to rows by label and their
+    columns taken over in one vectorized step. Source rows without a result
+    get nulls, and result columns replace source columns of the same name.
+    attrs['unmatched_results'] counts results that match no source row.
+    """
+    if not isinstance(source, pd.DataFrame):
+        # A Dataset is read whole to hold the joined columns
+        source = pd.concat(list(iter_chunks(source)))
+    labels = pd.Index(source.index.astype(str))
+    if not labels.is_unique:
+        raise ValueError("The source table has duplicate index labels, so results can't be matched to its rows")
+
+    positions = labels.get_indexer(results_df['row_number'].astype(str))
+    matched = positions >= 0
+    # For every source row, the position of its result, or null
+    result_rows = np.full(len(source), -1, dtype=np.int64)
+    result_rows[positions[matched]] = np.flatnonzero(matched)
+    take = pa.array(result_rows, mask=result_rows < 0)
+
+    table = results_table(results_df)
+    joined = source.copy(deep=False)
+    for column in table.column_names:
+        if column != 'row_number':
+            joined[column] = _arrow_series(table.column(column).take(take), source.index)
+    joined.attrs = dict(results_df.attrs, unmatched_results=int((~matched).sum()))
+    return joined
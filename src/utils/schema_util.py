@@ -0,0 +1,152 @@
+import json
+import re
+
+# Property names the providers accept in a response schema
+_INVALID_PROPERTY_CHARS = re.compile(r'[^a-zA-Z0-9_.-]')
+MAX_PROPERTY_LENGTH = 64
+
+REASONING_PROPERTY = "reasoning"
+ROW_ID_PROPERTY = "row_id"
+CONFIDENCE_PROPERTY = "confidence"
+
+# Result column holding the model's confidence; it isn't a field of the job
+CONFIDENCE_COLUMN = "_confidence"
+
+# Completion tokens allowed for one value of each field type, for the
+# reasoning, for each property's key and punctuation, and per packed row
+VALUE_TOKENS = {"number": 16, "text": 384}
+REASONING_TOKENS = 512
+CONFIDENCE_TOKENS = 8
+PROPERTY_OVERHEAD_TOKENS = 6
+ROW_OVERHEAD_TOKENS = 12
+MAX_COMPLETION_TOKENS = 16384
+
+
+def _property_name(field_name, taken):
+    """Turn a field name into a unique property name the providers accept"""
+    base = _INVALID_PROPERTY_CHARS.sub('_', str(field_name))[:MAX_PROPERTY_LENGTH] or 'field'
+    name = base
+    suffix = 2
+    while name in taken:
+        name = f"{base[:MAX_PROPERTY_LENGTH - len(str(suffix)) - 1]}_{suffix}"
+        suffix += 1
+    return name
+
+
+class ResponseSchema:
+    """Response schema generated per job: one typed property per field.
+
+    Number fields are declared as numbers and text fields as strings, so the
+    model can't answer with anything but the job's fields. A free-text
+    reasoning property, written before the values, is only asked for when
+    reasoning is on, and a confidence between 0 and 1, written after them,
+    when confidence is. Field names that aren't valid property names are
+    rewritten; keys maps every property back to its field.
+    """
+
+    def __init__(self, field_descriptions, reasoning=False, confidence=False):
+        self.field_descriptions = field_descriptions
+        self.reasoning = reasoning
+        self.confidence = confidence
+
+        taken = {REASONING_PROPERTY, ROW_ID_PROPERTY, CONFIDENCE_PROPERTY}
+        self.keys = {}
+        self.properties = {}
+        for field in field_descriptions:
+            key = _property_name(field['field_name'], taken)
+            taken.add(key)
+            self.keys[key] = field['field_name']
+            self.properties[key] = {"type": "number" if field.get('data_type') == 'number' else "string"}
+            if key != field['field_name']:
+                # Tell the model which field a rewritten property stands for
+                self.properties[key]["description"] = field['field_name']
+
+    @classmethod
+    def for_field_names(cls, field_names):
+        """Schema for parsing the responses of a job whose field names are all that is known"""
+        return cls([{"field_name": field_name} for field_name in field_names])
+
+    def row_schema(self):
+        """Schema of the object holding one row's values"""
+        properties = {REASONING_PROPERTY: {"type": "string"}} if self.reasoning else {}
+        properties.update(self.properties)
+        if self.confidence:
+            properties[CONFIDENCE_PROPERTY] = {"type": "number", "minimum": 0, "maximum": 1}
+        return {
+            "type": "object",
+            "properties": properties,
+            "required": list(properties),
+            "additionalProperties": False
+        }
+
+    def response_format(self, packed=False):
+        """Structured output format shared by every request of the job"""
+        if not packed:
+            return {
+                "type": "json_schema",
+                "json_schema": {"name": "response", "schema": self.row_schema(), "strict": True}
+            }
+
+        # One entry per row, each tagged with its row_id
+        row_schema = self.row_schema()
+        row_schema["properties"] = {ROW_ID_PROPERTY: {"type": "string"}, **row_schema["properties"]}
+        row_schema["required"] = [ROW_ID_PROPERTY, *row_schema["required"]]
+        return {
+            "type": "json_schema",
+            "json_schema": {
+                "name": "packed_response",
+                "schema": {
+                    "type": "object",
+                    "properties": {"rows": {"type": "array", "items": row_schema}},
+                    "required": ["rows"],
+                    "additionalProperties": False
+                },
+                "strict": True
+            }
+        }
+
+    def max_tokens(self, pack_size=1):
+        """Completion tokens to allow a request carrying pack_size rows"""
+        row_tokens = sum(
+            VALUE_TOKENS.get(field.get('data_type'), VALUE_TOKENS['text']) + PROPERTY_OVERHEAD_TOKENS + len(key) // 4
+            for key, field in zip(self.keys, self.field_descriptions)
+        )
+        if self.reasoning:
+            row_tokens += REASONING_TOKENS + PROPERTY_OVERHEAD_TOKENS
+        if self.confidence:
+            row_tokens += CONFIDENCE_TOKENS + PROPERTY_OVERHEAD_TOKENS
+        if pack_size and pack_size > 1:
+            return min((row_tokens + ROW_OVERHEAD_TOKENS) * pack_size + ROW_OVERHEAD_TOKENS, MAX_COMPLETION_TOKENS)
+        return min(row_tokens + ROW_OVERHEAD_TOKENS, MAX_COMPLETION_TOKENS)
+
+    def values(self, row):
+        """Return [(field_name, value)] for one parsed row object, or None if it isn't one.
+
+        Properties that aren't fields of the job are dropped, except the
+        confidence, which comes last as CONFIDENCE_COLUMN. Rows in the
+        earlier {"responses": [{"field_name", "reasoning", "value"}]} layout,
+        from jobs submitted before schemas were generated per job, are read too.
+        """
+        if not isinstance(row, dict):
+            return None
+        if "responses" in row and "responses" not in self.keys.values():
+            if not isinstance(row["responses"], list):
+                return None
+            try:
+                return [(response["field_name"], response["value"]) for response in row["responses"]]
+            except (TypeError, KeyError):
+                return None
+
+        values = []
+        for key, value in row.items():
+            if key in (REASONING_PROPERTY, ROW_ID_PROPERTY, CONFIDENCE_PROPERTY) or (self.keys and key not in self.keys):
+                continue
+            if isinstance(value, (dict, list)):
+                value = json.dumps(value)
+            values.append((self.keys.get(key, key), value))
+        if self.keys and not values:
+            # None of the job's fields came back
+            return None
+        if CONFIDENCE_PROPERTY in row:
+            values.append((CONFIDENCE_COLUMN, row[CONFIDENCE_PROPERTY]))
+        return values
@@ -0,0 +1,146 @@
+import json
+import os
+from functools import lru_cache
+from json.encoder import encode_basestring
+
+import pandas as pd
+
+from src.utils.ingest_util import iter_chunks
+
+FIELD_DESCRIPTIONS_MARKER = '{{FIELD_DESCRIPTIONS}}'
+
+ROW_DATA_NOTE = """
+
+The row to process is given in the user message as a JSON object of column values. Every @column in the field descriptions stands for the value of that column in the row."""
+
+REASONING_NOTE = """
+
+Before the values, write a short "reasoning" explaining how you arrived at them."""
+
+CONFIDENCE_NOTE = """
+
+After the values, give your "confidence" that they are all correct, from 0 (a guess) to 1 (certain)."""
+
+PACKING_NOTE = """
+
+The user message holds several rows, each inside a <row> tag with its own JSON object of column values. Process every row independently and return one entry per row in "rows", with "row_id" set to the id of the row."""
+
+# Budgets used to choose how many rows go into one packed request
+MAX_PACK_SIZE = 50
+PACK_INPUT_TOKENS = 32000
+PACK_OUTPUT_TOKENS = 12000
+OUTPUT_TOKENS_PER_FIELD = 40
+OUTPUT_TOKENS_PER_REASONING = 120
+CHARS_PER_TOKEN = 4
+
+# instructions.txt at the repository root, wherever the app or CLI is started from
+PROMPT_TEMPLATE_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), 'instructions.txt')
+
+
+@lru_cache(maxsize=None)
+def load_prompt_template(path=PROMPT_TEMPLATE_PATH):
+    """Read the prompt template once per process"""
+    with open(path, 'r') as f:
+        return f.read()
+
+
+def _to_text(value):
+    """Convert a cell to text the same way the row-by-row renderer did"""
+    return str(value.item() if hasattr(value, 'item') else value)
+
+
+class PromptTemplate:
+    """Prompt layout compiled once per job: a static system prompt and a small data block per row.
+
+    The system prompt carries the instructions and every field description
+    with its @column references left in place, so it is the same for every
+    request of a job and the provider can serve it from its prompt cache.
+    Each row only contributes a JSON object with the values of the columns
+    the fields reference. With reasoning, the model is asked to explain its
+    values first; with confidence, to rate how sure it is of them.
+    """
+
+    def __init__(self, field_descriptions, columns, prompt_template=None, reasoning=False, confidence=False):
+        if prompt_template is None:
+            prompt_template = load_prompt_template()
+
+        self.columns = list(columns)
+        self.field_descriptions = field_descriptions
+        self.system = prompt_template.replace(
+            FIELD_DESCRIPTIONS_MARKER, json.dumps(field_descriptions, indent=2)
+        ) + ROW_DATA_NOTE + (REASONING_NOTE if reasoning else '') + (CONFIDENCE_NOTE if confidence else '')
+
+        # Columns a field mentions go into the data block
+        self.data_columns = [
+            col for col in dict.fromkeys(self.columns)
+            if any(f'@{col}' in field['instructions'] for field in field_descriptions)
+        ]
+        keys = [encode_basestring(str(col)) for col in self.data_columns]
+        self.data_literals = ['{' + keys[0] + ': '] + [', ' + key + ': ' for key in keys[1:]] + ['}'] if keys else ['{}']
+
+    def _encode_column(self, df, col):
+        """Encode a column's values as JSON strings, with missing values as null"""
+        series = df[col]
+        if isinstance(series, pd.DataFrame):
+            # Duplicate column names: use the first of them
+            series = series.iloc[:, 0]
+        values = series.to_numpy(dtype=object)
+        missing = pd.isna(values).tolist()
+        return [
+            'null' if is_missing else encode_basestring(_to_text(value))
+            for value, is_missing in zip(values.tolist(), missing)
+        ]
+
+    def render(self, df):
+        """Return the data block of every row of the dataframe, in row order"""
+        literals = self.data_literals
+        if len(literals) == 1:
+            return [literals[0]] * len(df)
+
+        blocks = []
+        for row in zip(*(self._encode_column(df, col) for col in self.data_columns)):
+            block = literals[0]
+            for value, literal in zip(row, literals[1:]):
+                block += value + literal
+            blocks.append(block)
+        return blocks
+
+    def iter_render(self, df, chunk_size=5000):
+        """Yield (index, data_blocks) for consecutive row chunks of the dataframe or dataset"""
+        for chunk in iter_chunks(df, chunk_size):
+            yield chunk.index, self.render(chunk)
+
+
+class PackedPromptTemplate:
+    """Renders prompts that carry the data of several rows.
+
+    The system prompt appears once per request and each row contributes
+    only its data block, wrapped in a <row> tag.
+    """
+
+    def __init__(self, field_descriptions, columns, prompt_template=None, reasoning=False, confidence=False):
+        self.rows = PromptTemplate(field_descriptions, columns, prompt_template, reasoning, confidence)
+        self.field_count = len(field_descriptions)
+        self.reasoning = reasoning
+        self.system = self.rows.system + PACKING_NOTE
+
+    def iter_render(self, df, chunk_size=5000):
+        """Yield (index, data_blocks) for consecutive row chunks of the dataframe"""
+        return self.rows.iter_render(df, chunk_size)
+
+    def render_pack(self, rows):
+        """Render the user message for a list of (row_id, data_block) pairs"""
+        return '\n'.join(f'<row id={json.dumps(row_id)}>{block}</row>' for row_id, block in rows)
+
+    def choose_pack_size(self, df, sample_rows=200):
+        """Pick the number of rows per request that fits the input and output token budgets"""
+        sample = df.head(sample_rows)
+        if len(sample) == 0:
+            return 1
+        blocks = self.rows.render(sample)
+        block_tokens = max(len(block) for block in blocks) / CHARS_PER_TOKEN
+        system_tokens = len(self.system) / CHARS_PER_TOKEN
+        by_input = (PACK_INPUT_TOKENS - system_tokens) // max(block_tokens, 1)
+        row_output_tokens = OUTPUT_TOKENS_PER_FIELD * self.field_count + (OUTPUT_TOKENS_PER_REASONING if self.reasoning else 0)
+        by_output = PACK_OUTPUT_TOKENS // max(row_output_tokens, 1)
+        return int(max(1, min(MAX_PACK_SIZE, by_input, by_output)))
@@ -0,0 +1,87 @@
+import re
+
+import pandas as pd
+
+from src.utils.schema_util import CONFIDENCE_COLUMN
+
+# Optional keys of a field description that its values are checked against
+CONSTRAINT_KEYS = ("pattern", "minimum", "maximum", "allowed_values")
+
+
+def field_constraints(field):
+    """Return the constraints set on a field description"""
+    return {key: field[key] for key in CONSTRAINT_KEYS if field.get(key) not in (None, "", [])}
+
+
+def check_constraints(field_descriptions):
+    """Raise ValueError if a field's constraints can't be applied to its values"""
+    for field in field_descriptions:
+        constraints = field_constraints(field)
+        name = field["field_name"]
+        if "pattern" in constraints:
+            try:
+                re.compile(constraints["pattern"])
+            except re.error as e:
+                raise ValueError(f"The pattern of {name} isn't a valid regular expression: {e}")
+        for key in ("minimum", "maximum"):
+            if key in constraints and not isinstance(constraints[key], (int, float)):
+                raise ValueError(f"The {key} of {name} must be a number")
+        if "minimum" in constraints and "maximum" in constraints and constraints["minimum"] > constraints["maximum"]:
+            raise ValueError(f"The minimum of {name} is above its maximum")
+        if "allowed_values" in constraints and not isinstance(constraints["allowed_values"], list):
+            raise ValueError(f"The allowed values of {name} must be a list")
+
+
+def failing_rows(results_df, field_descriptions, min_confidence=None):
+    """Return the reason each row fails its checks, as a Series indexed by row_number.
+
+    A row fails when one of its fields has no value, a number field's value
+    isn't a number, a value breaks its field's pattern, range or allowed
+    values, or the model's confidence is below min_confidence. Only the
+    first reason found for a row is kept; rows that pass aren't listed.
+    """
+    reasons = pd.Series(None, index=results_df.index, dtype=object)
+
+    def flag(mask, reason):
+        reasons[mask & reasons.isna()] = reason
+
+    for field in field_descriptions:
+        name = field["field_name"]
+        if name not in results_df:
+            flag(pd.Series(True, index=results_df.index), f"{name}: missing")
+            continue
+        values = results_df[name]
+        present = values.notna()
+        flag(~present, f"{name}: missing")
+
+        constraints = field_constraints(field)
+        numbers = None
+        if field.get("data_type") == "number" or "minimum" in constraints or "maximum" in constraints:
+            numbers = pd.to_numeric(values, errors="coerce")
+            flag(present & numbers.isna(), f"{name}: not a number")
+        if "minimum" in constraints:
+            flag(numbers < constraints["minimum"], f"{name}: below {constraints['minimum']}")
+        if "maximum" in constraints:
+            flag(numbers > constraints["maximum"], f"{name}: above {constraints['maximum']}")
+
+        text = values[present].astype(str).str.strip()
+        if "pattern" in constraints:
+            matches = text.str.fullmatch(constraints["pattern"]).reindex(values.index, fill_value=True)
+            flag(~matches.astype(bool), f"{name}: doesn't match the pattern")
+        if "allowed_values" in constraints:
+            allowed = constraints["allowed_values"]
+            if field.get("data_type") == "number":
+                allowed_values = numbers.isin(pd.to_numeric(pd.Series(allowed), errors="coerce").dropna())
+            else:
+                allowed_values = text.isin([str(value).strip() for value in allowed]).reindex(values.index, fill_value=True)
+            flag(present & ~allowed_values, f"{name}: not an allowed value")
+
+    if min_confidence is not None:
+        if CONFIDENCE_COLUMN in results_df:
+            confidence = pd.to_numeric(results_df[CONFIDENCE_COLUMN], errors="coerce")
+        else:
+            confidence = pd.Series(float("nan"), index=results_df.index)
+        flag(confidence.isna() | (confidence < min_confidence), "low confidence")
+
+    reasons.index = results_df["row_number"]
+    return reasons.dropna()
@@ -0,0 +1,314 @@
+"""Command-line interface for running TableTalk transformations without Streamlit.
+
+Run from the repository root:
+
+    python -m tabletalk estimate tabletalk_config.json data.csv
+    python -m tabletalk test tabletalk_config.json data.csv --rows 20
+    python -m tabletalk submit tabletalk_config.json data.csv
+    python -m tabletalk status <batch_id>
+    python -m tabletalk fetch <batch_id> -o results.parquet --wait
+    python -m tabletalk fetch <batch_id> --join data.csv -o joined.parquet
+    python -m tabletalk jobs
+
+Claude models (--model claude-...) run as Anthropic message batches.
+--log-json logs timings and token usage as JSON lines, and --metrics-file
+writes them in the Prometheus text format.
+"""
+import argparse
+import datetime
+import json
+import os
+import sys
+
+from src.utils.ingest_util import SUPPORTED_FILE_TYPES
+from src.utils.job_util import job_provider
+from src.utils.provider_util import ANTHROPIC, provider_for_model
+from src.utils.metrics_util import METRICS_PATH_ENV, configure_logging
+from src.utils.llm_util import DEFAULT_TEST_ROWS
+from src.utils.realtime_util import DEFAULT_CONCURRENCY
+from tabletalk.api import estimate, fetch, join, jobs, load_config, read_input, status, submit, test_run, usage_report, write_results
+
+# The Streamlit app's secrets, at the repository root
+SECRETS_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), ".streamlit", "secrets.toml")
+DEFAULT_POLL_SECONDS = 60
+
+# Environment variables holding each provider's API key
+API_KEY_ENV = {"openai": "OPENAI_API_KEY", ANTHROPIC: "ANTHROPIC_API_KEY"}
+
+# Exit code of `status` and `fetch` while the batch is still running
+EXIT_NOT_DONE = 3
+
+
+def resolve_model(model):
+    """Use --model, then TABLETALK_MODEL, then MODEL from the Streamlit secrets file"""
+    if model:
+        return model
+    if os.environ.get("TABLETALK_MODEL"):
+        return os.environ["TABLETALK_MODEL"]
+    if os.path.exists(SECRETS_PATH):
+        import tomllib
+        with open(SECRETS_PATH, "rb") as f:
+            model = tomllib.load(f).get("MODEL")
+        if model:
+            return model
+    raise SystemExit("No model configured: pass --model or set TABLETALK_MODEL")
+
+
+def resolve_api_key(api_key, provider):
+    """Use --api-key, then the provider's API key environment variable"""
+    api_key = api_key or os.environ.get(API_KEY_ENV[provider])
+    if not api_key:
+        raise SystemExit(f"No API key: pass --api-key or set {API_KEY_ENV[provider]}")
+    return api_key
+
+
+def report_result_warnings(df):
+    malformed_lines = df.attrs.get("malformed_lines", 0)
+    if malformed_lines:
+        print(f"warning: {malformed_lines:,} responses could not be parsed", file=sys.stderr)
+    failed_rows = df.attrs.get("failed_rows", [])
+    if failed_rows:
+        print(f"warning: {len(failed_rows):,} rows have no results after retrying", file=sys.stderr)
+    cascade = df.attrs.get("cascade")
+    if cascade and (cascade["escalated"] or cascade.get("not_escalated")):
+        print(
+            f"cascade: {cascade['escalated']:,} rows escalated to {cascade['model']}, "
+            f"{cascade['still_failing']:,} still fail their checks",
+            file=sys.stderr
+        )
+    if cascade and cascade.get("not_escalated"):
+        print(
+            f"warning: {cascade['not_escalated']:,} rows that fail their checks came from the response cache "
+            f"and weren't escalated",
+            file=sys.stderr
+        )
+    for field_name, values in df.attrs.get("invalid_values", {}).items():
+        print(f"warning: {len(values):,} values of {field_name} aren't numbers and were left empty", file=sys.stderr)
+    usage = df.attrs.get("usage")
+    if usage and usage["input_tokens"]:
+        from src.utils.estimate_util import prompt_cache_report
+
+        report = prompt_cache_report(usage)
+        print(
+            f"prompt cache: {report['hit_rate']:.0%} of {usage['input_tokens']:,} input tokens cached, "
+            f"saved ${report['savings']:.4f}",
+            file=sys.stderr
+        )
+
+
+def report_usage(batch_id, df, api_key):
+    """Print the job's actual requests, tokens and cost next to what was estimated at submission"""
+    comparison = usage_report(batch_id, df, api_key)
+    if not comparison:
+        return
+    for row in comparison:
+        measure = row["measure"]
+        difference = f" ({row['difference']:+.0%})" if row["difference"] is not None else ""
+        print(
+            f"{measure.replace('_', ' ')}: {format_amount(measure, row['actual'])} actual, "
+            f"{format_amount(measure, row['estimated'])} estimated{difference}",
+            file=sys.stderr
+        )
+
+
+def format_amount(measure, amount):
+    return f"${amount:.4f}" if measure == "cost" else f"{amount:,}"
+
+
+def command_estimate(args):
+    df = read_input(args.input, args.input_type)
+    print(json.dumps(estimate(df, load_config(args.config), resolve_model(args.model), args.reasoning), indent=2))
+
+
+def command_submit(args):
+    from src.utils.cache_util import ResponseCache
+
+    if args.min_confidence is not None and not args.escalate_to:
+        raise SystemExit("--min-confidence needs --escalate-to")
+    df = read_input(args.input, args.input_type)
+    model = resolve_model(args.model)
+    field_descriptions = load_config(args.config)
+    batch_id, stats = submit(
+        resolve_api_key(args.api_key, provider_for_model(model).name),
+        df,
+        field_descriptions,
+        model,
+        pack_size=args.pack_size if args.pack_size == "auto" else int(args.pack_size),
+        cache=ResponseCache(path=args.cache_path) if args.cache_path else None,
+        incremental=not args.full,
+        reasoning=args.reasoning,
+        estimate=estimate(df, field_descriptions, model, args.reasoning) if args.estimate else None,
+        escalate_to=args.escalate_to,
+        min_confidence=args.min_confidence
+    )
+    print(json.dumps(stats), file=sys.stderr)
+    print(batch_id)
+
+
+def command_test(args):
+    df = read_input(args.input, args.input_type)
+    model = resolve_model(args.model)
+    field_descriptions = load_config(args.config)
+    if args.stratify_by is not None and args.stratify_by not in df.columns:
+        raise SystemExit(f"No column named {args.stratify_by} to stratify by")
+    rows_df, projection = test_run(
+        resolve_api_key(args.api_key, provider_for_model(model).name),
+        df,
+        field_descriptions,
+        model,
+        rows=args.rows,
+        stratify_by=args.stratify_by,
+        concurrency=args.concurrency,
+        reasoning=args.reasoning
+    )
+    for request in rows_df.attrs["requests"]:
+        if request["error"]:
+            print(f"warning: a test request failed: {request['error']}", file=sys.stderr)
+    rows_df.to_csv(sys.stdout, index=False)
+    for row in projection:
+        print(
+            f"{row['mode']}: ${row['cost']:.4f} (${row['cost_low']:.4f} to ${row['cost_high']:.4f}) "
+            f"for {row['requests']:,} requests, about {datetime.timedelta(seconds=round(row['wall_seconds']))} "
+            f"({row['limited_by']})",
+            file=sys.stderr
+        )
+
+
+def command_status(args):
+    batch = status(args.batch_id, resolve_api_key(args.api_key, job_provider(args.batch_id)))
+    request_counts = batch.request_counts
+    print(json.dumps({
+        "id": args.batch_id,
+        "status": batch.status,
+        "completed": request_counts.completed if request_counts else None,
+        "failed": request_counts.failed if request_counts else None,
+        "total": request_counts.total if request_counts else None
+    }))
+    if batch.status != "completed":
+        return EXIT_NOT_DONE
+
+
+def command_fetch(args):
+    # Stored results are only returned for the key the job was submitted with
+    api_key = resolve_api_key(args.api_key, job_provider(args.batch_id))
+    done, df, batch = fetch(
+        args.batch_id,
+        api_key,
+        wait=args.wait,
+        poll_interval=args.poll_interval,
+        on_poll=lambda batch: print(f"{batch.status}; checking again in {args.poll_interval}s", file=sys.stderr)
+    )
+    if not done:
+        print(f"Batch is not finished yet (status: {batch.status})", file=sys.stderr)
+        return EXIT_NOT_DONE
+    if df is None:
+        print(f"Batch ended without results (status: {batch.status})", file=sys.stderr)
+        return 1
+
+    report_result_warnings(df)
+    report_usage(args.batch_id, df, api_key)
+    if args.join:
+        df = join(read_input(args.join, args.input_type), df)
+        if df.attrs["unmatched_results"]:
+            print(f"warning: {df.attrs['unmatched_results']:,} results match no row of {args.join}", file=sys.stderr)
+    write_results(df, args.output)
+
+
+def command_jobs(args):
+    if args.api_key:
+        api_keys = [args.api_key]
+    else:
+        api_keys = [os.environ[name] for name in API_KEY_ENV.values() if os.environ.get(name)]
+    if not api_keys:
+        raise SystemExit(f"No API key: pass --api-key or set {' or '.join(API_KEY_ENV.values())}")
+    # Jobs of every key, newest first
+    listed = sorted((job for api_key in api_keys for job in jobs(api_key, args.limit)), key=lambda job: job["submitted_at"], reverse=True)
+    for job in listed[:args.limit]:
+        print(json.dumps({
+            "id": job["job_id"],
+            "submitted_at": datetime.datetime.fromtimestamp(job["submitted_at"]).isoformat(timespec="seconds"),
+            "model": job["model"],
+            "rows": job["rows"],
+            "fields": [field["field_name"] for field in job["fields"]],
+            "status": job["status"],
+            "completed": job["completed"],
+            "failed": job["failed"],
+            "total": job["total"],
+            "results_stored": job["done"]
+        }))
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="tabletalk", description="Transform tabular data with natural language instructions")
+    parser.add_argument("--log-json", action="store_true", help="Log timings and token usage to stderr as JSON lines")
+    parser.add_argument("--metrics-file", help=f"Write timings and token counts to this file in the Prometheus text format (default: {METRICS_PATH_ENV})")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    def add_input_arguments(subparser):
+        subparser.add_argument("config", help="tabletalk_config.json from the Download Configuration button")
+        subparser.add_argument("input", help="CSV, Excel or Parquet file, or '-' to read from stdin")
+        subparser.add_argument("--input-type", choices=SUPPORTED_FILE_TYPES, help="Input format (default: from the file name, csv for stdin)")
+        subparser.add_argument("--model", help="Model name (default: TABLETALK_MODEL or MODEL in .streamlit/secrets.toml)")
+        subparser.add_argument("--reasoning", action="store_true", help="Ask the model to explain its values before giving them (more output tokens)")
+
+    estimate_parser = subparsers.add_parser("estimate", help="Estimate tokens and cost without calling the API")
+    add_input_arguments(estimate_parser)
+    estimate_parser.set_defaults(handler=command_estimate)
+
+    test_parser = subparsers.add_parser("test", help="Transform a sample of rows right away and project the full run's cost and time")
+    add_input_arguments(test_parser)
+    test_parser.add_argument("--api-key", help="API key (default: OPENAI_API_KEY, or ANTHROPIC_API_KEY for Claude models)")
+    test_parser.add_argument("--rows", type=int, default=DEFAULT_TEST_ROWS, help=f"Rows to sample (default: {DEFAULT_TEST_ROWS})")
+    test_parser.add_argument("--stratify-by", metavar="COLUMN", help="Sample rows in proportion to the values of this column")
+    test_parser.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY, help=f"Requests sent at the same time (default: {DEFAULT_CONCURRENCY})")
+    test_parser.set_defaults(handler=command_test)
+
+    submit_parser = subparsers.add_parser("submit", help="Submit a batch and print its batch ID")
+    add_input_arguments(submit_parser)
+    submit_parser.add_argument("--api-key", help="API key (default: OPENAI_API_KEY, or ANTHROPIC_API_KEY for Claude models)")
+    submit_parser.add_argument("--pack-size", default="1", help="Rows per request, or 'auto' (default: 1)")
+    submit_parser.add_argument("--cache-path", help="Response cache file (default: TABLETALK_CACHE_PATH or ~/.cache/tabletalk)")
+    submit_parser.add_argument("--full", action="store_true", help="Regenerate every field, even those with stored results for this data")
+    submit_parser.add_argument("--escalate-to", metavar="MODEL", help="Send rows that fail their checks to this stronger model once --model is done")
+    submit_parser.add_argument("--min-confidence", type=float, help="With --escalate-to, also escalate rows the model is less sure of than this (0 to 1)")
+    submit_parser.add_argument("--estimate", action="store_true", help="Estimate tokens and cost to compare the job's actual usage with (downloads the tokenizer on first use)")
+    submit_parser.set_defaults(handler=command_submit)
+
+    status_parser = subparsers.add_parser("status", help=f"Print the status of a batch (exit code {EXIT_NOT_DONE} while it runs)")
+    status_parser.add_argument("batch_id")
+    status_parser.add_argument("--api-key", help="API key (default: OPENAI_API_KEY, or ANTHROPIC_API_KEY for anthropic: batch IDs)")
+    status_parser.set_defaults(handler=command_status)
+
+    fetch_parser = subparsers.add_parser("fetch", help="Download the results of a finished batch")
+    fetch_parser.add_argument("batch_id")
+    fetch_parser.add_argument("-o", "--output", default="-", help="Output .csv, .parquet or .arrow file, or '-' for CSV on stdout")
+    fetch_parser.add_argument("--join", metavar="INPUT", help="Add the results as columns of the input file they were generated from")
+    fetch_parser.add_argument("--input-type", choices=SUPPORTED_FILE_TYPES, help="Format of the --join file (default: from the file name)")
+    fetch_parser.add_argument("--api-key", help="API key (default: OPENAI_API_KEY, or ANTHROPIC_API_KEY for anthropic: batch IDs)")
+    fetch_parser.add_argument("--wait", action="store_true", help="Poll until the batch finishes")
+    fetch_parser.add_argument("--poll-interval", type=int, default=DEFAULT_POLL_SECONDS, help="Seconds between polls with --wait")
+    fetch_parser.set_defaults(handler=command_fetch)
+
+    jobs_parser = subparsers.add_parser("jobs", help="List the jobs submitted from this machine with your API keys, newest first")
+    jobs_parser.add_argument("--limit", type=int, help="Show only this many jobs")
+    jobs_parser.add_argument("--api-key", help="List the jobs of this key (default: those of OPENAI_API_KEY and ANTHROPIC_API_KEY)")
+    jobs_parser.set_defaults(handler=command_jobs)
+
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    if args.log_json:
+        configure_logging()
+    if args.metrics_file:
+        os.environ[METRICS_PATH_ENV] = args.metrics_file
+    try:
+        return args.handler(args) or 0
+    except Exception as e:
+        print(f"error: {e}", file=sys.stderr)
+        return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
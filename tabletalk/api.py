@@ -0,0 +1,152 @@
+"""Python API for running TableTalk transformations without Streamlit."""
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from src.utils.ingest_util import load_dataset
+from src.utils.job_util import JobStatus, RequestCounts
+from src.utils.llm_util import DEFAULT_TEST_ROWS, apply_test_run, apply_transformation, check_batch_status, get_batch_status
+from src.utils.provider_util import provider_for_model
+from src.utils.realtime_util import DEFAULT_CONCURRENCY, DEFAULT_RPM, DEFAULT_TPM
+from src.utils.registry_util import JobRegistry
+from src.utils.result_util import export_results, join_results
+from src.utils.validation_util import CONSTRAINT_KEYS
+
+
+def load_config(path):
+    """Read a tabletalk_config.json into the field descriptions used by llm_util, constraints included"""
+    with open(path, "r") as f:
+        config_data = json.load(f)
+    return [
+        {
+            "field_name": col["name"],
+            "instructions": col["instructions"],
+            "data_type": col.get("field_type", "text"),
+            **{key: col[key] for key in CONSTRAINT_KEYS if col.get(key) not in (None, "", [])}
+        }
+        for col in config_data["columns"]
+    ]
+
+
+def read_input(path, file_type=None):
+    """Load the input dataset from a file, or from stdin when path is '-'"""
+    if path != "-":
+        with open(path, "rb") as f:
+            return load_dataset(f, file_type)
+
+    # Spool stdin to disk so the loader can make more than one pass over it
+    with tempfile.TemporaryFile() as f:
+        shutil.copyfileobj(sys.stdin.buffer, f)
+        f.seek(0)
+        return load_dataset(f, file_type or "csv")
+
+
+def write_results(df, path):
+    """Write results as Parquet or Arrow by the path's extension (.parquet, .arrow), otherwise as CSV ('-' for stdout)"""
+    if path == "-":
+        df.to_csv(sys.stdout, index=False)
+        return
+    file_format = {".parquet": "parquet", ".arrow": "arrow", ".feather": "arrow"}.get(os.path.splitext(path)[1].lower(), "csv")
+    with open(path, "wb") as f:
+        f.write(export_results(df, file_format))
+
+
+def join(source_df, results_df):
+    """Merge the results onto the table they were generated from, matching rows by index"""
+    return join_results(source_df, results_df)
+
+
+def estimate(df, field_descriptions, model, reasoning=False):
+    """Estimate tokens and cost of a transformation"""
+    # tiktoken is only needed here, so it isn't loaded for the other commands
+    from src.utils.estimate_util import estimate_cost
+    return estimate_cost(df, field_descriptions, model, reasoning=reasoning)
+
+
+def submit(api_key, df, field_descriptions, model, pack_size=1, cache=None, incremental=True, reasoning=False, estimate=None,
+           escalate_to=None, min_confidence=None):
+    """Submit a transformation as a batch and return (batch_id, stats).
+
+    reasoning asks the model to explain its values. An estimate from
+    estimate() is recorded with the job, to compare its actual usage with.
+    With escalate_to, rows that fail their checks or are answered with less
+    than min_confidence are sent again to that model once model is done.
+    """
+    if estimate is not None:
+        from src.utils.estimate_util import job_estimate
+        estimate = job_estimate(estimate, pack_size)
+    return apply_transformation(
+        api_key, df, field_descriptions, model, cache=cache, pack_size=pack_size, incremental=incremental,
+        reasoning=reasoning, estimate=estimate,
+        cascade={"model": escalate_to, "min_confidence": min_confidence} if escalate_to else None
+    )
+
+
+def test_run(api_key, df, field_descriptions, model, rows=DEFAULT_TEST_ROWS, stratify_by=None, concurrency=DEFAULT_CONCURRENCY,
+             reasoning=False, total_requests=None, rpm=DEFAULT_RPM, tpm=DEFAULT_TPM):
+    """Transform a sample of rows right away and project the full dataset's cost and time from them.
+
+    Returns (rows_df, projection): the sampled rows with their values,
+    latency and token usage, and one projection per mode for total_requests
+    requests (by default one per distinct prompt, since rows with identical
+    prompts are sent once).
+    """
+    from src.utils.estimate_util import count_requests, project_test_run
+    rows_df, _ = apply_test_run(
+        df, field_descriptions, api_key, model, sample_size=rows, stratify_by=stratify_by,
+        concurrency=concurrency, reasoning=reasoning
+    )
+    projection = project_test_run(
+        rows_df.attrs["requests"], total_requests or count_requests(df, field_descriptions, reasoning), model, max_tokens=rows_df.attrs["max_tokens"],
+        batch_seconds=JobRegistry().batch_durations(provider_for_model(model).name),
+        rpm=rpm, tpm=tpm, concurrency=concurrency
+    )
+    return rows_df, projection
+
+
+def status(batch_id, api_key):
+    """Return the combined status of a batch without downloading its results"""
+    return get_batch_status(batch_id, api_key)
+
+
+def jobs(api_key, limit=None):
+    """Return the jobs submitted from this machine with api_key, newest first"""
+    return JobRegistry().jobs(api_key, limit)
+
+
+def usage_report(batch_id, results_df, api_key):
+    """Return estimated versus actual requests, tokens and cost of a finished job, or None if no estimate was recorded"""
+    job = JobRegistry().job(batch_id, api_key)
+    usage = results_df.attrs.get("usage")
+    if job is None or not job["estimate"] or not usage:
+        return None
+    from src.utils.estimate_util import usage_comparison
+    return usage_comparison(job["estimate"], usage)
+
+
+def fetch(batch_id, api_key, wait=False, poll_interval=60, on_poll=None):
+    """Return (done, results_df, batch), polling until the batch finishes when wait is set.
+
+    Registered jobs keep their results once they finish, and later fetches
+    with the same API key return them without calling the API.
+    """
+    registry = JobRegistry()
+    job = registry.job(batch_id, api_key)
+    if job is not None and job["done"]:
+        df = registry.load_results(batch_id, api_key)
+        if df is not None:
+            counts = RequestCounts(completed=job["completed"], failed=job["failed"], total=job["total"])
+            return True, df, JobStatus(id=job["job_id"], status=job["status"], request_counts=counts, batches=[])
+
+    while True:
+        done, df, batch = check_batch_status(batch_id, api_key)
+        if done and job is not None:
+            registry.save_results(batch_id, df, batch)
+        if done or not wait:
+            return done, df, batch
+        if on_poll is not None:
+            on_poll(batch)
+        time.sleep(poll_interval)
@@ -0,0 +1,21 @@
+from collections import OrderedDict
+
+import pytest
+
+from src.utils import client_util
+from src.utils.cache_util import ResponseCache
+
+
+@pytest.fixture
+def fake_cache(tmp_path, monkeypatch):
+    """A response cache in a temporary folder, with batches run by the offline fake backend"""
+    monkeypatch.setenv("TABLETALK_BACKEND", "fake")
+    monkeypatch.setenv("TABLETALK_FAKE_DIR", str(tmp_path / "fake"))
+    monkeypatch.setenv("TABLETALK_FAKE_BATCH_SECONDS", "0")
+    monkeypatch.setenv("TABLETALK_FAKE_FAILURE_RATE", "0")
+    monkeypatch.setenv("TABLETALK_CACHE_PATH", str(tmp_path / "cache.sqlite"))
+    monkeypatch.setenv("TABLETALK_REQUEST_DIR", str(tmp_path / "requests"))
+    monkeypatch.delenv("TABLETALK_METRICS_PATH", raising=False)
+    # Clients read the fake backend's settings when they're created
+    monkeypatch.setattr(client_util, "_clients", OrderedDict())
+    return ResponseCache(str(tmp_path / "cache.sqlite"))
@@ -0,0 +1,53 @@
+import itertools
+from types import SimpleNamespace
+
+import pytest
+
+from src.utils import cache_util
+from src.utils.cache_util import ResponseCache
+
+
+@pytest.fixture
+def cache(tmp_path, monkeypatch):
+    # Every access gets a later time, so the least recently used entry is unambiguous
+    clock = itertools.count(1)
+    monkeypatch.setattr(cache_util, "time", SimpleNamespace(time=lambda: float(next(clock))))
+    return ResponseCache(str(tmp_path / "cache.sqlite"), max_bytes=1000)
+
+
+def test_least_recently_used_responses_are_evicted(cache):
+    cache.put_many([(f"k{i}", "x" * 200) for i in range(4)])
+    # Reading k0 makes k1 the least recently used
+    assert cache.get("k0") == "x" * 200
+    cache.put("k4", "x" * 200)
+
+    # Over the limit: evict down to 90% of it, oldest first
+    cache.put("k5", "x" * 200)
+    assert set(cache.get_many([f"k{i}" for i in range(6)])) == {"k0", "k3", "k4", "k5"}
+
+
+def test_field_results_share_the_size_limit(cache):
+    cache.put_field_values("dataset", "model", "fingerprint", ["0", "1"], ["a" * 150, "b" * 150])
+    cache.put_many([(f"k{i}", "x" * 200) for i in range(3)])
+    assert cache.field_values("dataset", "model", "fingerprint") == {"0": "a" * 150, "1": "b" * 150}
+
+    # The field results were read last, so the oldest responses go first
+    cache.put("k3", "x" * 200)
+    assert cache.stored_fields("dataset", "model", ["fingerprint"]) == {"fingerprint"}
+    assert set(cache.get_many([f"k{i}" for i in range(4)])) == {"k2", "k3"}
+
+
+def test_responses_are_kept_apart_per_account():
+    assert ResponseCache.namespace("account 1", "model", "schema") != ResponseCache.namespace("account 2", "model", "schema")
+    field = {"field_name": "summary", "instructions": "Summarize @text"}
+    assert ResponseCache.field_fingerprint(field, "account 1") != ResponseCache.field_fingerprint(field, "account 2")
+
+
+def test_discarded_jobs_leave_no_rows(cache):
+    cache.add_job_rows("job", [("0", "k0", None), ("1", "k1", "{}")])
+    cache.add_row_map("job", [b'{"custom_id": "0", "duplicates": ["2"]}'])
+    cache.add_job_fields("job", "dataset", "model", [("fingerprint", "summary", True)])
+    cache.discard_job("job")
+    assert cache.job_rows("job") == []
+    assert cache.row_map_lines("job") == []
+    assert cache.job_fields("job") == []
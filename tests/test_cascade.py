@@ -0,0 +1,47 @@
+import pandas as pd
+
+from src.utils.llm_util import apply_transformation, check_batch_status
+
+API_KEY = "sk-test"
+
+FIELDS = [{"field_name": "summary", "instructions": "Summarize @text", "data_type": "text"}]
+
+# Nearly every fake confidence is below this, so nearly every row is escalated
+CASCADE = {"model": "gpt-4.1", "min_confidence": 0.999}
+
+
+def _df(rows):
+    return pd.DataFrame({"text": [f"item {i}" for i in range(rows)]})
+
+
+def _run(cache, df):
+    job_id, stats = apply_transformation(API_KEY, df, FIELDS, "gpt-4o-mini", cache=cache, incremental=False, cascade=CASCADE)
+    for _ in range(3):
+        done, results_df, batch = check_batch_status(job_id, API_KEY, cache)
+        if done:
+            return stats, results_df
+        assert batch.status == "escalating"
+    raise AssertionError("the job didn't finish")
+
+
+def test_rows_that_fail_their_checks_are_escalated(fake_cache):
+    _, results_df = _run(fake_cache, _df(6))
+    cascade = results_df.attrs["cascade"]
+    assert cascade["escalated"] == 6
+    assert cascade["not_escalated"] == 0
+    assert cascade["usage"]["requests"] == 6
+    assert results_df["summary"].notna().all()
+
+
+def test_cached_rows_that_fail_their_checks_are_reported_as_not_escalated(fake_cache):
+    _run(fake_cache, _df(6))
+
+    # Rows 0 to 5 are answered from the cache, so only rows 6 to 9 have requests to escalate
+    stats, results_df = _run(fake_cache, _df(10))
+    assert stats["cache_hits"] == 6
+    cascade = results_df.attrs["cascade"]
+    assert cascade["escalated"] == 4
+    assert cascade["usage"]["requests"] == 4
+    assert cascade["not_escalated"] == 6
+    assert cascade["still_failing"] >= 6
+    assert len(results_df) == 10
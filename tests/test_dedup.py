@@ -0,0 +1,63 @@
+import json
+
+import pandas as pd
+import pytest
+
+from src.utils.job_util import RowMap
+from src.utils.llm_util import apply_transformation, check_batch_status
+from src.utils.result_util import fan_out_rows
+
+API_KEY = "sk-test"
+
+FIELDS = [
+    {"field_name": "summary", "instructions": "Summarize @text", "data_type": "text"},
+    {"field_name": "score", "instructions": "Score @text", "data_type": "number"},
+]
+
+
+def test_row_map_sends_the_first_row_of_each_prompt():
+    row_map = RowMap()
+    prompts = ["a", "b", "a", "c", "b", "a"]
+    sent = [str(i) for i, prompt in enumerate(prompts) if row_map.add(str(i), prompt)]
+    assert sent == ["0", "1", "3"]
+    assert row_map.duplicates == {"0": ["2", "5"], "1": ["4"]}
+    assert (row_map.rows, row_map.requests) == (6, 3)
+    assert row_map.dedup_ratio == 2.0
+
+
+def test_row_map_lines_list_duplicates_and_packs():
+    row_map = RowMap()
+    for i, prompt in enumerate(["a", "a", "b"]):
+        row_map.add(str(i), prompt)
+    row_map.add_pack("pack-0", ["0", "2"])
+    assert [json.loads(line) for line in row_map.iter_lines()] == [
+        {"custom_id": "0", "duplicates": ["1"]},
+        {"custom_id": "pack-0", "rows": ["0", "2"]},
+    ]
+
+
+def test_fan_out_copies_results_to_duplicates_in_row_order():
+    results_df = pd.DataFrame({"row_number": ["0", "3", "10"], "value": ["x", "y", "z"]})
+    results_df.attrs["usage"] = {"requests": 3}
+    fanned_out = fan_out_rows(results_df, {"0": ["2", "11"], "3": ["4"], "7": ["8"]})
+    assert list(fanned_out["row_number"]) == ["0", "2", "3", "4", "10", "11"]
+    assert list(fanned_out["value"]) == ["x", "x", "y", "y", "z", "x"]
+    assert fanned_out.attrs == results_df.attrs
+
+
+@pytest.mark.parametrize("model", ["gpt-4o", "claude-3-5-haiku-latest"])
+@pytest.mark.parametrize("pack_size", [None, 3])
+def test_rows_sharing_a_prompt_get_the_same_result(fake_cache, model, pack_size):
+    df = pd.DataFrame({"text": ["a", "b", "a", "c", "b", "a", "d"]})
+    job_id, stats = apply_transformation(API_KEY, df, FIELDS, model, cache=fake_cache, pack_size=pack_size)
+    assert stats["rows"] == 7
+    assert stats["requests"] == (4 if pack_size is None else 2)
+
+    done, results_df, _ = check_batch_status(job_id, API_KEY, fake_cache)
+    assert done
+    assert list(results_df["row_number"]) == [str(i) for i in range(7)]
+    assert results_df["summary"].notna().all()
+    for first, duplicates in {0: [2, 5], 1: [4]}.items():
+        for duplicate in duplicates:
+            assert results_df.loc[duplicate, ["summary", "score"]].tolist() == results_df.loc[first, ["summary", "score"]].tolist()
+    assert results_df.attrs["row_breakdown"]["completed"] == 7
@@ -0,0 +1,31 @@
+import pytest
+
+from src.utils.job_util import CACHED_JOB_PREFIX, decode_job_id, encode_job_id, job_provider
+
+
+def test_single_batch_keeps_its_id():
+    assert encode_job_id(["batch_abc"]) == "batch_abc"
+    assert decode_job_id("batch_abc") == ["batch_abc"]
+    assert job_provider("batch_abc") == "openai"
+
+
+@pytest.mark.parametrize("provider", ["openai", "anthropic"])
+def test_sharded_job_round_trip(provider):
+    batch_ids = ["batch_1", "batch_2", "msgbatch_01Ab-_c"]
+    job_id = encode_job_id(batch_ids, provider)
+    assert decode_job_id(job_id) == batch_ids
+    assert job_provider(job_id) == provider
+
+
+def test_provider_prefix():
+    job_id = encode_job_id(["msgbatch_1"], "anthropic")
+    assert job_id == "anthropic:msgbatch_1"
+    assert decode_job_id(job_id) == ["msgbatch_1"]
+    assert decode_job_id(f" {job_id}\n") == ["msgbatch_1"]
+
+
+@pytest.mark.parametrize("provider", ["openai", "anthropic"])
+def test_cached_job_keeps_its_provider(provider):
+    job_id = encode_job_id([f"{CACHED_JOB_PREFIX}0123"], provider)
+    assert decode_job_id(job_id) == []
+    assert job_provider(job_id) == provider
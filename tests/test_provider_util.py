@@ -0,0 +1,64 @@
+import gzip
+import io
+import json
+import os
+from types import SimpleNamespace
+
+from src.utils.provider_util import AnthropicProvider, discard_request_archives, request_archive_path
+
+
+class MessageBatches:
+    def __init__(self, entries):
+        self.entries = entries
+        self.created = []
+        self.results_calls = 0
+
+    def create(self, requests):
+        self.created.append(requests)
+        return SimpleNamespace(id="msgbatch_1")
+
+    def results(self, batch_id):
+        self.results_calls += 1
+        return iter(self.entries)
+
+
+def _client(entries=()):
+    return SimpleNamespace(messages=SimpleNamespace(batches=MessageBatches(list(entries))))
+
+
+def _entry(custom_id, result_type):
+    message = SimpleNamespace(
+        content=[SimpleNamespace(type="tool_use", input={"a": 1})],
+        model="claude-test",
+        usage=SimpleNamespace(input_tokens=10, cache_read_input_tokens=0, cache_creation_input_tokens=0, output_tokens=2)
+    )
+    return SimpleNamespace(custom_id=custom_id, result=SimpleNamespace(type=result_type, message=message))
+
+
+def test_failed_requests_are_collected_with_the_results():
+    client = _client([_entry("0", "succeeded"), _entry("1", "errored"), _entry("2", "expired")])
+    provider = AnthropicProvider()
+    batch = SimpleNamespace(id="msgbatch_1")
+    failed_ids = []
+    results = list(provider.iter_results(client, batch, failed_ids))
+    assert [custom_id for custom_id, _, _ in results] == ["0"]
+    assert results[0][1] == json.dumps({"a": 1})
+    assert failed_ids == ["1", "2"]
+    assert list(provider.iter_failed(client, batch)) == []
+    assert client.messages.batches.results_calls == 1
+
+
+def test_create_batch_archives_requests_until_discarded(tmp_path, monkeypatch):
+    monkeypatch.setenv("TABLETALK_REQUEST_DIR", str(tmp_path))
+    lines = [json.dumps({"custom_id": str(i), "params": {}}).encode("utf-8") for i in range(3)]
+    client = _client()
+    provider = AnthropicProvider()
+    assert provider.create_batch(client, io.BytesIO(b"\n".join(lines)), None) == "msgbatch_1"
+    assert client.messages.batches.created == [[json.loads(line) for line in lines]]
+    assert os.listdir(tmp_path) == ["msgbatch_1.jsonl.gz"]
+    with gzip.open(request_archive_path("msgbatch_1")) as f:
+        assert f.read().splitlines() == lines
+    assert list(provider.iter_requests(client, SimpleNamespace(id="msgbatch_1"))) == lines
+
+    discard_request_archives(["msgbatch_1", "msgbatch_missing"])
+    assert os.listdir(tmp_path) == []
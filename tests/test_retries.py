@@ -0,0 +1,52 @@
+import pandas as pd
+import pytest
+
+from src.utils.llm_util import MAX_RETRY_ROUNDS, apply_transformation, check_batch_status
+from src.utils.registry_util import JobRegistry
+
+API_KEY = "sk-test"
+
+FIELDS = [{"field_name": "summary", "instructions": "Summarize @text", "data_type": "text"}]
+
+MODELS = ["gpt-4o-mini", "claude-3-5-haiku-latest"]
+
+
+def _check_until_done(cache, job_id):
+    statuses = []
+    for _ in range(MAX_RETRY_ROUNDS + 2):
+        done, results_df, batch = check_batch_status(job_id, API_KEY, cache)
+        if done:
+            return statuses, results_df
+        statuses.append(batch.status)
+    raise AssertionError("the job didn't finish")
+
+
+@pytest.mark.parametrize("model", MODELS)
+def test_rows_that_keep_failing_are_retried_max_rounds_then_reported(fake_cache, monkeypatch, model):
+    monkeypatch.setenv("TABLETALK_FAKE_FAILURE_RATE", "1")
+    df = pd.DataFrame({"text": [f"item {i}" for i in range(8)]})
+    job_id, _ = apply_transformation(API_KEY, df, FIELDS, model, cache=fake_cache)
+
+    statuses, results_df = _check_until_done(fake_cache, job_id)
+    assert statuses == ["retrying"] * MAX_RETRY_ROUNDS
+    assert len(JobRegistry(fake_cache.path).job_retries(job_id)) == MAX_RETRY_ROUNDS
+    breakdown = results_df.attrs["row_breakdown"]
+    assert breakdown["retry_rounds"] == MAX_RETRY_ROUNDS
+    assert breakdown["completed"] == 0 and breakdown["failed"] == 8
+    assert results_df.attrs["failed_rows"] == [str(i) for i in range(8)]
+
+
+@pytest.mark.parametrize("model", MODELS)
+def test_failed_rows_are_recovered_by_retries(fake_cache, monkeypatch, model):
+    monkeypatch.setenv("TABLETALK_FAKE_FAILURE_RATE", "0.5")
+    df = pd.DataFrame({"text": [f"item {i}" for i in range(40)]})
+    job_id, _ = apply_transformation(API_KEY, df, FIELDS, model, cache=fake_cache)
+
+    statuses, results_df = _check_until_done(fake_cache, job_id)
+    breakdown = results_df.attrs["row_breakdown"]
+    assert breakdown["retry_rounds"] == len(statuses) >= 1
+    assert breakdown["recovered_by_retry"] > 0
+    assert breakdown["completed"] + breakdown["failed"] == 40
+    assert set(results_df["row_number"]) | set(results_df.attrs["failed_rows"]) == {str(i) for i in range(40)}
+    returned = results_df["summary"].notna()
+    assert set(results_df["row_number"][returned]).isdisjoint(results_df.attrs["failed_rows"])
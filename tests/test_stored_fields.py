@@ -0,0 +1,86 @@
+import pandas as pd
+import pytest
+
+from src.utils.cache_util import ResponseCache
+from src.utils.client_util import key_hash
+from src.utils.ingest_util import dataset_fingerprint
+from src.utils.job_util import decode_job_id, job_provider
+from src.utils.llm_util import _merge_stored_fields, apply_transformation, check_batch_status
+
+API_KEY = "sk-test"
+
+FIELDS = [
+    {"field_name": "summary", "instructions": "Summarize @text", "data_type": "text"},
+    {"field_name": "score", "instructions": "Score @text", "data_type": "number"},
+]
+
+
+def _df():
+    return pd.DataFrame({"text": [f"item {i}" for i in range(6)]})
+
+
+def _run(cache, df, model, **kwargs):
+    job_id, stats = apply_transformation(API_KEY, df, FIELDS, model, cache=cache, **kwargs)
+    done, results_df, _ = check_batch_status(job_id, API_KEY, cache)
+    assert done
+    return job_id, stats, results_df
+
+
+@pytest.mark.parametrize("model, provider", [("gpt-4o", "openai"), ("claude-3-5-haiku-latest", "anthropic")])
+def test_stored_fields_are_reused_without_a_batch(fake_cache, model, provider):
+    _, stats, first = _run(fake_cache, _df(), model)
+    assert stats["fields_submitted"] == 2
+
+    job_id, stats, again = _run(fake_cache, _df(), model)
+    assert stats["requests"] == 0 and stats["fields_reused"] == 2
+    assert decode_job_id(job_id) == [] and job_provider(job_id) == provider
+    pd.testing.assert_frame_equal(again[first.columns], first, check_like=True)
+
+
+def test_rows_missing_from_a_stored_field_are_generated_again(fake_cache):
+    df = _df()
+    _, _, first = _run(fake_cache, df, "gpt-4o")
+
+    # Leave rows 3 and 4 out of the stored summaries, as a run where they failed would
+    dataset = dataset_fingerprint(df)
+    fingerprint = ResponseCache.field_fingerprint(FIELDS[0], key_hash(API_KEY))
+    values = fake_cache.field_values(dataset, "gpt-4o", fingerprint)
+    kept = {row_id: value for row_id, value in values.items() if row_id not in ("3", "4")}
+    fake_cache.put_field_values(dataset, "gpt-4o", fingerprint, list(kept), list(kept.values()))
+
+    _, stats, again = _run(fake_cache, df, "gpt-4o")
+    assert stats["fields_submitted"] == 1 and stats["fields_reused"] == 1
+    assert stats["rows"] == 2
+    assert list(again["row_number"]) == [str(i) for i in range(6)]
+    regenerated = again["row_number"].isin(["3", "4"])
+    assert again["summary"].notna().all()
+    assert list(again["summary"][~regenerated]) == list(first["summary"][~regenerated])
+    assert list(again["score"]) == list(first["score"])
+    assert set(fake_cache.field_values(dataset, "gpt-4o", fingerprint)) == set(values)
+
+    _, stats, _ = _run(fake_cache, df, "gpt-4o")
+    assert stats["requests"] == 0 and stats["fields_reused"] == 2
+
+
+def test_only_values_that_pass_on_the_job_model_are_stored(fake_cache):
+    field = {"field_name": "label", "instructions": "Label @text", "data_type": "text", "allowed_values": ["ok", "fine"]}
+    fingerprint = ResponseCache.field_fingerprint(field, key_hash(API_KEY))
+    fake_cache.add_job_fields("job_1", "dataset", "gpt-4o", [(fingerprint, "label", True)])
+    results_df = pd.DataFrame({
+        "row_number": ["0", "1", "2", "3", "4"],
+        "label": ["ok", None, "wrong", "fine", "ok"],
+    })
+
+    merged = _merge_stored_fields(fake_cache, "job_1", results_df, [field], escalated_rows=["3"])
+    assert fake_cache.field_values("dataset", "gpt-4o", fingerprint) == {"0": "ok", "4": "ok"}
+    assert list(merged["label"].fillna("")) == ["ok", "", "wrong", "fine", "ok"]
+
+    # A later job fills the gaps; the earlier values stay for rows it didn't return
+    fake_cache.add_job_fields("job_2", "dataset", "gpt-4o", [(fingerprint, "label", True)])
+    later_df = pd.DataFrame({"row_number": ["1", "2", "3"], "label": ["fine", "ok", "ok"]})
+    merged = _merge_stored_fields(fake_cache, "job_2", later_df, [field])
+    assert fake_cache.field_values("dataset", "gpt-4o", fingerprint) == {
+        "0": "ok", "1": "fine", "2": "ok", "3": "ok", "4": "ok"
+    }
+    assert list(merged["row_number"]) == ["0", "1", "2", "3", "4"]
+    assert list(merged["label"]) == ["ok", "fine", "ok", "ok", "ok"]